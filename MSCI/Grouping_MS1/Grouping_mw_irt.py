@@ -56,25 +56,94 @@ def find_combinations_kdtree(data, tolerance1, tolerance2, use_ppm=True):
 
     return valid_combinations
 
+def find_candidate_pairs(mw, irt, tolerance1, tolerance2, use_ppm=True, chunk_size=5_000_000):
+    """
+    Vectorized MS1 grouping: all pairs inside the m/z (ppm or absolute) x iRT box.
+
+    The precursors are sorted by mass once and every precursor is compared with the
+    window of heavier precursors it can reach, chunk by chunk, using the exact tests
+    of within_ppm/within_tolerance (the ppm window is taken from the first element of
+    the pair in input order). Returns two int arrays of positions, pos1 < pos2, sorted
+    by (pos1, pos2).
+
+    Usage:
+    pos1, pos2 = find_candidate_pairs(mz_irt_df['MW'], mz_irt_df['iRT'], 10, 5, use_ppm=True)
+    """
+    mw = np.asarray(mw, dtype=float)
+    irt = np.asarray(irt, dtype=float)
+    n_points = len(mw)
+
+    order = np.argsort(mw, kind='stable')
+    sorted_mw = mw[order]
+    if use_ppm:
+        ppm_fraction = tolerance1 / 1e6
+        # Either element's ppm window may apply, the heavier one reaches furthest
+        reach = sorted_mw / (1 - ppm_fraction) if ppm_fraction < 1 else np.full(n_points, np.inf)
+    else:
+        reach = sorted_mw + tolerance1
+    reach = reach + np.abs(reach) * 1e-9 + 1e-12
+    window_end = np.searchsorted(sorted_mw, reach, side='right')
+    counts = window_end - np.arange(n_points) - 1
+    cumulative = np.cumsum(counts)
+
+    index1_parts, index2_parts = [], []
+    start = 0
+    while start < n_points:
+        # Take as many sorted precursors as fit in chunk_size candidate pairs (at least one)
+        done = cumulative[start - 1] if start else 0
+        end = max(np.searchsorted(cumulative, done + chunk_size, side='right'), start + 1)
+        block_counts = counts[start:end]
+        total = int(block_counts.sum())
+        if total:
+            first = np.repeat(np.arange(start, end), block_counts)
+            block_offsets = np.concatenate(([0], np.cumsum(block_counts)[:-1]))
+            second = first + 1 + np.arange(total) - np.repeat(block_offsets, block_counts)
+
+            a = order[first]
+            b = order[second]
+            pos1 = np.minimum(a, b)
+            pos2 = np.maximum(a, b)
+            if use_ppm:
+                keep = np.abs(mw[pos1] - mw[pos2]) <= (mw[pos1] * tolerance1) / 1e6
+            else:
+                keep = np.abs(mw[pos1] - mw[pos2]) <= tolerance1
+            keep &= np.abs(irt[pos1] - irt[pos2]) <= tolerance2
+            index1_parts.append(pos1[keep])
+            index2_parts.append(pos2[keep])
+        start = end
+
+    if index1_parts:
+        pos1 = np.concatenate(index1_parts)
+        pos2 = np.concatenate(index2_parts)
+    else:
+        pos1 = np.empty(0, dtype=np.int64)
+        pos2 = np.empty(0, dtype=np.int64)
+    sort = np.lexsort((pos2, pos1))
+    return pos1[sort], pos2[sort]
+
+
+def _pairs_table(mz_irt_df, pos1, pos2):
+    """Candidate pair table with the original index labels and precursor values of both peptides."""
+    labels = mz_irt_df.index.to_numpy()
+    # Pairs are reported with the smaller index label first
+    swap = labels[pos1] > labels[pos2]
+    pos1, pos2 = np.where(swap, pos2, pos1), np.where(swap, pos1, pos2)
+
+    names = mz_irt_df['Name'].to_numpy()
+    mw = mz_irt_df['MW'].to_numpy()
+    irt = mz_irt_df['iRT'].to_numpy()
+    return pd.DataFrame({
+        'index1': labels[pos1],
+        'index2': labels[pos2],
+        'peptide 1': names[pos1],
+        'peptide 2': names[pos2],
+        'm/z  1': mw[pos1],
+        'm/z 2': mw[pos2],
+        'iRT 1': irt[pos1],
+        'iRT 2': irt[pos2],
+    })
+
+
 def process_peptide_combinations(mz_irt_df, tolerance1, tolerance2, use_ppm=True):
-    compatible_data = make_data_compatible(mz_irt_df)
-    result_tolerance = find_combinations_kdtree(compatible_data, tolerance1, tolerance2, use_ppm)
-    unique_result_tolerance = list({tuple(sorted(pair)) for pair in result_tolerance})
-    
-    # Create a DataFrame for the results
-    results = []
-    for (index1, mw1, irt1), (index2, mw2, irt2) in unique_result_tolerance:
-        results.append({
-            'index1': index1,
-            'index2': index2,
-            'peptide 1': mz_irt_df.loc[index1, 'Name'],
-            'peptide 2': mz_irt_df.loc[index2, 'Name'],
-            'm/z  1': mz_irt_df.loc[index1, 'MW'],
-            'm/z 2': mz_irt_df.loc[index2, 'MW'],
-            'iRT 1': mz_irt_df.loc[index1, 'iRT'],
-            'iRT 2': mz_irt_df.loc[index2, 'iRT'],
-        })
-
-    results_df = pd.DataFrame(results)
-    print("Results DataFrame Columns:", results_df.columns)  # Debugging line
-    return results_df
+    pos1, pos2 = find_candidate_pairs(mz_irt_df['MW'], mz_irt_df['iRT'], tolerance1, tolerance2, use_ppm)
+    return _pairs_table(mz_irt_df, pos1, pos2)
@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+
+from MSCI.Grouping_MS1.Grouping_mw_irt import find_candidate_pairs
+from MSCI.Preprocessing.peptide_mass import PROTON_MASS
+
+
+def precursor_mz(neutral_mass, charge):
+    """Precursor m/z of a neutral mass at the given charge."""
+    return (neutral_mass + charge * PROTON_MASS) / charge
+
+
+def neutral_mass_from_mz(mz, charge):
+    """Neutral mass of a precursor from its m/z (the MW field of our MSP files) and charge."""
+    return mz * charge - charge * PROTON_MASS
+
+
+def split_name(names):
+    """Split 'SEQUENCE/charge' names into a sequence array and an int charge array."""
+    parts = pd.Series(names).str.rsplit('/', n=1, expand=True)
+    return parts[0].to_numpy(dtype=object), parts[1].astype(int).to_numpy()
+
+
+class NeutralMassIndex:
+    """
+    Peptides indexed once by neutral mass, for grouping across charge states.
+
+    The m/z of every charge state is derived from the neutral mass when candidates
+    are generated, so one index answers any set of charges without re-predicting or
+    re-grouping per charge.
+
+    Usage:
+    index = NeutralMassIndex.from_msp_frame(read_msp_file('library.msp'))
+    pairs = index.candidate_pairs(charges=(1, 2, 3, 4), tolerance1=10, tolerance2=5)
+    """
+
+    def __init__(self, sequences, neutral_masses, irt):
+        self.sequences = np.asarray(sequences, dtype=object)
+        self.neutral_masses = np.asarray(neutral_masses, dtype=float)
+        self.irt = np.asarray(irt, dtype=float)
+
+        # Keep the peptides sorted by neutral mass, so every charge's m/z is sorted too
+        order = np.argsort(self.neutral_masses, kind='stable')
+        self.sequences = self.sequences[order]
+        self.neutral_masses = self.neutral_masses[order]
+        self.irt = self.irt[order]
+
+    @classmethod
+    def from_msp_frame(cls, mz_irt_df):
+        """Build the index from a read_msp_file table ('SEQ/charge' names, MW = precursor m/z)."""
+        sequences, charges = split_name(mz_irt_df['Name'])
+        neutral = neutral_mass_from_mz(mz_irt_df['MW'].to_numpy(dtype=float), charges)
+        # One entry per sequence; iRT does not depend on the charge
+        _, first = np.unique(sequences.astype(str), return_index=True)
+        first = np.sort(first)
+        return cls(sequences[first], neutral[first], mz_irt_df['iRT'].to_numpy(dtype=float)[first])
+
+    def __len__(self):
+        return len(self.sequences)
+
+    def mz(self, charge):
+        """Precursor m/z of every peptide at the given charge, in index order."""
+        return precursor_mz(self.neutral_masses, charge)
+
+    def candidate_pairs(self, charges=(1, 2, 3, 4), tolerance1=10, tolerance2=5, use_ppm=True):
+        """
+        Pairs of (peptide, charge) states within the m/z x iRT box, within and across charges.
+
+        All charge states are swept together in one pass; pairs of two charge states of
+        the same peptide are left out. Returns a DataFrame with the peptide positions in
+        the index, the charges and the columns of process_peptide_combinations.
+        """
+        charges = np.asarray(charges, dtype=np.int64)
+        n_peptides = len(self)
+        state_peptide = np.tile(np.arange(n_peptides), len(charges))
+        state_charge = np.repeat(charges, n_peptides)
+        state_mz = precursor_mz(self.neutral_masses[state_peptide], state_charge)
+        state_irt = self.irt[state_peptide]
+
+        pos1, pos2 = find_candidate_pairs(state_mz, state_irt, tolerance1, tolerance2, use_ppm)
+        distinct = state_peptide[pos1] != state_peptide[pos2]
+        pos1, pos2 = pos1[distinct], pos2[distinct]
+
+        peptide1, peptide2 = state_peptide[pos1], state_peptide[pos2]
+        charge1, charge2 = state_charge[pos1], state_charge[pos2]
+        return pd.DataFrame({
+            'index1': peptide1,
+            'charge 1': charge1,
+            'index2': peptide2,
+            'charge 2': charge2,
+            'peptide 1': [f"{s}/{z}" for s, z in zip(self.sequences[peptide1], charge1.tolist())],
+            'peptide 2': [f"{s}/{z}" for s, z in zip(self.sequences[peptide2], charge2.tolist())],
+            'm/z  1': state_mz[pos1],
+            'm/z 2': state_mz[pos2],
+            'iRT 1': state_irt[pos1],
+            'iRT 2': state_irt[pos2],
+        })
+
+
+def process_multicharge_combinations(mz_irt_df, tolerance1, tolerance2, use_ppm=True, charges=None):
+    """
+    Multi-charge grouping for a predicted library holding several charge states per peptide.
+
+    Candidates are generated from a NeutralMassIndex built once for charges (default:
+    every charge present in the library) and only pairs whose two states were predicted
+    are kept. index1/index2 are the row labels of mz_irt_df, so the result can be passed
+    to the similarity scorers like the output of process_peptide_combinations.
+    """
+    sequences, state_charges = split_name(mz_irt_df['Name'])
+    if charges is None:
+        charges = np.unique(state_charges)
+    index = NeutralMassIndex.from_msp_frame(mz_irt_df)
+    pairs = index.candidate_pairs(charges, tolerance1, tolerance2, use_ppm)
+
+    rows = pd.Series(mz_irt_df.index.to_numpy(), index=mz_irt_df['Name'].to_numpy())
+    rows = rows[~rows.index.duplicated()]
+    label1 = rows.reindex(pairs['peptide 1'].to_numpy()).to_numpy()
+    label2 = rows.reindex(pairs['peptide 2'].to_numpy()).to_numpy()
+    predicted = ~(pd.isna(label1) | pd.isna(label2))
+
+    pairs = pairs[predicted].reset_index(drop=True)
+    pairs['index1'] = label1[predicted].astype(mz_irt_df.index.dtype)
+    pairs['index2'] = label2[predicted].astype(mz_irt_df.index.dtype)
+    return pairs.drop(columns=['charge 1', 'charge 2'])
@@ -0,0 +1,148 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from MSCI.Grouping_MS1.Grouping_mw_irt import find_candidate_pairs, _pairs_table
+
+
+def _iter_precursor_chunks(precursors, chunksize):
+    """Yield DataFrames with Name, MW and iRT columns from a DataFrame, a CSV/Parquet file or an iterable."""
+    if isinstance(precursors, pd.DataFrame):
+        for start in range(0, len(precursors), chunksize):
+            yield precursors.iloc[start:start + chunksize]
+    elif isinstance(precursors, (str, os.PathLike)):
+        if str(precursors).endswith('.parquet'):
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(precursors).iter_batches(batch_size=chunksize, columns=['Name', 'MW', 'iRT']):
+                yield batch.to_pandas()
+        else:
+            yield from pd.read_csv(precursors, usecols=['Name', 'MW', 'iRT'], chunksize=chunksize)
+    else:
+        yield from precursors
+
+
+def _bin_path(work_dir, mass_bin):
+    return Path(work_dir) / f"bin_{mass_bin:010d}.parquet"
+
+
+def partition_by_mass(precursors, work_dir, bin_width=1.0, chunksize=1_000_000):
+    """
+    First pass: split the precursors into mass bins on disk.
+
+    Every input chunk is cut by floor(MW / bin_width) and each piece is appended as a
+    row group to work_dir/bin_<bin>.parquet, with a global 'row' number (the position
+    of the precursor in the input); one ParquetWriter stays open per bin until the
+    input is consumed. Returns the sorted list of non-empty bins.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([('row', pa.int64()), ('Name', pa.string()), ('MW', pa.float64()), ('iRT', pa.float64()),
+                        ('bin', pa.int64())])
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    writers = {}
+    row_offset = 0
+    try:
+        for chunk in _iter_precursor_chunks(precursors, chunksize):
+            chunk = pd.DataFrame({
+                'row': np.arange(row_offset, row_offset + len(chunk), dtype=np.int64),
+                'Name': chunk['Name'].to_numpy(),
+                'MW': chunk['MW'].to_numpy(dtype=float),
+                'iRT': chunk['iRT'].to_numpy(dtype=float),
+            })
+            row_offset += len(chunk)
+            chunk['bin'] = np.floor(chunk['MW'].to_numpy() / bin_width).astype(np.int64)
+
+            for mass_bin, piece in chunk.groupby('bin', sort=False):
+                mass_bin = int(mass_bin)
+                if mass_bin not in writers:
+                    writers[mass_bin] = pq.ParquetWriter(_bin_path(work_dir, mass_bin), schema)
+                writers[mass_bin].write_table(pa.Table.from_pandas(piece, schema=schema, preserve_index=False))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return sorted(writers)
+
+
+def _read_bin(work_dir, mass_bin):
+    return pd.read_parquet(_bin_path(work_dir, mass_bin))
+
+
+def stream_peptide_combinations(precursors, output_dir, tolerance1, tolerance2, use_ppm=True,
+                                bin_width=1.0, chunksize=1_000_000, work_dir=None):
+    """
+    Out-of-core version of process_peptide_combinations for very large precursor universes.
+
+    The precursors (a DataFrame, a CSV/Parquet file with Name, MW and iRT columns, or an
+    iterable of such DataFrames) are partitioned into mass bins on disk, then every bin is
+    grouped together with the part of the following bins that lies within the m/z
+    tolerance. A pair is written by the bin of its lighter precursor only, so no pair is
+    reported twice. Peak memory is bounded by a bin plus its overlap, not by the universe.
+
+    Candidate pairs are written incrementally to output_dir/pairs_<bin>.parquet with the
+    columns of process_peptide_combinations; index1 and index2 are the row numbers of the
+    precursors in the input. Returns the list of written files.
+
+    Usage:
+    files = stream_peptide_combinations('precursors.parquet', 'pairs/', 10, 5, use_ppm=True)
+    pairs = pd.read_parquet('pairs/')
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    own_work_dir = work_dir is None
+    work_dir = Path(tempfile.mkdtemp(prefix='msci_bins_') if own_work_dir else work_dir)
+
+    written = []
+    try:
+        bins = partition_by_mass(precursors, work_dir, bin_width, chunksize)
+        loaded = {}
+        for position, mass_bin in enumerate(bins):
+            # Drop bins that can no longer overlap with the current one
+            for old_bin in [b for b in loaded if b < mass_bin]:
+                del loaded[old_bin]
+            if mass_bin not in loaded:
+                loaded[mass_bin] = _read_bin(work_dir, mass_bin)
+            current = loaded[mass_bin]
+
+            max_mw = current['MW'].max()
+            if use_ppm:
+                ppm_fraction = tolerance1 / 1e6
+                reach = max_mw / (1 - ppm_fraction) if ppm_fraction < 1 else np.inf
+            else:
+                reach = max_mw + tolerance1
+            reach += abs(reach) * 1e-9 + 1e-12
+
+            frames = [current]
+            for next_bin in bins[position + 1:]:
+                if next_bin * bin_width > reach:
+                    break
+                if next_bin not in loaded:
+                    loaded[next_bin] = _read_bin(work_dir, next_bin)
+                overlap = loaded[next_bin]
+                frames.append(overlap[overlap['MW'].to_numpy() <= reach])
+
+            # Positions follow input order so the ppm window is taken as in memory
+            window = pd.concat(frames, ignore_index=True).sort_values('row', kind='stable')
+            window = window.set_index('row')
+            pos1, pos2 = find_candidate_pairs(window['MW'], window['iRT'], tolerance1, tolerance2, use_ppm)
+
+            bin_ids = window['bin'].to_numpy()
+            mw = window['MW'].to_numpy()
+            lighter = np.where(mw[pos1] <= mw[pos2], pos1, pos2)
+            owned = bin_ids[lighter] == mass_bin
+            pairs = _pairs_table(window, pos1[owned], pos2[owned])
+
+            if len(pairs):
+                path = output_dir / f"pairs_{mass_bin:010d}.parquet"
+                pairs.to_parquet(path, index=False)
+                written.append(path)
+    finally:
+        if own_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return written
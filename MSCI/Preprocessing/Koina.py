@@ -1,178 +1,75 @@
-import requests
-import pandas as pd
-import re
-from itertools import combinations
-import streamlit as st
-import time
-# Existing masses and modifications
-PARTICLE_MASSES = {"PROTON": 1.007276467, "ELECTRON": 0.00054858}
-
-ATOM_MASSES = {
-    "H": 1.007825035,
-    "C": 12.0,
-    "O": 15.9949146,
-    "N": 14.003074,
-}
-
-MASSES = {**PARTICLE_MASSES, **ATOM_MASSES}
-MASSES["N_TERMINUS"] = MASSES["H"]
-MASSES["C_TERMINUS"] = MASSES["O"] + MASSES["H"]
-
-AA_MASSES = {
-    "A": 71.037114,
-    "R": 156.101111,
-    "N": 114.042927,
-    "D": 115.026943,
-    "C": 103.009185,
-    "E": 129.042593,
-    "Q": 128.058578,
-    "G": 57.021464,
-    "H": 137.058912,
-    "I": 113.084064,
-    "L": 113.084064,
-    "K": 128.094963,
-    "M": 131.040485,
-    "F": 147.068414,
-    "P": 97.052764,
-    "S": 87.032028,
-    "T": 101.047679,
-    "U": 150.95363,
-    "W": 186.079313,
-    "Y": 163.063329,
-    "V": 99.068414,
-    "[]-": MASSES["N_TERMINUS"],
-    "-[]": MASSES["C_TERMINUS"],
-}
-
-MOD_MASSES = {
-    "[UNIMOD:737]": 229.162932,  # TMT_6
-    "[UNIMOD:2016]": 304.207146,  # TMT_PRO
-    "[UNIMOD:214]": 144.102063,  # iTRAQ4
-    "[UNIMOD:730]": 304.205360,  # iTRAQ8
-    "[UNIMOD:259]": 8.014199,  # SILAC Lysine
-    "[UNIMOD:267]": 10.008269,  # SILAC Arginine
-    "[]": 0.0,
-    "[UNIMOD:1]": 42.010565,  # Acetylation
-    "[UNIMOD:1896]": 158.003765,  # DSSO-crosslinker
-    "[UNIMOD:1881]": 54.010565,  # Alkene short fragment of DSSO-crosslinker
-    "[UNIMOD:1882]": 85.982635,  # Thiol long fragment of DSSO-crosslinker
-    "[UNIMOD:1884]": 196.084792,  # BuUrBu (DSBU)-crosslinker
-    "[UNIMOD:1885]": 111.032028,  # BuUr long fragment of BuUrBu (DSBU)-crosslinker
-    "[UNIMOD:1886]": 85.052764,  # Bu short fragment of BuUrBu (DSBU)-crosslinker
-    "[UNIMOD:1898]": 138.068080,  # DSS and BS3 non-cleavable crosslinker
-    "[UNIMOD:122]": 27.994915,  # Formylation
-    "[UNIMOD:1289]": 70.041865,  # Butyrylation
-    "[UNIMOD:1363]": 68.026215,  # Crotonylation
-    "[UNIMOD:1848]": 114.031694,  # Glutarylation
-    "[UNIMOD:1914]": -32.008456,  # Oxidation and then loss of oxidized M side chain
-    "[UNIMOD:2]": -0.984016,  # Amidation
-    "[UNIMOD:21]": 79.966331,  # Phosphorylation
-    "[UNIMOD:213]": 541.06111,  # ADP-ribosylation
-    "[UNIMOD:23]": -18.010565,  # Water Loss
-    "[UNIMOD:24]": 71.037114,  # Propionamidation
-    "[UNIMOD:354]": 44.985078,  # Nitrosylation
-    "[UNIMOD:28]": -17.026549,  # Glu to PyroGlu
-    "[UNIMOD:280]": 28.0313,  # Ethylation
-    "[UNIMOD:299]": 43.989829,  # Carboxylation
-    "[UNIMOD:3]": 226.077598,  # Biotinylation
-    "[UNIMOD:34]": 14.01565,  # Methylation
-    "[UNIMOD:345]": 47.984744,  # Trioxidation
-    "[UNIMOD:35]": 15.994915,  # Hydroxylation
-    "[UNIMOD:351]": 3.994915,  # Oxidation to Kynurenine
-    "[UNIMOD:36]": 28.0313,  # Dimethylation
-    "[UNIMOD:360]": -30.010565,  # Pyrrolidinone
-    "[UNIMOD:368]": -33.987721,  # Dehydroalanine
-    "[UNIMOD:37]": 42.04695,  # Trimethylation
-    "[UNIMOD:385]": -17.026549,  # Ammonia loss
-    "[UNIMOD:392]": 29.974179,  # Quinone
-    "[UNIMOD:4]": 57.021464,  # Carbamidomethyl
-    "[UNIMOD:40]": 79.956815,  # Sulfonation
-    "[UNIMOD:401]": -2.01565,  # Didehydro
-    "[UNIMOD:425]": 31.989829,  # Dioxidation
-    "[UNIMOD:43]": 203.079373,  # HexNAc
-    "[UNIMOD:44]": 204.187801,  # Farnesylation
-    "[UNIMOD:447]": -15.994915,  # Reduction
-    "[UNIMOD:46]": 229.014009,  # Pyridoxal phosphate
-    "[UNIMOD:47]": 238.229666,  # Palmitoylation
-    "[UNIMOD:5]": 43.005814,  # Carbamyl
-    "[UNIMOD:58]": 56.026215,  # Propionylation
-    "[UNIMOD:6]": 58.005479,  # Carboxymethylation
-    "[UNIMOD:64]": 100.016044,  # Succinylation
-    "[UNIMOD:7]": 0.984016,  # Deamidation
-    "[UNIMOD:747]": 86.000394,  # Malonylation
-}
-
-# These are only used for specific applications
-AA_MOD_MASSES = {
-    "K[UNIMOD:737]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:737]"],
-    "M[UNIMOD:35]": AA_MASSES["M"] + MOD_MASSES["[UNIMOD:35]"],
-    "C[UNIMOD:4]": AA_MASSES["C"] + MOD_MASSES["[UNIMOD:4]"],
-    "K[UNIMOD:2016]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:2016]"],
-    "K[UNIMOD:214]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:214]"],
-    "K[UNIMOD:730]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:730]"],
-    "S[UNIMOD:21]": AA_MASSES["S"] + MOD_MASSES["[UNIMOD:21]"],
-    "T[UNIMOD:21]": AA_MASSES["T"] + MOD_MASSES["[UNIMOD:21]"],
-    "Y[UNIMOD:21]": AA_MASSES["Y"] + MOD_MASSES["[UNIMOD:21]"],
-    "S[UNIMOD:23]": AA_MASSES["S"],  # + MOD_MASSES['[UNIMOD:23]'],
-    "T[UNIMOD:23]": AA_MASSES["T"],  # + MOD_MASSES['[UNIMOD:23]'],
-    "Y[UNIMOD:23]": AA_MASSES["Y"],  # + MOD_MASSES['[UNIMOD:23]'],
-    "K[UNIMOD:1896]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1896]"],
-    "K[UNIMOD:1881]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1881]"],
-    "K[UNIMOD:1882]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1882]"],
-    "K[UNIMOD:1884]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1884]"],
-    "K[UNIMOD:1885]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1885]"],
-    "K[UNIMOD:1886]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1886]"],
-    "K[UNIMOD:1898]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1898]"],
-    "[UNIMOD:1]-": MASSES["N_TERMINUS"] + MOD_MASSES["[UNIMOD:1]"],
-    "K[UNIMOD:259]": AA_MASSES["K"],  # + MOD_MASSES['[UNIMOD:259]'],
-    # To make vecMZ work
-    "R[UNIMOD:267]": AA_MASSES["R"],  # + MOD_MASSES['[UNIMOD:267]']
-}
-
-AA_MOD = {**AA_MASSES, **AA_MOD_MASSES}
-
-import re
-
-import re
-import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
 import pandas as pd
 import requests
-import re
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from MSCI.Preprocessing.packed_spectra import PackedSpectra
+from MSCI.Preprocessing.spectral_library import SpectralLibraryWriter
+from MSCI.progress import default_progress
+# The mass tables used to be defined here; they stay importable from this module
+from MSCI.Preprocessing.peptide_mass import (  # noqa: F401
+    PARTICLE_MASSES, ATOM_MASSES, MASSES, AA_MASSES, MOD_MASSES, AA_MOD_MASSES, AA_MOD, PROTON_MASS, peptide_masses
+)
+
+KOINA_URL = "https://koina.wilhelmlab.org"
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
 
 
 class PeptideProcessor:
-    def __init__(self, input_file, collision_energy, charge, model_intensity, model_irt, instrument_type="QE"):
+    def __init__(self, input_file, collision_energy, charge, model_intensity, model_irt, instrument_type="QE",
+                 server_url=KOINA_URL, batch_size=1000, max_workers=4, max_retries=5, backoff_factor=0.5,
+                 session=None, cache=None, peptides=None, progress=None):
         self.input_file = input_file
+        # Peptides given directly (a list, or any iterable streamed once) are used instead of input_file
+        self.peptides = peptides
         self.collision_energy = collision_energy
         self.charge = charge
+        # A list of charges predicts every peptide at each of them
+        self.charges = list(charge) if isinstance(charge, (list, tuple)) else [charge]
         self.instrument_type = instrument_type
         self.model_intensity = model_intensity
         self.model_irt = model_irt
-        self.model_intensity_url = f"https://koina.wilhelmlab.org/v2/models/{model_intensity}/infer"
-        self.model_irt_url = f"https://koina.wilhelmlab.org/v2/models/{model_irt}/infer"
+        self.model_intensity_url = f"{server_url}/v2/models/{model_intensity}/infer"
+        self.model_irt_url = f"{server_url}/v2/models/{model_irt}/infer"
+        self.batch_size = batch_size
+        # Number of batches kept in flight; each batch sends its iRT and intensity requests together
+        self.max_workers = max_workers
+        self.session = session or self.create_session(max_workers, max_retries, backoff_factor)
+        # Optional PredictionCache consulted before sending peptides to Koina
+        self.cache = cache
+        # Reporter called as progress(done, total) per batch (see MSCI.progress)
+        self.progress = progress
+
+    @staticmethod
+    def create_session(max_workers=4, max_retries=5, backoff_factor=0.5):
+        """One pooled HTTP session for all requests, retrying 429/5xx with exponential backoff."""
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset(["POST"]),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=2 * max_workers, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
 
     def calculate_peptide_mass(self, peptide_sequence):
-        total_mass = MASSES["N_TERMINUS"]
-        pattern = re.compile(r'([A-Z])(\[UNIMOD:\d+\])?')
-
-        for match in pattern.finditer(peptide_sequence):
-            aa = match.group(1)
-            mod = match.group(2)
-            
-            if aa in AA_MASSES:
-                total_mass += AA_MASSES[aa]
-                if mod:
-                    mod_mass = MOD_MASSES.get(mod, 0.0)
-                    total_mass += mod_mass
-            else:
-                print(f"Unknown amino acid: {aa}")
-                return None
-        
-        total_mass += MASSES["C_TERMINUS"]
-        return total_mass
+        """Neutral mass of one sequence, or None if it holds an unknown residue or modification."""
+        masses, valid = peptide_masses([peptide_sequence])
+        return float(masses[0]) if valid[0] else None
 
-    def get_request_body(self, peptides, model_type):
+    def get_request_body(self, peptides, model_type, charges=None):
+        if charges is None:
+            charges = [self.charge] * len(peptides)
         if model_type.startswith("Prosit"):
             return {
                 "id": "batch_request",
@@ -193,7 +90,7 @@ class PeptideProcessor:
                         "name": "precursor_charges",
                         "shape": [len(peptides), 1],
                         "datatype": "INT32",
-                        "data": [self.charge] * len(peptides)
+                        "data": list(charges)
                     }
                 ]
             }
@@ -211,18 +108,59 @@ class PeptideProcessor:
                         "name": "precursor_charges",
                         "shape": [len(peptides), 1],
                         "datatype": "INT32",
-                        "data": [self.charge] * len(peptides)
+                        "data": list(charges)
                     }
                 ]
             }
         else:
             raise ValueError("Unsupported model type")
 
-    def get_predictions(self, peptides):
-        model_type = self.model_intensity.split("_")[0]  # Determine model type from the name
-        request_body = self.get_request_body(peptides, self.model_intensity)
+    def get_predictions(self, peptides, charges=None):
+        if charges is None:
+            charges = [self.charge] * len(peptides)
+
+        if self.cache is None:
+            peak_lists = self.request_predictions(peptides, charges)
+        else:
+            # Only peptides missing from the cache are sent to Koina
+            peak_lists = self.cache.get_intensities(peptides, charges, self.collision_energy, self.model_intensity)
+            missing = [i for i, peaks in enumerate(peak_lists) if peaks is None]
+            if missing:
+                missing_peptides = [peptides[i] for i in missing]
+                missing_charges = [charges[i] for i in missing]
+                fetched = self.request_predictions(missing_peptides, missing_charges)
+                if fetched is None:
+                    return None
+                self.cache.put_intensities(
+                    missing_peptides, missing_charges, self.collision_energy, self.model_intensity,
+                    [mz for mz, _ in fetched], [intensity for _, intensity in fetched]
+                )
+                for i, peaks in zip(missing, fetched):
+                    peak_lists[i] = peaks
+
+        if peak_lists is None:
+            return None
+
+        rows = []
+        for i, peptide in enumerate(peptides):
+            peptide_mz_values, peptide_intensities = peak_lists[i]
+            row = {
+                'peptide_sequence': peptide,
+                'charge': charges[i],
+                'collision_energy': self.collision_energy,
+                'mz_values': peptide_mz_values,
+                'intensities': peptide_intensities
+            }
+            rows.append(row)
+
+        df = pd.DataFrame(rows)
+        return df
 
-        response = requests.post(self.model_intensity_url, json=request_body)
+    def request_predictions(self, peptides, charges):
+        """Query the intensity model; returns (mz_values, intensities) lists per peptide or None."""
+        request_body = self.get_request_body(peptides, self.model_intensity, charges)
+
+        response = self.session.post(self.model_intensity_url, json=request_body)
 
         if response.status_code == 200:
             predictions = response.json()
@@ -232,25 +170,15 @@ class PeptideProcessor:
                 mz_values = [float(mz) for mz in predictions['outputs'][1]['data']]
             except KeyError:
                 return None
-            
+
             num_intensities_per_peptide = len(intensities) // len(peptides)
 
-            rows = []
-            for i, peptide in enumerate(peptides):
+            peak_lists = []
+            for i in range(len(peptides)):
                 peptide_intensities = intensities[i * num_intensities_per_peptide : (i + 1) * num_intensities_per_peptide]
                 peptide_mz_values = mz_values[i * num_intensities_per_peptide : (i + 1) * num_intensities_per_peptide]
-                
-                row = {
-                    'peptide_sequence': peptide,
-                    'charge': self.charge,
-                    'collision_energy': self.collision_energy,
-                    'mz_values': peptide_mz_values,
-                    'intensities': peptide_intensities
-                }
-                rows.append(row)
-            
-            df = pd.DataFrame(rows)
-            return df
+                peak_lists.append((peptide_mz_values, peptide_intensities))
+            return peak_lists
         else:
             return None
 
@@ -258,6 +186,23 @@ class PeptideProcessor:
         if not self.model_irt_url:
             return [0.0] * len(peptides)  # Return default iRT value if no model is specified
 
+        if self.cache is None:
+            return self.request_irt_predictions(peptides)
+
+        irt_values = self.cache.get_irt(peptides, self.model_irt)
+        missing = [i for i, irt in enumerate(irt_values) if irt is None]
+        if missing:
+            missing_peptides = [peptides[i] for i in missing]
+            fetched = self.request_irt_predictions(missing_peptides)
+            if fetched is None:
+                return None
+            self.cache.put_irt(missing_peptides, self.model_irt, fetched)
+            for i, irt in zip(missing, fetched):
+                irt_values[i] = irt
+        return irt_values
+
+    def request_irt_predictions(self, peptides):
+        """Query the iRT model; returns the list of iRT values or None."""
         request_body = {
             "id": "test_id",
             "inputs": [
@@ -270,7 +215,7 @@ class PeptideProcessor:
             ]
         }
 
-        response = requests.post(self.model_irt_url, json=request_body)
+        response = self.session.post(self.model_irt_url, json=request_body)
 
         if response.status_code == 200:
             predictions = response.json()
@@ -281,7 +226,7 @@ class PeptideProcessor:
 
     def format_msp(self, peptide, charge, collision_energy, mz_values, intensities, irt):
         mw = self.calculate_peptide_mass(peptide)
-        mz = (mw + (charge * 1.007276)) / charge
+        mz = (mw + (charge * PROTON_MASS)) / charge
 
         # Convert to float to ensure no format issues
         mz = float(mz)
@@ -312,22 +257,112 @@ class PeptideProcessor:
             msp_entry = self.format_msp(row['peptide_sequence'], row['charge'], row['collision_energy'], row['mz_values'], row['intensities'], irt)
             file.write(msp_entry)
 
-    def process(self, output_filename):
-        peptides = pd.read_csv(self.input_file, header=None)[0].tolist()
-        batch_size = 1000
-        total_batches = len(peptides) // batch_size + (1 if len(peptides) % batch_size != 0 else 0)
-        progress_bar = st.progress(0)
-
-        with open(output_filename, 'w') as file:
-            for i, start in enumerate(range(0, len(peptides), batch_size)):
-                batch_peptides = peptides[start:start + batch_size]
-                irt_values = self.get_irt_predictions(batch_peptides)
-                df = self.get_predictions(batch_peptides)
+    def predict_batch(self, executor, batch_peptides):
+        """Submit the iRT and intensity requests of one batch concurrently and return both futures."""
+        # Every peptide is predicted at each requested charge; iRT does not depend on it
+        state_peptides = [peptide for peptide in batch_peptides for _ in self.charges]
+        state_charges = [charge for _ in batch_peptides for charge in self.charges]
+        irt_future = executor.submit(self.get_irt_predictions, batch_peptides)
+        intensity_future = executor.submit(self.get_predictions, state_peptides, state_charges)
+        return irt_future, intensity_future
+
+    def iter_predictions(self, peptides):
+        """
+        Yield (predictions DataFrame, iRT per row) for every batch of peptides, in input order.
+
+        peptides may be any iterable, e.g. a generator; it is consumed one batch at a time.
+        max_workers batches are kept in flight; a failed batch yields (None, None).
+        """
+        batch_size = self.batch_size
+        peptides = iter(peptides)
+        batches = iter(lambda: list(islice(peptides, batch_size)), [])
+        with ThreadPoolExecutor(max_workers=2 * self.max_workers) as executor:
+            in_flight = deque()
+            while True:
+                # Keep max_workers batches in flight, handed back in submission order
+                for batch_peptides in batches:
+                    in_flight.append(self.predict_batch(executor, batch_peptides))
+                    if len(in_flight) >= self.max_workers:
+                        break
+                if not in_flight:
+                    break
+
+                irt_future, intensity_future = in_flight.popleft()
+                irt_values = irt_future.result()
+                df = intensity_future.result()
 
                 if df is not None and irt_values is not None:
+                    yield df, [irt for irt in irt_values for _ in self.charges]
+                else:
+                    yield None, None
+
+    def predictions_to_packed(self, df, irt_values):
+        """
+        Convert one batch of Koina predictions to PackedSpectra without going through MSP text.
+
+        Peaks flagged -1 by the model are dropped and the remaining ones sorted by m/z, as in
+        format_msp; metadata holds Name, MW (precursor m/z), iRT, sequence, charge and
+        collision_energy.
+        """
+        mz = np.array(df['mz_values'].tolist(), dtype=float).reshape(len(df), -1)
+        intensities = np.array(df['intensities'].tolist(), dtype=float).reshape(len(df), -1)
+        valid = (mz != -1.00) & (intensities != -1.000000)
+        rows = np.broadcast_to(np.arange(len(df))[:, None], mz.shape)[valid]
+        order = np.lexsort((intensities[valid], mz[valid], rows))
+        offsets = np.concatenate(([0], np.cumsum(valid.sum(axis=1))))
+
+        sequences = df['peptide_sequence'].tolist()
+        charges = df['charge'].to_numpy(dtype=int)
+        masses, _ = peptide_masses(sequences)
+        metadata = pd.DataFrame({
+            'Name': [f"{peptide}/{charge}" for peptide, charge in zip(sequences, charges.tolist())],
+            'MW': (masses + (charges * PROTON_MASS)) / charges,
+            'iRT': np.asarray(irt_values, dtype=float),
+            'sequence': sequences,
+            'charge': charges,
+            'collision_energy': df['collision_energy'].to_numpy(dtype=float),
+        })
+        return PackedSpectra(offsets, mz[valid][order], intensities[valid][order], metadata)
+
+    def read_peptides(self):
+        if self.peptides is not None:
+            return list(self.peptides)
+        return pd.read_csv(self.input_file, header=None)[0].tolist()
+
+    def iter_batches(self, progress=None):
+        """
+        iter_predictions over the input peptides, reporting progress(done, total) after every batch.
+
+        progress defaults to the processor's reporter, else a Streamlit bar inside the GUI and
+        log lines elsewhere (see MSCI.progress).
+        """
+        # Peptides given as a generator are streamed; the number of batches is then unknown
+        peptides = self.peptides if self.peptides is not None else self.read_peptides()
+        total_batches = None
+        if hasattr(peptides, '__len__'):
+            total_batches = len(peptides) // self.batch_size + (1 if len(peptides) % self.batch_size != 0 else 0)
+        progress = progress or self.progress or default_progress("Predicting")
+
+        progress(0, total_batches)
+        for i, (df, irt_values) in enumerate(self.iter_predictions(peptides)):
+            yield df, irt_values
+            progress(i + 1, total_batches)  # Update progress
+
+    def process(self, output_filename, progress=None):
+        with open(output_filename, 'w') as file:
+            for df, irt_values in self.iter_batches(progress):
+                if df is not None:
                     self.save_to_msp(df, file, irt_values)
-                
-                progress_bar.progress((i + 1) / total_batches)  # Update progress
-                time.sleep(0.1)  # Simulate delay for user experience
 
-        st.success("Processing complete!")
+    def process_to_packed(self, progress=None):
+        """Predict the input peptides into one in-memory PackedSpectra (same spectra as process writes)."""
+        parts = [self.predictions_to_packed(df, irt_values)
+                 for df, irt_values in self.iter_batches(progress) if df is not None]
+        return PackedSpectra.concat(parts)
+
+    def process_to_library(self, output_path, progress=None):
+        """Predict the input peptides straight into a binary spectral library (see spectral_library)."""
+        with SpectralLibraryWriter(output_path) as writer:
+            for df, irt_values in self.iter_batches(progress):
+                if df is not None:
+                    writer.write(self.predictions_to_packed(df, irt_values))
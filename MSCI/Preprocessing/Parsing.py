@@ -1,6 +1,6 @@
+import numpy as np
 import pandas as pd
-from pyopenms import MzMLFile, MSExperiment
-from pyteomics import mgf
+from MSCI.Preprocessing.read_msp_file import read_msp
 
 def read_msp_file(filename):
     spectra = []
@@ -29,39 +29,45 @@ def process_spectrum(spectrum):
         mw = precursors[0].getMZ()
         rt = spectrum.getRT()
         num_peaks = spectrum.size()
-        peaks = [(peak.getMZ(), peak.getIntensity()) for peak in spectrum]
+        mz_values, intensities = spectrum.get_peaks()
+        peaks = list(zip(mz_values.tolist(), intensities.tolist()))
         return {'MW': mw, 'RT': rt, 'Num Peaks': num_peaks, 'Peaks': peaks}
     return None
 
-def read_mgf_file(filename):
+def read_mgf_file(filename, summary=None):
+    from MSCI.Preprocessing.read_mgf import iter_mgf
+
+    # Spectra are streamed in packed batches (see read_mgf.iter_mgf); missing values are counted in summary
     spectra = []
-    with mgf.read(filename) as mgf_file:
-        for spectrum in mgf_file:
-            mz_values = spectrum['m/z array']
-            intensities = spectrum['intensity array']
-            mw = spectrum['params'].get('pepmass', [None])[0]
-            rt = spectrum['params'].get('rtinseconds', None)
-            if rt is None:
-                print(f"Warning: No retention time found for spectrum with MW {mw}.")
+    for batch in iter_mgf(filename, summary=summary):
+        metadata = batch.metadata
+        for i in range(len(batch)):
+            mz_values, intensities = batch.peaks(i)
+            mw, rt = metadata['MW'].iat[i], metadata['RT'].iat[i]
             spectra.append({
                 'mz_values': mz_values,
                 'intensities': intensities,
-                'MW': mw,
-                'RT': rt
+                'MW': None if np.isnan(mw) else float(mw),
+                'RT': None if np.isnan(rt) else float(rt)
             })
-            print(f"Spectrum with {len(mz_values)} m/z values and {len(intensities)} intensities. MW: {mw}, RT: {rt}")
     return spectra
 
 def read_mzml_file(filename):
+    from MSCI.Preprocessing.read_mzml import iter_mzml
+
+    # Spectra are streamed in packed batches (see read_mzml.iter_mzml) instead of loading the whole run
     spectra_data = []
-    exp = MSExperiment()
-    MzMLFile().load(filename, exp)
+    for batch in iter_mzml(filename, ms_level=None):
+        metadata = batch.metadata
+        for i in np.flatnonzero(metadata['MW'].notna().to_numpy()):
+            mz_values, intensities = batch.peaks(i)
+            spectra_data.append({
+                'MW': float(metadata['MW'].iat[i]),
+                'RT': float(metadata['RT'].iat[i]),
+                'Num Peaks': len(mz_values),
+                'Peaks': list(zip(mz_values.tolist(), intensities.tolist())),
+            })
 
-    for spectrum in exp:
-        processed_spectrum = process_spectrum(spectrum)
-        if processed_spectrum:
-            spectra_data.append(processed_spectrum)
-    
     return spectra_data
 
 def read_ms_file(filename):
@@ -75,10 +81,36 @@ def read_ms_file(filename):
     else:
         raise ValueError(f"Unsupported file format: {file_extension}")
 
-# Example usage
-file_path = 'Z:/zelhamraoui/MSCA_Package/real_data/example.mgf'
-result = read_ms_file(file_path)
-if isinstance(result, pd.DataFrame):
-    display(result)
-else:
+def read_packed_spectra(filename):
+    """
+    Read an MSP, mzML (MS2) or MGF file into PackedSpectra for the grouping and similarity engines.
+
+    The metadata always has Name, MW (precursor m/z) and iRT columns; for measured runs
+    (mzML, MGF) iRT holds the retention time in seconds, so the iRT tolerance of the
+    grouping applies to RT. The mzML and MGF readers (pyopenms, pyteomics) are only
+    imported for their own formats.
+
+    Usage:
+    packed = read_packed_spectra('run.mgf')
+    Groups_df = process_peptide_combinations(packed.metadata, 10, 30)
+    """
+    file_extension = str(filename).split('.')[-1].lower()
+    if file_extension == 'msp':
+        return read_msp(filename)
+    if file_extension == 'mzml':
+        from MSCI.Preprocessing.read_mzml import read_mzml
+        packed = read_mzml(filename)
+        packed.metadata['Name'] = packed.metadata['native_id']
+    elif file_extension == 'mgf':
+        from MSCI.Preprocessing.read_mgf import read_mgf
+        packed = read_mgf(filename)
+    else:
+        raise ValueError(f"Unsupported file format: {file_extension}")
+    packed.metadata['iRT'] = packed.metadata['RT']
+    return packed
+
+if __name__ == "__main__":
+    # Example usage
+    file_path = 'Z:/zelhamraoui/MSCA_Package/real_data/example.mgf'
+    result = read_ms_file(file_path)
     print(result)
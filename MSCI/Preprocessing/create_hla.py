@@ -1,19 +1,15 @@
-from Bio import SeqIO
+from MSCI.Preprocessing.digestion import digest, digest_fasta
+
 
 def generate_variable_length_peptides(protein_sequence, min_length=8, max_length=11):
     """Generate all variable length peptides from a protein sequence."""
-    peptides = []
-    for length in range(min_length, max_length + 1):
-        peptides.extend([protein_sequence[i:i+length] for i in range(len(protein_sequence) - length + 1)])
-    return peptides
+    return list(digest(protein_sequence, 'nonspecific', min_length=min_length, max_length=max_length))
 
-# Path to the human proteome FASTA file
-fasta_file = "Z:/zelhamraoui/MSCA_Package/IMMUNO/immuno/sp_human_2023_04.fasta"
 
-# List to store all variable length peptides
-all_peptides = []
+if __name__ == "__main__":
+    # Path to the human proteome FASTA file
+    fasta_file = "Z:/zelhamraoui/MSCA_Package/IMMUNO/immuno/sp_human_2023_04.fasta"
 
-# Parse the FASTA file and generate variable length peptides
-for record in SeqIO.parse(fasta_file, "fasta"):
-    protein_sequence = str(record.seq)
-    all_peptides.extend(generate_variable_length_peptides(protein_sequence))
+    # Stream the proteome and write every distinct 8-11mer once
+    count = digest_fasta(fasta_file, "hla_peptides.txt", enzyme='nonspecific', min_length=8, max_length=11)
+    print(f"{count} distinct HLA peptides written to hla_peptides.txt")
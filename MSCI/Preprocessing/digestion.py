@@ -0,0 +1,196 @@
+import gzip
+import heapq
+import os
+import re
+import tempfile
+from pathlib import Path
+
+from MSCI.Preprocessing.peptide_mass import peptide_masses
+
+# Cleavage rules as zero-width patterns matching between two residues; None cuts everywhere
+ENZYMES = {
+    'trypsin': r'(?<=[KR])(?!P)',
+    'trypsin/p': r'(?<=[KR])',
+    'lys-c': r'(?<=K)',
+    'arg-c': r'(?<=R)(?!P)',
+    'asp-n': r'(?=D)',
+    'glu-c': r'(?<=E)',
+    'chymotrypsin': r'(?<=[FWYL])(?!P)',
+    'nonspecific': None,
+}
+
+
+def _open_text(path):
+    return gzip.open(path, 'rt') if str(path).endswith('.gz') else open(path)
+
+
+def read_fasta(path):
+    """
+    Yield (header, sequence) for every record of a FASTA file (optionally gzipped), one at a time.
+
+    header is the description line without '>'; sequences are upper-cased and joined over lines.
+    """
+    header, lines = None, []
+    with _open_text(path) as file:
+        for line in file:
+            line = line.strip()
+            if line.startswith('>'):
+                if header is not None:
+                    yield header, ''.join(lines).upper()
+                header, lines = line[1:], []
+            elif line:
+                lines.append(line)
+    if header is not None:
+        yield header, ''.join(lines).upper()
+
+
+def _cleavage_rule(enzyme):
+    if enzyme not in ENZYMES:
+        raise ValueError(f"Unknown enzyme: {enzyme} (choose from {', '.join(ENZYMES)})")
+    rule = ENZYMES[enzyme]
+    return None if rule is None else re.compile(rule)
+
+
+def digest_spans(sequence, enzyme='trypsin', missed_cleavages=0, min_length=7, max_length=30):
+    """
+    Yield (start, end) of the peptides of a protein sequence, in order of their start position.
+
+    Specific enzymes give the peptides between cleavage sites with up to missed_cleavages
+    skipped sites; 'nonspecific' gives every subsequence (e.g. 8-11mers for HLA ligands).
+    Only peptides within [min_length, max_length] are yielded; sequence[start:end] is
+    the peptide.
+    """
+    rule = _cleavage_rule(enzyme)
+    if rule is None:
+        for start in range(len(sequence)):
+            for length in range(min_length, min(max_length, len(sequence) - start) + 1):
+                yield start, start + length
+        return
+
+    sites = [0] + [match.start() for match in rule.finditer(sequence) if 0 < match.start() < len(sequence)]
+    sites.append(len(sequence))
+    for i in range(len(sites) - 1):
+        for j in range(i + 1, min(i + missed_cleavages + 1, len(sites) - 1) + 1):
+            length = sites[j] - sites[i]
+            if length > max_length:
+                break
+            if length >= min_length:
+                yield sites[i], sites[j]
+
+
+def digest(sequence, enzyme='trypsin', missed_cleavages=0, min_length=7, max_length=30):
+    """
+    Yield the peptides of a protein sequence, in order of their start position (see digest_spans).
+
+    A peptide occurring several times in the sequence is yielded each time.
+    """
+    for start, end in digest_spans(sequence, enzyme, missed_cleavages, min_length, max_length):
+        yield sequence[start:end]
+
+
+def tryptic_digest(sequence, missed_cleavages=0, min_length=7, max_length=30):
+    """Tryptic peptides of a protein sequence with up to missed_cleavages, within the length range."""
+    return list(digest(sequence, 'trypsin', missed_cleavages, min_length, max_length))
+
+
+def iter_proteome_peptides(fasta, enzyme='trypsin', missed_cleavages=0, min_length=7, max_length=30,
+                           min_mass=None, max_mass=None, batch_size=100_000):
+    """
+    Stream the peptides of every protein of a FASTA file in batches (lists) of about batch_size.
+
+    Peptides with residues outside the mass table (X, B, Z, ...) are dropped; min_mass and
+    max_mass bound the neutral monoisotopic mass. Batches are not deduplicated across
+    proteins (see write_unique_peptides).
+    """
+    batch = []
+    for _, sequence in read_fasta(fasta):
+        batch.extend(digest(sequence, enzyme, missed_cleavages, min_length, max_length))
+        if len(batch) >= batch_size:
+            yield _mass_filter(batch, min_mass, max_mass)
+            batch = []
+    if batch:
+        yield _mass_filter(batch, min_mass, max_mass)
+
+
+def _mass_filter(peptides, min_mass, max_mass):
+    masses, keep = peptide_masses(peptides)
+    if min_mass is not None:
+        keep &= masses >= min_mass
+    if max_mass is not None:
+        keep &= masses <= max_mass
+    return [peptide for peptide, kept in zip(peptides, keep.tolist()) if kept]
+
+
+def _spill(unique, run_dir, runs):
+    """Write the in-memory set as a sorted run file and return its path."""
+    path = Path(run_dir) / f"run_{len(runs):06d}.txt"
+    with open(path, 'w') as file:
+        file.writelines(f"{peptide}\n" for peptide in sorted(unique))
+    return path
+
+
+def _merge_runs(runs, file):
+    """Write the distinct lines of sorted run files to file and return their number."""
+    handles = [open(run) for run in runs]
+    try:
+        count, previous = 0, None
+        for line in heapq.merge(*handles):
+            if line != previous:
+                file.write(line)
+                count += 1
+                previous = line
+        return count
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+def write_unique_peptides(batches, output, max_in_memory=2_000_000, work_dir=None):
+    """
+    Write the distinct peptides of an iterable of batches to output, sorted, one per line.
+
+    Duplicates are removed with an in-memory set; once it holds max_in_memory peptides it
+    is written out as a sorted run and cleared, and the runs are merged at the end with
+    duplicates dropped, so memory is bounded by max_in_memory whatever the input size.
+    The result is staged next to output and moved into place when complete; if digestion
+    or the merge fails, the runs and the staging file are removed and output is untouched.
+    Returns the number of distinct peptides.
+    """
+    with tempfile.TemporaryDirectory(prefix='msci_digest_', dir=work_dir) as run_dir:
+        runs = []
+        unique = set()
+        for batch in batches:
+            unique.update(batch)
+            if len(unique) >= max_in_memory:
+                runs.append(_spill(unique, run_dir, runs))
+                unique = set()
+
+        staging = Path(f"{output}.{os.getpid()}.tmp")
+        try:
+            with open(staging, 'w') as file:
+                if not runs:
+                    file.writelines(f"{peptide}\n" for peptide in sorted(unique))
+                    count = len(unique)
+                else:
+                    if unique:
+                        runs.append(_spill(unique, run_dir, runs))
+                    unique = set()
+                    count = _merge_runs(runs, file)
+            os.replace(staging, output)
+        except BaseException:
+            staging.unlink(missing_ok=True)
+            raise
+    return count
+
+
+def digest_fasta(fasta, output, enzyme='trypsin', missed_cleavages=0, min_length=7, max_length=30,
+                 min_mass=None, max_mass=None, max_in_memory=2_000_000):
+    """
+    Digest a whole proteome into a deduplicated peptide file.
+
+    Usage:
+    digest_fasta('human.fasta', 'hla_peptides.txt', enzyme='nonspecific', min_length=8, max_length=11)
+    """
+    batches = iter_proteome_peptides(fasta, enzyme, missed_cleavages, min_length, max_length, min_mass, max_mass)
+    return write_unique_peptides(batches, output, max_in_memory)
+
@@ -1,6 +1,10 @@
 import matchms.filtering as filtering
 import pickle
 
+import numpy as np
+
+from MSCI.Preprocessing.packed_spectra import PackedSpectra
+
 def keep_top_n_peaks(spectrum, n: int):
     """Keep only the top n most intense peaks."""
     return filtering.reduce_to_number_of_peaks(spectrum, n_required=n, n_max=n)
@@ -18,3 +22,106 @@ def filter_spectra_by_top_peaks(input_file_path: str, output_file_path: str, n_p
         pickle.dump(processed_spectra, output_file)
 
     return processed_spectra
+
+
+def select_peaks(packed, keep):
+    """Return PackedSpectra holding only the peaks flagged in the boolean mask keep; spectra are kept."""
+    keep = np.asarray(keep, dtype=bool)
+    counts = np.bincount(packed.segment_ids()[keep], minlength=len(packed))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return PackedSpectra(offsets, packed.mz[keep], packed.intensities[keep], packed.metadata)
+
+
+def _nth_largest(packed, n, block_size=4_000_000):
+    """
+    n-th largest intensity of every spectrum (-inf for spectra with fewer than n peaks).
+
+    Spectra are laid out as rows of a -inf padded block and np.partition finds the value
+    in linear time; blocks hold about block_size cells whatever the largest spectrum.
+    """
+    counts = packed.counts
+    thresholds = np.full(len(packed), -np.inf)
+    width = int(counts.max()) if len(packed) else 0
+    if width < n:
+        return thresholds
+    rows_per_block = max(1, block_size // width)
+    for first in range(0, len(packed), rows_per_block):
+        rows = np.arange(first, min(first + rows_per_block, len(packed)))
+        positions, offsets = packed.gather(rows)
+        block_counts = np.diff(offsets)
+        padded = np.full((len(rows), int(block_counts.max())), -np.inf)
+        if padded.shape[1] < n:
+            continue
+        segments = np.repeat(np.arange(len(rows)), block_counts)
+        padded[segments, np.arange(len(positions)) - offsets[segments]] = packed.intensities[positions]
+        kth = padded.shape[1] - n
+        thresholds[rows] = np.partition(padded, kth, axis=1)[:, kth]
+    return thresholds
+
+
+def top_n_peaks(packed, n, n_required=None):
+    """
+    Keep the n most intense peaks of every spectrum, like
+    reduce_to_number_of_peaks(n_required=n_required, n_max=n).
+
+    Spectra with fewer than n_required peaks (default n, as the matchms filter this
+    replaces) lose all their peaks; they stay in place so pair indices remain valid
+    and score NaN. Pass n_required=0 to keep all peaks of small spectra instead. Among
+    equal intensities at the cut-off the peaks of higher m/z win.
+    """
+    n_required = n if n_required is None else n_required
+    segments = packed.segment_ids()
+    intensities = np.asarray(packed.intensities)
+    threshold = _nth_largest(packed, n)[segments]
+    above = intensities > threshold
+    # Peaks tied with the n-th largest fill the remaining places from the high m/z end
+    tied = intensities == threshold
+    tied_through_spectrum = np.cumsum(np.bincount(segments, weights=tied, minlength=len(packed)))
+    tied_after = tied_through_spectrum[segments] - np.cumsum(tied)
+    places = n - np.bincount(segments, weights=above, minlength=len(packed))
+    keep = above | (tied & (tied_after < places[segments]))
+    keep &= (packed.counts >= n_required)[segments]
+    return select_peaks(packed, keep)
+
+
+def select_by_relative_intensity(packed, intensity_from=0.0, intensity_to=1.0):
+    """Keep peaks whose intensity relative to the spectrum's maximum lies within [intensity_from, intensity_to]."""
+    segments = packed.segment_ids()
+    maximum = np.full(len(packed), -np.inf)
+    np.maximum.at(maximum, segments, packed.intensities)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative = packed.intensities / maximum[segments]
+    return select_peaks(packed, (intensity_from <= relative) & (relative <= intensity_to))
+
+
+def select_by_mz(packed, mz_from=0.0, mz_to=1000.0):
+    """Keep peaks with mz_from <= m/z <= mz_to."""
+    return select_peaks(packed, (mz_from <= packed.mz) & (packed.mz <= mz_to))
+
+
+def remove_zero_intensities(packed):
+    """Drop peaks with an intensity of 0 (e.g. fragments predicted as absent)."""
+    return select_peaks(packed, packed.intensities > 0)
+
+
+def filter_peaks(packed, top_n=None, intensity_from=None, mz_range=None, remove_zeros=False):
+    """
+    Filter the peaks of a whole library at once, in memory.
+
+    Zero intensities, the m/z window and the relative intensity threshold are applied
+    first, then top_n (spectra left with fewer than top_n peaks are emptied, see
+    top_n_peaks); the metadata and the number of spectra are unchanged, so the result
+    can be grouped and scored directly.
+
+    Usage:
+    packed = filter_peaks(read_msp('library.msp'), top_n=6, remove_zeros=True)
+    """
+    if remove_zeros:
+        packed = remove_zero_intensities(packed)
+    if mz_range is not None:
+        packed = select_by_mz(packed, *mz_range)
+    if intensity_from is not None:
+        packed = select_by_relative_intensity(packed, intensity_from, 1.0)
+    if top_n is not None:
+        packed = top_n_peaks(packed, top_n)
+    return packed
@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+
+from MSCI.Preprocessing.packed_spectra import PackedSpectra
+from MSCI.Preprocessing.peptide_mass import ATOM_MASSES, MASSES, PROTON_MASS, encode_peptides
+from MSCI.Similarity.spectral_angle_similarity import _segmented_searchsorted, _within_tolerance
+
+H2O_MASS = 2 * ATOM_MASSES["H"] + ATOM_MASSES["O"]
+CO_MASS = ATOM_MASSES["C"] + ATOM_MASSES["O"]
+
+# Ion series: terminus they contain and mass added to the neutral residue sum
+ION_TYPES = {
+    'a': ('N', -CO_MASS),
+    'b': ('N', 0.0),
+    'y': ('C', H2O_MASS),
+}
+NEUTRAL_LOSSES = {
+    'H2O': H2O_MASS,
+    'NH3': 3 * ATOM_MASSES["H"] + ATOM_MASSES["N"],
+}
+
+
+def fragment_ladders(sequences, ion_types=('b', 'y'), fragment_charges=(1,), neutral_losses=(),
+                     with_annotations=False):
+    """
+    Theoretical fragment m/z of a batch of sequences, computed offline from the mass tables.
+
+    Residue masses are encoded once (see encode_peptides) and every ladder is a cumulative
+    sum over them: b/a ions from the N-terminal prefix sums, y ions from the suffix sums.
+    Every ion type is generated at every fragment charge, with and without each of the
+    neutral_losses ('H2O', 'NH3'). The result is PackedSpectra with unit intensities and
+    one spectrum per sequence (empty for sequences with unknown residues), so the ladders
+    can go straight into score_spectra_pairs for an m/z-only twin pre-screening.
+
+    With with_annotations=True, also returns a DataFrame aligned with the packed peaks with
+    ion_type, ion_number, fragment_charge and neutral_loss columns.
+
+    Usage:
+    ladders = fragment_ladders(peptides, ion_types=('b', 'y'), fragment_charges=(1, 2))
+    prescreen = score_spectra_pairs(index_array, ladders, mz_irt_df, tolerance=0.02)
+    """
+    encoded = encode_peptides(sequences)
+    n_sequences = len(encoded)
+    lengths = encoded.lengths
+    segments = encoded.segment_ids()
+
+    # Prefix sum of the residue masses within each sequence, at every residue; unknown
+    # residues count as 0 so they cannot spill into the following sequences
+    cumulative = np.concatenate(([0.0], np.cumsum(np.nan_to_num(encoded.residue_masses()))))
+    base = cumulative[encoded.offsets[:-1]]
+    totals = cumulative[encoded.offsets[1:]] - base
+    prefix = cumulative[1:] - base[segments]
+    position = np.arange(len(segments)) - encoded.offsets[:-1][segments]
+
+    # One cleavage after every residue but the last one
+    cleavage = (position < lengths[segments] - 1) & encoded.valid[segments]
+    segments, prefix, position = segments[cleavage], prefix[cleavage], position[cleavage]
+    n_terminal_residues = prefix + encoded.n_terminus[segments] - MASSES["N_TERMINUS"]
+    c_terminal_residues = totals[segments] - prefix
+
+    neutral, peak_segments, types, numbers, charges, losses = [], [], [], [], [], []
+    for type_code, ion_type in enumerate(ion_types):
+        terminus, offset = ION_TYPES[ion_type]
+        if terminus == 'N':
+            ion_neutral, ion_number = n_terminal_residues + offset, position + 1
+        else:
+            ion_neutral, ion_number = c_terminal_residues + offset, lengths[segments] - position - 1
+        for loss_code, loss in enumerate(('',) + tuple(neutral_losses)):
+            loss_mass = NEUTRAL_LOSSES[loss] if loss else 0.0
+            for charge in fragment_charges:
+                neutral.append((ion_neutral - loss_mass + charge * PROTON_MASS) / charge)
+                peak_segments.append(segments)
+                types.append(np.full(len(segments), type_code))
+                numbers.append(ion_number)
+                charges.append(np.full(len(segments), charge))
+                losses.append(np.full(len(segments), loss_code))
+
+    mz = np.concatenate(neutral) if neutral else np.empty(0)
+    peak_segments = np.concatenate(peak_segments) if peak_segments else np.empty(0, dtype=np.int64)
+    order = np.lexsort((mz, peak_segments))
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(peak_segments, minlength=n_sequences))))
+    metadata = pd.DataFrame({'sequence': list(sequences), 'valid': encoded.valid})
+    packed = PackedSpectra(offsets, mz[order], np.ones(len(mz)), metadata)
+    if not with_annotations:
+        return packed
+
+    annotations = pd.DataFrame({
+        'ion_type': pd.Categorical.from_codes(np.concatenate(types)[order], categories=list(ion_types)),
+        'ion_number': np.concatenate(numbers)[order],
+        'fragment_charge': np.concatenate(charges)[order],
+        'neutral_loss': pd.Categorical.from_codes(np.concatenate(losses)[order],
+                                                  categories=[''] + list(neutral_losses)),
+    }) if neutral else pd.DataFrame(columns=['ion_type', 'ion_number', 'fragment_charge', 'neutral_loss'])
+    return packed, annotations
+
+
+def fragment_labels(annotations):
+    """Readable labels such as 'b3', 'y7^2' or 'y5-H2O' for fragment annotations."""
+    labels = annotations['ion_type'].astype(str) + annotations['ion_number'].astype(str)
+    loss = annotations['neutral_loss'].astype(str)
+    labels += ('-' + loss).where(loss != '', '')
+    charge = annotations['fragment_charge']
+    labels += ('^' + charge.astype(str)).where(charge > 1, '')
+    return labels
+
+
+def annotate_peaks(spectra, sequences, tolerance=0.02, ppm=0, ion_types=('b', 'y'), fragment_charges=(1,),
+                   neutral_losses=()):
+    """
+    Annotate the peaks of predicted spectra with the nearest theoretical fragment of their sequence.
+
+    spectra is PackedSpectra (e.g. from read_msp or load_library) and sequences holds the
+    sequence of each spectrum. Returns a DataFrame aligned with the packed peaks: the
+    fragment columns of fragment_ladders plus a label, empty where no fragment lies within
+    the tolerance (absolute, or ppm).
+
+    Usage:
+    annotations = annotate_peaks(packed, packed.metadata['sequence'], tolerance=0.02)
+    """
+    ladders, fragments = fragment_ladders(sequences, ion_types, fragment_charges, neutral_losses,
+                                          with_annotations=True)
+    peak_mz = np.asarray(spectra.mz, dtype=float)
+    peak_segments = spectra.segment_ids()
+    ladder_segments = ladders.segment_ids()
+
+    # Nearest theoretical fragment on each side of every peak, within the same sequence;
+    # a missing neighbour points at a NaN sentinel, which never matches
+    n_fragments = len(ladders.mz)
+    fragment_mz = np.append(ladders.mz, np.nan)
+    right = _segmented_searchsorted(ladders.mz, ladder_segments, peak_mz, peak_segments, side='left')
+    left = right - 1
+    left = np.where(left >= ladders.offsets[peak_segments], left, n_fragments)
+    right = np.where(right < ladders.offsets[peak_segments + 1], right, n_fragments)
+    left_diff = peak_mz - fragment_mz[left]
+    right_diff = fragment_mz[right] - peak_mz
+    nearest = np.where((right_diff < left_diff) | np.isnan(left_diff), right, left)
+    matched = _within_tolerance(peak_mz, fragment_mz[nearest], tolerance, ppm)
+
+    annotations = fragments.iloc[nearest[matched]].reset_index(drop=True)
+    result = pd.DataFrame(index=pd.RangeIndex(len(peak_mz)))
+    result['matched'] = matched
+    for column in annotations.columns:
+        result[column] = pd.Series(annotations[column].to_numpy(), index=np.flatnonzero(matched)).reindex(result.index)
+    result['label'] = ''
+    if matched.any():
+        result.loc[matched, 'label'] = fragment_labels(annotations).to_numpy()
+    return result
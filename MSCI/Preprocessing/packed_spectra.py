@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+
+
+class PackedSpectra:
+    """
+    Peaks of many spectra stored in contiguous, CSR-style arrays.
+
+    The peaks of spectrum i are mz[offsets[i]:offsets[i + 1]] and
+    intensities[offsets[i]:offsets[i + 1]], sorted by m/z within each spectrum.
+    An optional metadata DataFrame holds one row per spectrum (e.g. Name, MW, iRT).
+
+    Usage:
+    packed = PackedSpectra.from_spectra(list(load_from_msp(filename)))
+    mz, intensities = packed.peaks(0)
+    """
+
+    def __init__(self, offsets, mz, intensities, metadata=None):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.mz = np.asanyarray(mz)
+        self.intensities = np.asanyarray(intensities)
+        self.metadata = metadata
+
+        if len(self.mz) != len(self.intensities):
+            raise ValueError("mz and intensities must have the same length")
+        if len(self.offsets) == 0 or self.offsets[0] != 0 or self.offsets[-1] != len(self.mz):
+            raise ValueError("offsets must start at 0 and end at the number of peaks")
+
+    @classmethod
+    def from_peak_lists(cls, mz_values, intensities, metadata=None):
+        """Pack per-spectrum peak sequences, sorting each spectrum by m/z."""
+        counts = np.fromiter((len(values) for values in mz_values), dtype=np.int64, count=len(mz_values))
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        if offsets[-1]:
+            mz = np.concatenate([np.asarray(values, dtype=float) for values in mz_values])
+            intensity = np.concatenate([np.asarray(values, dtype=float) for values in intensities])
+        else:
+            mz = np.empty(0)
+            intensity = np.empty(0)
+
+        # Sort peaks within each spectrum without a Python loop
+        segments = np.repeat(np.arange(len(counts)), counts)
+        order = np.lexsort((mz, segments))
+        return cls(offsets, mz[order], intensity[order], metadata)
+
+    @classmethod
+    def from_spectra(cls, spectra, metadata=None):
+        """Pack a list of matchms Spectrum objects (their peaks are already m/z-sorted)."""
+        counts = np.fromiter((len(spectrum.peaks.mz) for spectrum in spectra), dtype=np.int64, count=len(spectra))
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        if offsets[-1]:
+            mz = np.concatenate([spectrum.peaks.mz for spectrum in spectra])
+            intensities = np.concatenate([spectrum.peaks.intensities for spectrum in spectra])
+        else:
+            mz = np.empty(0)
+            intensities = np.empty(0)
+        return cls(offsets, mz, intensities, metadata)
+
+    @classmethod
+    def concat(cls, parts):
+        """Concatenate PackedSpectra in order; metadata frames are concatenated with a new index."""
+        parts = list(parts)
+        if not parts:
+            return cls(np.zeros(1, dtype=np.int64), np.empty(0), np.empty(0))
+        counts = np.concatenate([part.counts for part in parts])
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        mz = np.concatenate([part.mz for part in parts])
+        intensities = np.concatenate([part.intensities for part in parts])
+        metadata = None
+        if all(part.metadata is not None for part in parts):
+            metadata = pd.concat([part.metadata for part in parts], ignore_index=True)
+        return cls(offsets, mz, intensities, metadata)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def counts(self):
+        """Number of peaks of every spectrum."""
+        return np.diff(self.offsets)
+
+    def peaks(self, i):
+        """Return views on the m/z and intensity arrays of spectrum i."""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.mz[start:end], self.intensities[start:end]
+
+    def segment_ids(self):
+        """Spectrum number of every packed peak."""
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    def gather(self, rows):
+        """
+        Return the positions of the peaks of the given spectra in the packed arrays,
+        concatenated in the order of rows, together with their new offsets.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.offsets[rows]
+        counts = self.offsets[rows + 1] - starts
+        new_offsets = np.concatenate(([0], np.cumsum(counts)))
+        positions = np.repeat(starts - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+        return positions, new_offsets
+
+    def take(self, rows):
+        """Return a new PackedSpectra holding only the given spectra, in that order."""
+        positions, offsets = self.gather(rows)
+        metadata = None
+        if self.metadata is not None:
+            metadata = self.metadata.iloc[np.asarray(rows, dtype=np.int64)].reset_index(drop=True)
+        return PackedSpectra(offsets, self.mz[positions], self.intensities[positions], metadata)
+
+    def to_spectrum(self, i):
+        """Return spectrum i as a matchms Spectrum, e.g. for plotting."""
+        from matchms import Spectrum
+
+        mz, intensities = self.peaks(i)
+        metadata = {}
+        if self.metadata is not None:
+            row = self.metadata.iloc[i]
+            metadata = {'compound_name': row.get('Name'), 'precursor_mz': row.get('MW')}
+        return Spectrum(mz=np.asarray(mz, dtype=float), intensities=np.asarray(intensities, dtype=float),
+                        metadata=metadata)
+
+
+def pack_spectra(spectra, metadata=None):
+    """Return spectra as PackedSpectra, packing matchms Spectrum lists once."""
+    if isinstance(spectra, PackedSpectra):
+        return spectra
+    if metadata is not None and not isinstance(metadata, pd.DataFrame):
+        metadata = pd.DataFrame(metadata)
+    return PackedSpectra.from_spectra(list(spectra), metadata)
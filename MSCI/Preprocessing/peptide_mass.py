@@ -0,0 +1,307 @@
+import numpy as np
+
+# Existing masses and modifications
+PARTICLE_MASSES = {"PROTON": 1.007276467, "ELECTRON": 0.00054858}
+
+ATOM_MASSES = {
+    "H": 1.007825035,
+    "C": 12.0,
+    "O": 15.9949146,
+    "N": 14.003074,
+}
+
+MASSES = {**PARTICLE_MASSES, **ATOM_MASSES}
+MASSES["N_TERMINUS"] = MASSES["H"]
+MASSES["C_TERMINUS"] = MASSES["O"] + MASSES["H"]
+
+AA_MASSES = {
+    "A": 71.037114,
+    "R": 156.101111,
+    "N": 114.042927,
+    "D": 115.026943,
+    "C": 103.009185,
+    "E": 129.042593,
+    "Q": 128.058578,
+    "G": 57.021464,
+    "H": 137.058912,
+    "I": 113.084064,
+    "L": 113.084064,
+    "K": 128.094963,
+    "M": 131.040485,
+    "F": 147.068414,
+    "P": 97.052764,
+    "S": 87.032028,
+    "T": 101.047679,
+    "U": 150.95363,
+    "W": 186.079313,
+    "Y": 163.063329,
+    "V": 99.068414,
+    "[]-": MASSES["N_TERMINUS"],
+    "-[]": MASSES["C_TERMINUS"],
+}
+
+MOD_MASSES = {
+    "[UNIMOD:737]": 229.162932,  # TMT_6
+    "[UNIMOD:2016]": 304.207146,  # TMT_PRO
+    "[UNIMOD:214]": 144.102063,  # iTRAQ4
+    "[UNIMOD:730]": 304.205360,  # iTRAQ8
+    "[UNIMOD:259]": 8.014199,  # SILAC Lysine
+    "[UNIMOD:267]": 10.008269,  # SILAC Arginine
+    "[]": 0.0,
+    "[UNIMOD:1]": 42.010565,  # Acetylation
+    "[UNIMOD:1896]": 158.003765,  # DSSO-crosslinker
+    "[UNIMOD:1881]": 54.010565,  # Alkene short fragment of DSSO-crosslinker
+    "[UNIMOD:1882]": 85.982635,  # Thiol long fragment of DSSO-crosslinker
+    "[UNIMOD:1884]": 196.084792,  # BuUrBu (DSBU)-crosslinker
+    "[UNIMOD:1885]": 111.032028,  # BuUr long fragment of BuUrBu (DSBU)-crosslinker
+    "[UNIMOD:1886]": 85.052764,  # Bu short fragment of BuUrBu (DSBU)-crosslinker
+    "[UNIMOD:1898]": 138.068080,  # DSS and BS3 non-cleavable crosslinker
+    "[UNIMOD:122]": 27.994915,  # Formylation
+    "[UNIMOD:1289]": 70.041865,  # Butyrylation
+    "[UNIMOD:1363]": 68.026215,  # Crotonylation
+    "[UNIMOD:1848]": 114.031694,  # Glutarylation
+    "[UNIMOD:1914]": -32.008456,  # Oxidation and then loss of oxidized M side chain
+    "[UNIMOD:2]": -0.984016,  # Amidation
+    "[UNIMOD:21]": 79.966331,  # Phosphorylation
+    "[UNIMOD:213]": 541.06111,  # ADP-ribosylation
+    "[UNIMOD:23]": -18.010565,  # Water Loss
+    "[UNIMOD:24]": 71.037114,  # Propionamidation
+    "[UNIMOD:354]": 44.985078,  # Nitrosylation
+    "[UNIMOD:28]": -17.026549,  # Glu to PyroGlu
+    "[UNIMOD:280]": 28.0313,  # Ethylation
+    "[UNIMOD:299]": 43.989829,  # Carboxylation
+    "[UNIMOD:3]": 226.077598,  # Biotinylation
+    "[UNIMOD:34]": 14.01565,  # Methylation
+    "[UNIMOD:345]": 47.984744,  # Trioxidation
+    "[UNIMOD:35]": 15.994915,  # Hydroxylation
+    "[UNIMOD:351]": 3.994915,  # Oxidation to Kynurenine
+    "[UNIMOD:36]": 28.0313,  # Dimethylation
+    "[UNIMOD:360]": -30.010565,  # Pyrrolidinone
+    "[UNIMOD:368]": -33.987721,  # Dehydroalanine
+    "[UNIMOD:37]": 42.04695,  # Trimethylation
+    "[UNIMOD:385]": -17.026549,  # Ammonia loss
+    "[UNIMOD:392]": 29.974179,  # Quinone
+    "[UNIMOD:4]": 57.021464,  # Carbamidomethyl
+    "[UNIMOD:40]": 79.956815,  # Sulfonation
+    "[UNIMOD:401]": -2.01565,  # Didehydro
+    "[UNIMOD:425]": 31.989829,  # Dioxidation
+    "[UNIMOD:43]": 203.079373,  # HexNAc
+    "[UNIMOD:44]": 204.187801,  # Farnesylation
+    "[UNIMOD:447]": -15.994915,  # Reduction
+    "[UNIMOD:46]": 229.014009,  # Pyridoxal phosphate
+    "[UNIMOD:47]": 238.229666,  # Palmitoylation
+    "[UNIMOD:5]": 43.005814,  # Carbamyl
+    "[UNIMOD:58]": 56.026215,  # Propionylation
+    "[UNIMOD:6]": 58.005479,  # Carboxymethylation
+    "[UNIMOD:64]": 100.016044,  # Succinylation
+    "[UNIMOD:7]": 0.984016,  # Deamidation
+    "[UNIMOD:747]": 86.000394,  # Malonylation
+}
+
+# These are only used for specific applications
+AA_MOD_MASSES = {
+    "K[UNIMOD:737]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:737]"],
+    "M[UNIMOD:35]": AA_MASSES["M"] + MOD_MASSES["[UNIMOD:35]"],
+    "C[UNIMOD:4]": AA_MASSES["C"] + MOD_MASSES["[UNIMOD:4]"],
+    "K[UNIMOD:2016]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:2016]"],
+    "K[UNIMOD:214]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:214]"],
+    "K[UNIMOD:730]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:730]"],
+    "S[UNIMOD:21]": AA_MASSES["S"] + MOD_MASSES["[UNIMOD:21]"],
+    "T[UNIMOD:21]": AA_MASSES["T"] + MOD_MASSES["[UNIMOD:21]"],
+    "Y[UNIMOD:21]": AA_MASSES["Y"] + MOD_MASSES["[UNIMOD:21]"],
+    "S[UNIMOD:23]": AA_MASSES["S"],  # + MOD_MASSES['[UNIMOD:23]'],
+    "T[UNIMOD:23]": AA_MASSES["T"],  # + MOD_MASSES['[UNIMOD:23]'],
+    "Y[UNIMOD:23]": AA_MASSES["Y"],  # + MOD_MASSES['[UNIMOD:23]'],
+    "K[UNIMOD:1896]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1896]"],
+    "K[UNIMOD:1881]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1881]"],
+    "K[UNIMOD:1882]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1882]"],
+    "K[UNIMOD:1884]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1884]"],
+    "K[UNIMOD:1885]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1885]"],
+    "K[UNIMOD:1886]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1886]"],
+    "K[UNIMOD:1898]": AA_MASSES["K"] + MOD_MASSES["[UNIMOD:1898]"],
+    "[UNIMOD:1]-": MASSES["N_TERMINUS"] + MOD_MASSES["[UNIMOD:1]"],
+    "K[UNIMOD:259]": AA_MASSES["K"],  # + MOD_MASSES['[UNIMOD:259]'],
+    # To make vecMZ work
+    "R[UNIMOD:267]": AA_MASSES["R"],  # + MOD_MASSES['[UNIMOD:267]']
+}
+
+AA_MOD = {**AA_MASSES, **AA_MOD_MASSES}
+
+# Proton mass used for precursor m/z throughout MSCI (see PeptideProcessor.format_msp)
+PROTON_MASS = PARTICLE_MASSES["PROTON"]
+
+# Mass of every single-character residue code (NaN for unknown characters)
+RESIDUE_MASS_TABLE = np.full(256, np.nan)
+for _residue, _mass in AA_MASSES.items():
+    if len(_residue) == 1:
+        RESIDUE_MASS_TABLE[ord(_residue)] = _mass
+
+
+def _modified_residue_mass(token):
+    """
+    Mass of a modified residue token such as 'M[UNIMOD:35]', or NaN if unknown.
+
+    Always residue plus modification mass: some AA_MOD_MASSES entries (SILAC, UNIMOD:23)
+    hold only the residue mass for fragment ion work and would drop the modification.
+    """
+    residue, modification = token[0], token[1:]
+    if residue in AA_MASSES and modification in MOD_MASSES:
+        return AA_MASSES[residue] + MOD_MASSES[modification]
+    return np.nan
+
+
+def _n_terminus_mass(token):
+    """Mass of the N-terminus carrying a modification token such as '[UNIMOD:1]-', or NaN if unknown."""
+    modification = token[:-1]
+    if modification in MOD_MASSES:
+        return MASSES["N_TERMINUS"] + MOD_MASSES[modification]
+    return np.nan
+
+
+class EncodedPeptides:
+    """
+    ProForma-style sequences ('PEPTM[UNIMOD:35]K', '[UNIMOD:1]-PEPTIDE') encoded once as integer residue codes.
+
+    The residues of sequence i are codes[offsets[i]:offsets[i + 1]]. Unmodified residues keep
+    their ASCII code; every distinct modified residue gets a code from 256 on, with its token in
+    vocabulary. token_masses maps each code to its residue mass (AA_MASSES + MOD_MASSES),
+    n_terminus holds the N-terminal mass of every sequence and valid flags the sequences
+    whose residues and modifications are all known.
+
+    Usage:
+    encoded = encode_peptides(['PEPTIDE', 'PEPTM[UNIMOD:35]K'])
+    masses = encoded.neutral_masses()
+    """
+
+    def __init__(self, offsets, codes, token_masses, vocabulary, n_terminus, valid):
+        self.offsets = offsets
+        self.codes = codes
+        self.token_masses = token_masses
+        self.vocabulary = vocabulary
+        self.n_terminus = n_terminus
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        """Number of residues of every sequence."""
+        return np.diff(self.offsets)
+
+    def segment_ids(self):
+        """Sequence number of every encoded residue."""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def residue_masses(self):
+        """Mass of every encoded residue, in sequence order."""
+        return self.token_masses[self.codes]
+
+    def neutral_masses(self):
+        """Monoisotopic neutral mass of every sequence; NaN where valid is False."""
+        sums = np.bincount(self.segment_ids(), weights=self.residue_masses(), minlength=len(self))
+        masses = self.n_terminus + sums + MASSES["C_TERMINUS"]
+        return np.where(self.valid, masses, np.nan)
+
+    def mz(self, charges=(2,)):
+        """Precursor m/z of every sequence (rows) at every charge (columns)."""
+        charges = np.asarray(charges, dtype=float)
+        return (self.neutral_masses()[:, None] + charges * PROTON_MASS) / charges
+
+
+def encode_peptides(sequences):
+    """
+    Encode a batch of sequences into an EncodedPeptides in a few vectorized passes.
+
+    Modification brackets are located on the raw bytes of all sequences at once; only
+    the distinct modification tokens are looked up in Python.
+    """
+    encoded = [sequence.encode('ascii', errors='replace') for sequence in sequences]
+    n_sequences = len(encoded)
+    byte_lengths = np.fromiter((len(sequence) for sequence in encoded), dtype=np.int64, count=n_sequences)
+    byte_offsets = np.concatenate(([0], np.cumsum(byte_lengths)))
+    raw = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    segments = np.repeat(np.arange(n_sequences), byte_lengths)
+
+    valid = byte_lengths > 0
+    n_terminus = np.full(n_sequences, MASSES["N_TERMINUS"])
+    codes = raw.astype(np.int64)
+    keep = np.ones(len(raw), dtype=bool)
+    vocabulary = []
+    token_masses = RESIDUE_MASS_TABLE.copy()
+
+    opens = np.flatnonzero(raw == ord('['))
+    closes = np.flatnonzero(raw == ord(']'))
+    if len(opens) or len(closes):
+        # Brackets must pair up in order, without nesting, within one sequence
+        if len(opens) != len(closes):
+            paired = min(len(opens), len(closes))
+            valid[segments[np.concatenate((opens[paired:], closes[paired:]))]] = False
+            opens, closes = opens[:paired], closes[:paired]
+        well_formed = (opens < closes) & (segments[opens] == segments[closes])
+        well_formed[:-1] &= closes[:-1] < opens[1:]
+        valid[segments[opens[~well_formed]]] = False
+        opens, closes = opens[well_formed], closes[well_formed]
+
+        depth = np.zeros(len(raw) + 1, dtype=np.int64)
+        np.add.at(depth, opens, 1)
+        np.add.at(depth, closes + 1, -1)
+        keep &= np.cumsum(depth[:-1]) == 0
+
+        text = raw.tobytes().decode('ascii')
+        at_start = opens == byte_offsets[segments[opens]]
+        after = np.minimum(closes + 1, len(raw) - 1)
+        n_terminal = at_start & (raw[after] == ord('-')) & (segments[after] == segments[opens])
+
+        # N-terminal modifications: '[UNIMOD:n]-' before the first residue
+        for position, close in zip(opens[n_terminal].tolist(), closes[n_terminal].tolist()):
+            sequence = segments[position]
+            n_terminus[sequence] = _n_terminus_mass(text[position:close + 2])
+            keep[close + 1] = False
+        # Any other bracket without a residue before it cannot be placed
+        valid[segments[opens[at_start & ~n_terminal]]] = False
+
+        # Modified residues get one code per distinct token
+        attached = ~at_start
+        residue_positions = opens[attached] - 1
+        # A bracket following another bracket or the N-terminal '-' has no residue of its own
+        valid[segments[residue_positions[~keep[residue_positions]]]] = False
+        tokens = [text[residue] + text[residue + 1:close + 1]
+                  for residue, close in zip(residue_positions.tolist(), closes[attached].tolist())]
+        vocabulary = sorted(set(tokens))
+        token_codes = {token: 256 + code for code, token in enumerate(vocabulary)}
+        codes[residue_positions] = [token_codes[token] for token in tokens]
+        token_masses = np.concatenate((token_masses, [_modified_residue_mass(token) for token in vocabulary]))
+
+    codes = codes[keep]
+    kept_segments = segments[keep]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(kept_segments, minlength=n_sequences))))
+
+    unknown = np.isnan(token_masses[codes])
+    valid[kept_segments[unknown]] = False
+    valid &= ~np.isnan(n_terminus) & (np.diff(offsets) > 0)
+    return EncodedPeptides(offsets, codes, token_masses, vocabulary, n_terminus, valid)
+
+
+def peptide_masses(sequences):
+    """
+    Neutral monoisotopic masses of a batch of sequences.
+
+    Returns (masses, valid): masses is NaN where a sequence holds an unknown residue or
+    modification, flagged False in valid.
+
+    Usage:
+    masses, valid = peptide_masses(peptides)
+    """
+    encoded = encode_peptides(sequences)
+    return encoded.neutral_masses(), encoded.valid
+
+
+def precursor_mzs(sequences, charges=(1, 2, 3, 4)):
+    """
+    Precursor m/z of a batch of sequences at several charges.
+
+    Returns (mz, valid): mz has one row per sequence and one column per charge.
+    """
+    encoded = encode_peptides(sequences)
+    return encoded.mz(charges), encoded.valid
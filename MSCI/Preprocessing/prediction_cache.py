@@ -0,0 +1,175 @@
+import sqlite3
+import threading
+
+import numpy as np
+
+# Eviction frees this fraction of max_entries at once, so a full table is counted again
+# only after that many new inserts instead of on every put
+EVICTION_SLACK = 0.1
+
+
+class PredictionCache:
+    """
+    Persistent SQLite store of Koina predictions.
+
+    Fragment predictions are keyed by (sequence, charge, collision_energy, model_intensity)
+    and iRT predictions by (sequence, model_irt). Once a table holds more than max_entries
+    rows, the least recently used ones are evicted, EVICTION_SLACK of max_entries beyond
+    the limit. hits and misses count the
+    peptides answered from and missing in the cache.
+
+    Usage:
+    cache = PredictionCache('predictions.sqlite', max_entries=5_000_000)
+    processor = PeptideProcessor(input_file, 30, 2, model_intensity, model_irt, cache=cache)
+    """
+
+    def __init__(self, path, max_entries=None):
+        self.path = str(path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._clock = 0
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS intensity ("
+                "sequence TEXT, charge INTEGER, collision_energy REAL, model TEXT, "
+                "mz BLOB, intensities BLOB, last_used INTEGER, "
+                "PRIMARY KEY (sequence, charge, collision_energy, model))"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS irt ("
+                "sequence TEXT, model TEXT, irt REAL, last_used INTEGER, "
+                "PRIMARY KEY (sequence, model))"
+            )
+            for table in ("intensity", "irt"):
+                self._connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_used ON {table} (last_used)")
+        row = self._connection.execute(
+            "SELECT MAX(m) FROM (SELECT MAX(last_used) AS m FROM intensity UNION ALL SELECT MAX(last_used) FROM irt)"
+        ).fetchone()
+        self._clock = row[0] or 0
+        # Upper bound of the rows of every table (INSERT OR REPLACE may overwrite), kept without counting
+        self._row_bounds = {
+            table: self._connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("intensity", "irt")
+        }
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def get_intensities(self, peptides, charges, collision_energy, model):
+        """Return a list with (mz_values, intensities) per peptide, or None where not cached."""
+        keys = [(peptide, int(charge), float(collision_energy), model) for peptide, charge in zip(peptides, charges)]
+        with self._lock:
+            found = {}
+            for key in set(keys):
+                row = self._connection.execute(
+                    "SELECT mz, intensities FROM intensity "
+                    "WHERE sequence = ? AND charge = ? AND collision_energy = ? AND model = ?", key
+                ).fetchone()
+                if row is not None:
+                    found[key] = (np.frombuffer(row[0], dtype=np.float64).tolist(),
+                                  np.frombuffer(row[1], dtype=np.float64).tolist())
+            stamp = self._tick()
+            with self._connection:
+                self._connection.executemany(
+                    "UPDATE intensity SET last_used = ? "
+                    "WHERE sequence = ? AND charge = ? AND collision_energy = ? AND model = ?",
+                    [(stamp, *key) for key in found]
+                )
+            results = [found.get(key) for key in keys]
+            self.hits += sum(result is not None for result in results)
+            self.misses += sum(result is None for result in results)
+        return results
+
+    def put_intensities(self, peptides, charges, collision_energy, model, mz_values, intensities):
+        with self._lock:
+            stamp = self._tick()
+            rows = [(peptide, int(charge), float(collision_energy), model,
+                     np.asarray(mz, dtype=np.float64).tobytes(), np.asarray(intensity, dtype=np.float64).tobytes(),
+                     stamp)
+                    for peptide, charge, mz, intensity in zip(peptides, charges, mz_values, intensities)]
+            with self._connection:
+                self._connection.executemany("INSERT OR REPLACE INTO intensity VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._evict("intensity", len(rows))
+
+    def get_irt(self, peptides, model):
+        """Return a list with the iRT per peptide, or None where not cached."""
+        with self._lock:
+            found = {}
+            for peptide in set(peptides):
+                row = self._connection.execute(
+                    "SELECT irt FROM irt WHERE sequence = ? AND model = ?", (peptide, model)
+                ).fetchone()
+                if row is not None:
+                    found[peptide] = row[0]
+            stamp = self._tick()
+            with self._connection:
+                self._connection.executemany(
+                    "UPDATE irt SET last_used = ? WHERE sequence = ? AND model = ?",
+                    [(stamp, peptide, model) for peptide in found]
+                )
+            results = [found.get(peptide) for peptide in peptides]
+            self.hits += sum(result is not None for result in results)
+            self.misses += sum(result is None for result in results)
+        return results
+
+    def put_irt(self, peptides, model, irt_values):
+        with self._lock:
+            stamp = self._tick()
+            rows = [(peptide, model, float(irt), stamp) for peptide, irt in zip(peptides, irt_values)]
+            with self._connection:
+                self._connection.executemany("INSERT OR REPLACE INTO irt VALUES (?, ?, ?, ?)", rows)
+            self._evict("irt", len(rows))
+
+    def _evict(self, table, inserted):
+        """Evict least recently used rows once the table may exceed max_entries; rows are counted only then."""
+        self._row_bounds[table] += inserted
+        if self.max_entries is None or self._row_bounds[table] <= self.max_entries:
+            return
+        count = self._connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        if count > self.max_entries:
+            keep = self.max_entries - int(self.max_entries * EVICTION_SLACK)
+            with self._connection:
+                self._connection.execute(
+                    f"DELETE FROM {table} WHERE rowid IN "
+                    f"(SELECT rowid FROM {table} ORDER BY last_used LIMIT ?)", (count - keep,)
+                )
+            count = keep
+        self._row_bounds[table] = count
+
+    def stats(self):
+        """Number of cached entries per table and the hit/miss counters of this session."""
+        with self._lock:
+            intensity = self._connection.execute("SELECT COUNT(*) FROM intensity").fetchone()[0]
+            irt = self._connection.execute("SELECT COUNT(*) FROM irt").fetchone()[0]
+        return {'intensity_entries': intensity, 'irt_entries': irt, 'hits': self.hits, 'misses': self.misses}
+
+    def warm(self, processor, peptides):
+        """
+        Predict every peptide with the processor's settings so later runs are served from the cache.
+
+        Batches go through processor.iter_predictions, so only max_workers batches are in
+        flight, and each result is dropped once it is stored. This cache is attached to the
+        processor while warming, whatever cache (if any) it was built with.
+        """
+        previous, processor.cache = processor.cache, self
+        try:
+            for _ in processor.iter_predictions(peptides):
+                pass
+        finally:
+            processor.cache = previous
+
+    def export(self, path):
+        """Write a consistent copy of the cache database to path."""
+        with self._lock:
+            target = sqlite3.connect(str(path))
+            try:
+                self._connection.backup(target)
+            finally:
+                target.close()
+
+    def close(self):
+        self._connection.close()
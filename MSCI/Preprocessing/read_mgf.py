@@ -0,0 +1,66 @@
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from pyteomics import mgf
+
+from MSCI.Preprocessing.packed_spectra import PackedSpectra
+
+MGF_COLUMNS = ['Name', 'MW', 'charge', 'RT']
+
+
+def _spectrum_row(spectrum, summary):
+    params = spectrum['params']
+    pepmass = params.get('pepmass', (None,))[0]
+    rt = params.get('rtinseconds')
+    if pepmass is None:
+        summary['missing_pepmass'] += 1
+    if rt is None:
+        summary['missing_rtinseconds'] += 1
+    charges = params.get('charge')
+    return {
+        'Name': params.get('title'),
+        'MW': np.nan if pepmass is None else float(pepmass),
+        'charge': int(charges[0]) if charges else 0,
+        'RT': np.nan if rt is None else float(rt),
+    }
+
+
+def _pack_batch(rows, mz_values, intensities):
+    return PackedSpectra.from_peak_lists(mz_values, intensities, pd.DataFrame(rows, columns=MGF_COLUMNS))
+
+
+def iter_mgf(filename, batch_size=10000, summary=None):
+    """
+    Stream an MGF file as PackedSpectra batches of up to batch_size spectra.
+
+    The metadata of each batch has Name (TITLE), MW (PEPMASS), charge and RT (RTINSECONDS);
+    missing values are NaN. Pass a collections.Counter as summary to collect the number of
+    spectra read and of spectra without rtinseconds or pepmass.
+
+    Usage:
+    summary = Counter()
+    for batch in iter_mgf('run.mgf', summary=summary):
+        mz, intensities = batch.peaks(0)
+    """
+    summary = Counter() if summary is None else summary
+    rows, mz_values, intensities = [], [], []
+    with mgf.read(filename, use_index=False, read_ions=False) as reader:
+        for spectrum in reader:
+            rows.append(_spectrum_row(spectrum, summary))
+            mz_values.append(spectrum['m/z array'])
+            intensities.append(spectrum['intensity array'])
+            summary['spectra'] += 1
+            if len(rows) == batch_size:
+                yield _pack_batch(rows, mz_values, intensities)
+                rows, mz_values, intensities = [], [], []
+    if rows:
+        yield _pack_batch(rows, mz_values, intensities)
+
+
+def read_mgf(filename, summary=None):
+    """Read an MGF file into a single PackedSpectra with metadata (see iter_mgf)."""
+    batches = list(iter_mgf(filename, summary=summary))
+    if not batches:
+        return _pack_batch([], [], [])
+    return PackedSpectra.concat(batches)
@@ -1,45 +1,144 @@
+import mmap
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 import pandas as pd
 
+from MSCI.Preprocessing.packed_spectra import PackedSpectra
+
+# Header fields of both MSP dialects we read and the column each one fills
+MSP_FIELDS = {
+    b'name': 'Name',
+    b'compound_name': 'Name',
+    b'mw': 'MW',
+    b'nominal_mass': 'MW',
+    b'irt': 'iRT',
+    b'collision_energy': 'collision_energy',
+}
+MSP_COLUMNS = ['Name', 'MW', 'iRT', 'collision_energy']
+
+# A blank line followed by the first line of the next record
+_RECORD_BREAK = re.compile(rb'\n[ \t\r]*\n(?=\S)')
+
+def _record_start(buffer, position):
+    """Position of the first record starting at or after position (records are separated by blank lines)."""
+    if position <= 0:
+        return 0
+    if position >= len(buffer):
+        return len(buffer)
+    # Step back over whitespace so a break ending exactly at position is found
+    start = position
+    while start > 0 and buffer[start - 1:start] in (b' ', b'\t', b'\r', b'\n'):
+        start -= 1
+    match = _RECORD_BREAK.search(buffer, start)
+    return len(buffer) if match is None else match.end()
+
+
+def _parse_msp_block(text):
+    """Parse the complete records of a block of MSP text into PackedSpectra."""
+    lines = text.split(b'\n')
+    rows = []
+    counts = []
+    peak_blocks = []
+    current = {}
+    i = 0
+    while i < len(lines):
+        key, separator, value = lines[i].partition(b':')
+        i += 1
+        if not separator:
+            continue
+        key = key.strip().lower()
+        if key == b'num peaks':
+            # The peak lines of the record are gathered and parsed together for the whole block
+            n_peaks = int(value)
+            peak_blocks.append(b'\n'.join(lines[i:i + n_peaks]))
+            counts.append(n_peaks)
+            rows.append(current)
+            current = {}
+            i += n_peaks
+        elif key in MSP_FIELDS:
+            column = MSP_FIELDS[key]
+            value = value.strip().decode('utf-8')
+            current[column] = value if column == 'Name' else float(value)
+
+    counts = np.asarray(counts, dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    blob = b'\n'.join(peak_blocks).decode('utf-8')
+    values = np.fromstring(blob, sep=' ') if blob.strip() else np.empty(0)
+    if len(values) != 2 * offsets[-1]:
+        # Peak lines with annotations: keep the first two fields of every line
+        values = np.array([line.split()[:2] for line in blob.splitlines() if line.strip()], dtype=float).ravel()
+    mz, intensities = values[0::2], values[1::2]
+
+    # Peaks are written sorted by m/z; sort anyway to be safe with other writers
+    segments = np.repeat(np.arange(len(counts)), counts)
+    order = np.lexsort((mz, segments))
+    metadata = pd.DataFrame(rows, columns=MSP_COLUMNS)
+    return PackedSpectra(offsets, mz[order], intensities[order], metadata)
+
+
+def iter_msp(filename, byte_range=None, block_size=1 << 24):
+    """
+    Stream an MSP file in a single pass, yielding PackedSpectra batches.
+
+    Every batch holds the peaks of the records of one block of about block_size bytes and
+    a metadata DataFrame with the Name, MW, iRT and collision_energy of each record. Both
+    dialects are read: Name/MW/iRT/Num peaks (PeptideProcessor) and
+    COMPOUND_NAME/NOMINAL_MASS/IRT/NUM PEAKS (matchms save_as_msp).
+
+    byte_range=(start, end) restricts parsing to the records that start within that range
+    of the file, so disjoint ranges (see msp_byte_ranges) can be parsed in parallel.
+
+    Usage:
+    for batch in iter_msp(filename):
+        mz, intensities = batch.peaks(0)
+    """
+    if os.path.getsize(filename) == 0:
+        return
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        start, end = (0, len(buffer)) if byte_range is None else byte_range
+        position = _record_start(buffer, start)
+        end = _record_start(buffer, end)
+        while position < end:
+            block_end = min(_record_start(buffer, position + block_size), end)
+            yield _parse_msp_block(buffer[position:block_end])
+            position = block_end
+
+
+def read_msp(filename, byte_range=None, block_size=1 << 24):
+    """Read an MSP file (or one byte range of it) into a single PackedSpectra with metadata."""
+    batches = list(iter_msp(filename, byte_range, block_size))
+    if not batches:
+        return PackedSpectra([0], np.empty(0), np.empty(0), pd.DataFrame(columns=MSP_COLUMNS))
+    return PackedSpectra.concat(batches)
+
+
+def msp_byte_ranges(filename, n_chunks):
+    """Split a file into n_chunks contiguous byte ranges of about equal size."""
+    bounds = np.linspace(0, os.path.getsize(filename), n_chunks + 1).astype(np.int64).tolist()
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_msp_parallel(filename, workers=None):
+    """Parse the byte ranges of a large MSP file in worker processes; same result as read_msp."""
+    workers = workers or os.cpu_count() or 1
+    ranges = msp_byte_ranges(filename, workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parts = list(executor.map(read_msp, [filename] * len(ranges), ranges))
+    return PackedSpectra.concat(parts)
+
+
 def read_msp_file(filename):
     """
-    This function is designed to parse and extract specific spectral data from either of two MSP formatted files. 
-    It processes the file line-by-line, capturing relevant fields such as the compound name, nominal mass, IRT, molecular weight (MW),
-    and collision energy. The function then standardizes the data into columns 'Name', 'MW', and 'iRT', which is returned as the final output.
+    This function is designed to parse and extract specific spectral data from either of two MSP formatted files.
+    It reads the file with the single-pass parser of read_msp, capturing relevant fields such as the compound name, nominal mass, IRT,
+    molecular weight (MW) and collision energy, and standardizes the data into columns 'Name', 'MW', and 'iRT', which is returned as the final output.
+    Use read_msp directly to get the peaks from the same pass.
 
     Usage:
     df = read_msp_file(filename)
     """
-    spectra = []
-    current_spectrum = {}
-    
-    with open(filename) as f:
-        for line in f:
-            line = line.strip()
-            # Detect format type based on the line content
-            if line.startswith('Name: '):
-                if current_spectrum:
-                    spectra.append(current_spectrum)
-                current_spectrum = {'Name': line.split('Name: ')[1]}
-            elif line.startswith('MW: '):
-                current_spectrum['MW'] = float(line.split('MW: ')[1])
-            elif line.startswith('iRT: '):
-                current_spectrum['iRT'] = float(line.split('iRT: ')[1])
-            elif line.startswith('COLLISION_ENERGY: '):
-                if current_spectrum:
-                    spectra.append(current_spectrum)
-                # Assuming COMPOUND_NAME comes after COLLISION_ENERGY in the file
-                current_spectrum = {}
-            elif line.startswith('IRT: '):
-                current_spectrum['iRT'] = float(line.split('IRT: ')[1])
-            elif line.startswith('COMPOUND_NAME: '):
-                current_spectrum['Name'] = line.split('COMPOUND_NAME: ')[1] if 'COMPOUND_NAME: ' in line else None
-            elif line.startswith('NOMINAL_MASS: '):
-                current_spectrum['MW'] = float(line.split('NOMINAL_MASS: ')[1]) if 'NOMINAL_MASS: ' in line else None
-
-    if current_spectrum:
-        spectra.append(current_spectrum)
-
-    # Standardize the DataFrame columns to 'Name', 'MW', and 'iRT'
-    index_df = pd.DataFrame(spectra, columns=['Name', 'MW', 'iRT'])
-    
+    index_df = read_msp(filename).metadata[['Name', 'MW', 'iRT']]
     return index_df
@@ -1,4 +1,14 @@
-from pyopenms import MzMLFile, MSExperiment
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pyopenms import MzMLFile, MSExperiment, OnDiscMSExperiment, PeakFileOptions
+
+from MSCI.Preprocessing.packed_spectra import PackedSpectra
+
+MZML_COLUMNS = ['scan', 'native_id', 'ms_level', 'MW', 'charge', 'RT']
+
 
 def process_spectrum(spectrum, msp_file):
     precursors = spectrum.getPrecursors()
@@ -10,28 +20,134 @@ def process_spectrum(spectrum, msp_file):
         msp_file.write(f"Name: Spectrum\nMW: {mw}\nRT: {RT}\n")
         msp_file.write(f"Num peaks: {spectrum.size()}\n")
 
-        for peak in spectrum:
-            m_z = peak.getMZ()
-            intensity = peak.getIntensity()
+        # Peaks come out of pyopenms as two arrays; MSP peak lines carry no annotation
+        mz_values, intensities = spectrum.get_peaks()
+        msp_file.writelines(
+            f"{m_z}\t{intensity}\t\"No Annotation\"\n" for m_z, intensity in zip(mz_values.tolist(), intensities.tolist())
+        )
 
-            try:
-                annotation = peak.getMetaValue("annotation").decode("utf-8")
-            except Exception as e:
-                annotation = "No Annotation"
+        msp_file.write("\n")
 
-            msp_file.write(f"{m_z}\t{intensity}\t\"{annotation}\"\n")
 
-        msp_file.write("\n")
+def _spectrum_row(scan, spectrum):
+    precursors = spectrum.getPrecursors()
+    return {
+        'scan': scan,
+        'native_id': spectrum.getNativeID(),
+        'ms_level': spectrum.getMSLevel(),
+        'MW': precursors[0].getMZ() if precursors else np.nan,
+        'charge': precursors[0].getCharge() if precursors else 0,
+        'RT': spectrum.getRT(),
+    }
+
+
+def _pack_batch(rows, peak_arrays):
+    metadata = pd.DataFrame(rows, columns=MZML_COLUMNS)
+    return PackedSpectra.from_peak_lists([mz for mz, _ in peak_arrays], [intensity for _, intensity in peak_arrays],
+                                         metadata)
+
+
+def _iter_loaded_spectra(filename, ms_level):
+    """Load the run with only the requested MS level, for mzML files without an index."""
+    experiment = MSExperiment()
+    mzml_file = MzMLFile()
+    scans = None
+    if ms_level is not None:
+        # A metadata-only pass gives the spectrum numbers of the requested level in the file
+        options = PeakFileOptions()
+        options.setFillData(False)
+        mzml_file.setOptions(options)
+        mzml_file.load(filename, experiment)
+        scans = [scan for scan, spectrum in enumerate(experiment) if spectrum.getMSLevel() == ms_level]
+
+        experiment = MSExperiment()
+        options = PeakFileOptions()
+        options.setMSLevels([ms_level])
+        mzml_file.setOptions(options)
+    mzml_file.load(filename, experiment)
+    for position in range(experiment.getNrSpectra()):
+        yield (position if scans is None else scans[position]), experiment.getSpectrum(position)
+
+
+def _iter_indexed_spectra(experiment, ms_level, spectrum_range):
+    """Read the requested spectra one by one from an indexed mzML file."""
+    # Spectrum metadata is read without peaks, so the MS level filter costs no peak I/O
+    metadata = experiment.getMetaData()
+    start, stop = spectrum_range or (0, experiment.getNrSpectra())
+    for scan in range(start, min(stop, experiment.getNrSpectra())):
+        if ms_level is None or metadata.getSpectrum(scan).getMSLevel() == ms_level:
+            yield scan, experiment.getSpectrum(scan)
+
+
+def iter_mzml(filename, ms_level=2, batch_size=10000, spectrum_range=None):
+    """
+    Stream the spectra of an mzML file as PackedSpectra batches of up to batch_size spectra.
+
+    Indexed mzML files are read through OnDiscMSExperiment, one spectrum at a time, so a
+    run of several GB is never held in memory; other files are loaded with only the
+    requested MS level. Peaks are taken in bulk with get_peaks(). ms_level=None keeps every
+    spectrum. The metadata of each batch has scan (spectrum number in the file), native_id,
+    ms_level, MW (precursor m/z), charge and RT.
+
+    spectrum_range=(start, stop) restricts an indexed file to those spectrum numbers, so
+    disjoint ranges can be read in parallel (see read_mzml_parallel).
+
+    Usage:
+    for batch in iter_mzml('run.mzML'):
+        mz, intensities = batch.peaks(0)
+    """
+    experiment = OnDiscMSExperiment()
+    if experiment.openFile(str(filename)):
+        spectra = _iter_indexed_spectra(experiment, ms_level, spectrum_range)
+    elif spectrum_range is None:
+        spectra = _iter_loaded_spectra(str(filename), ms_level)
+    else:
+        raise ValueError(f"spectrum_range needs an indexed mzML file: {filename}")
+
+    rows, peak_arrays = [], []
+    for scan, spectrum in spectra:
+        rows.append(_spectrum_row(scan, spectrum))
+        peak_arrays.append(spectrum.get_peaks())
+        if len(rows) == batch_size:
+            yield _pack_batch(rows, peak_arrays)
+            rows, peak_arrays = [], []
+    if rows:
+        yield _pack_batch(rows, peak_arrays)
+
+
+def read_mzml(filename, ms_level=2, spectrum_range=None):
+    """Read the spectra of an mzML file (MS2 by default) into a single PackedSpectra with metadata."""
+    batches = list(iter_mzml(filename, ms_level, spectrum_range=spectrum_range))
+    if not batches:
+        return _pack_batch([], [])
+    return PackedSpectra.concat(batches)
+
+
+def read_mzml_parallel(filename, ms_level=2, workers=None):
+    """Read contiguous spectrum ranges of an indexed mzML file in worker processes; same result as read_mzml."""
+    experiment = OnDiscMSExperiment()
+    if not experiment.openFile(str(filename)):
+        return read_mzml(filename, ms_level)
+    workers = workers or os.cpu_count() or 1
+    bounds = np.linspace(0, experiment.getNrSpectra(), workers + 1).astype(np.int64).tolist()
+    ranges = list(zip(bounds[:-1], bounds[1:]))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parts = list(executor.map(read_mzml, [filename] * len(ranges), [ms_level] * len(ranges), ranges))
+    return PackedSpectra.concat(parts)
 
 def main():
     mzml_file_path = 'Z:/zelhamraoui/umpire-zahra/2022MQ050_ZAEL_008_01_PoolProteome_1ug_DIA_OT_CE30_Q1.mzML'
     msp_file_path = 'Z:/zelhamraoui/umpire-zahra/umpire_30CE_data_Q1.msp'
 
-    exp = MSExperiment()
-    MzMLFile().load(mzml_file_path, exp)
+    # Stream the run instead of loading it whole; every spectrum with a precursor is written
+    experiment = OnDiscMSExperiment()
+    if experiment.openFile(mzml_file_path):
+        spectra = (experiment.getSpectrum(scan) for scan in range(experiment.getNrSpectra()))
+    else:
+        spectra = (spectrum for _, spectrum in _iter_loaded_spectra(mzml_file_path, None))
 
     with open(msp_file_path, 'w') as msp_file:
-        for spectrum in exp:
+        for spectrum in spectra:
             process_spectrum(spectrum, msp_file)
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from MSCI.Preprocessing.packed_spectra import PackedSpectra
+
+LIBRARY_FORMAT = "msci-spectral-library"
+LIBRARY_VERSION = 1
+
+# File name and dtype of every array of the library directory
+LIBRARY_ARRAYS = {
+    'offsets': np.int64,
+    'mz': np.float32,
+    'intensities': np.float32,
+    'sequence_offsets': np.int64,
+    'sequence': np.uint8,
+    'charge': np.int32,
+    'collision_energy': np.float32,
+    'precursor_mz': np.float64,
+    'irt': np.float32,
+}
+
+
+class SpectralLibraryWriter:
+    """
+    Write a columnar binary spectral library incrementally.
+
+    A library is a directory of raw little-endian arrays plus a library.json manifest:
+    CSR-packed float32 peaks (offsets, mz, intensities) and one metadata value per
+    spectrum (sequence, charge, collision_energy, precursor_mz, irt). Sequences are
+    stored as one UTF-8 blob with offsets. Every array can be memory-mapped as is.
+
+    Usage:
+    with SpectralLibraryWriter('library.msl') as writer:
+        writer.write(packed)
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._files = {name: open(self.path / f"{name}.bin", 'wb') for name in LIBRARY_ARRAYS}
+        self.n_spectra = 0
+        self.n_peaks = 0
+        self.n_sequence_bytes = 0
+        # The offset arrays start with a leading 0
+        self._write('offsets', [0])
+        self._write('sequence_offsets', [0])
+
+    def _write(self, name, values):
+        self._files[name].write(np.ascontiguousarray(values, dtype=np.dtype(LIBRARY_ARRAYS[name]).newbyteorder('<')).tobytes())
+
+    def write(self, packed):
+        """
+        Append PackedSpectra whose metadata has sequence, charge, collision_energy,
+        MW (precursor m/z) and iRT columns.
+        """
+        metadata = packed.metadata
+        self._write('offsets', packed.offsets[1:] + self.n_peaks)
+        self._write('mz', packed.mz)
+        self._write('intensities', packed.intensities)
+
+        encoded = [sequence.encode('utf-8') for sequence in metadata['sequence']]
+        lengths = np.fromiter((len(sequence) for sequence in encoded), dtype=np.int64, count=len(encoded))
+        self._write('sequence_offsets', np.cumsum(lengths) + self.n_sequence_bytes)
+        self._files['sequence'].write(b''.join(encoded))
+
+        self._write('charge', metadata['charge'].to_numpy())
+        self._write('collision_energy', metadata['collision_energy'].to_numpy())
+        self._write('precursor_mz', metadata['MW'].to_numpy())
+        self._write('irt', metadata['iRT'].to_numpy())
+
+        self.n_spectra += len(packed)
+        self.n_peaks += int(packed.offsets[-1])
+        self.n_sequence_bytes += int(lengths.sum())
+
+    def close(self):
+        for file in self._files.values():
+            file.close()
+        manifest = {
+            'format': LIBRARY_FORMAT,
+            'version': LIBRARY_VERSION,
+            'n_spectra': self.n_spectra,
+            'n_peaks': self.n_peaks,
+            'n_sequence_bytes': self.n_sequence_bytes,
+            'arrays': {name: np.dtype(dtype).newbyteorder('<').str for name, dtype in LIBRARY_ARRAYS.items()},
+        }
+        with open(self.path / 'library.json', 'w') as file:
+            json.dump(manifest, file, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_library(path, packed):
+    """Write PackedSpectra (see SpectralLibraryWriter.write for the metadata) as a binary library."""
+    with SpectralLibraryWriter(path) as writer:
+        writer.write(packed)
+
+
+def _map_array(path, dtype, count):
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+
+def load_library(path):
+    """
+    Load a binary spectral library as PackedSpectra.
+
+    Peak arrays are memory-mapped (no copy, no parsing); metadata has the Name ('SEQ/charge'),
+    MW, iRT columns used by the grouping and similarity code plus sequence, charge and
+    collision_energy.
+
+    Usage:
+    packed = load_library('library.msl')
+    Groups_df = process_peptide_combinations(packed.metadata, 10, 5)
+    """
+    path = Path(path)
+    with open(path / 'library.json') as file:
+        manifest = json.load(file)
+    if manifest.get('format') != LIBRARY_FORMAT:
+        raise ValueError(f"Not an MSCI spectral library: {path}")
+
+    counts = {
+        'offsets': manifest['n_spectra'] + 1,
+        'mz': manifest['n_peaks'],
+        'intensities': manifest['n_peaks'],
+        'sequence_offsets': manifest['n_spectra'] + 1,
+        'sequence': manifest['n_sequence_bytes'],
+    }
+    arrays = {
+        name: _map_array(path / f"{name}.bin", np.dtype(dtype), counts.get(name, manifest['n_spectra']))
+        for name, dtype in manifest['arrays'].items()
+    }
+
+    blob = arrays['sequence'].tobytes()
+    bounds = arrays['sequence_offsets'].tolist()
+    sequences = [blob[start:end].decode('utf-8') for start, end in zip(bounds[:-1], bounds[1:])]
+    charges = np.asarray(arrays['charge'])
+    metadata = pd.DataFrame({
+        'Name': pd.Series(sequences, dtype=object) + '/' + pd.Series(charges).astype(str),
+        'MW': np.asarray(arrays['precursor_mz']),
+        'iRT': np.asarray(arrays['irt'], dtype=float),
+        'sequence': sequences,
+        'charge': charges,
+        'collision_energy': np.asarray(arrays['collision_energy'], dtype=float),
+    })
+    return PackedSpectra(arrays['offsets'], arrays['mz'], arrays['intensities'], metadata)
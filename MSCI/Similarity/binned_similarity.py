@@ -0,0 +1,76 @@
+import numpy as np
+from scipy import sparse
+
+from MSCI.Similarity.parallel_scoring import score_spectra_pairs_parallel
+from MSCI.Similarity.spectral_angle_similarity import _packed_rows, _pair_metadata, _weightxy
+
+
+def binned_vectors(packed, bin_width=0.05, m=0, n=0.5):
+    """
+    Sparse binned intensity vectors of packed spectra, one L2-normalized CSR row per spectrum.
+
+    Every peak adds its weight mz**m * intensity**n (as in ndotproduct) to the m/z bin
+    floor(mz / bin_width); the peak arrays of PackedSpectra are already in CSR layout,
+    so the offsets are used as the row pointers. Spectra without peaks are all-zero rows.
+    """
+    bins = np.floor(np.asarray(packed.mz, dtype=np.float64) / bin_width).astype(np.int64)
+    weights = _weightxy(np.asarray(packed.mz, dtype=np.float64), np.asarray(packed.intensities, dtype=np.float64),
+                        m, n)
+    n_bins = int(bins.max()) + 1 if len(bins) else 1
+    vectors = sparse.csr_matrix((weights, bins, np.asarray(packed.offsets, dtype=np.int64)),
+                                shape=(len(packed), n_bins))
+    vectors.sum_duplicates()
+
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+    with np.errstate(divide='ignore'):
+        scale = np.where(norms > 0, 1 / norms, 0.0)
+    return sparse.diags(scale).dot(vectors).tocsr()
+
+
+def binned_scores(vectors, rows, chunk_size=200000):
+    """
+    Approximate nspectraangle of every (i, j) row of rows from binned_vectors.
+
+    The cosine of the binned vectors stands in for the matched-peak cosine; it is put on
+    the scale of nspectraangle (1 - 2 arccos(cos**2) / pi) so it can be compared with the
+    exact scores. Pairs with an empty spectrum score NaN, like the exact scorer.
+    """
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1, 2)
+    empty = np.diff(vectors.indptr) == 0
+    cosines = np.empty(len(rows))
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        products = vectors[chunk[:, 0]].multiply(vectors[chunk[:, 1]])
+        cosines[start:start + chunk_size] = np.asarray(products.sum(axis=1)).ravel()
+    scores = 1 - 2 * np.arccos(np.clip(cosines, 0, 1) ** 2) / np.pi
+    return np.where(empty[rows[:, 0]] | empty[rows[:, 1]], np.nan, scores)
+
+
+def score_spectra_pairs_binned(index_array, spectra, mz_irt_df=None, threshold=0.5, bin_width=0.05,
+                               tolerance=0, ppm=0, m=0, n=0.5, workers=None, chunk_size=20000, progress=None,
+                               metrics=None):
+    """
+    Two-stage scoring: a binned sparse prefilter, then exact peak matching for the pairs that pass.
+
+    All candidate pairs are scored with row-wise sparse dot products of binned_vectors;
+    only the pairs whose binned score reaches threshold are matched and scored exactly
+    with score_spectra_pairs_parallel (tolerance, ppm, m, n, workers and metrics as
+    there). Binning can split matching peaks over two bins, so bin_width should be
+    at least twice the fragment tolerance and threshold a margin below the score of
+    interest. Returns the rows of score_spectra_pairs_parallel for the retained pairs,
+    in input order, with their binned_score before the exact score column(s).
+
+    Usage:
+    index_array = Groups_df[['index1', 'index2']].values.astype(int)
+    result = score_spectra_pairs_binned(index_array, packed, threshold=0.6, bin_width=0.05, tolerance=0.02)
+    """
+    index_array = np.asarray(index_array, dtype=np.int64).reshape(-1, 2)
+    mz_irt_df = _pair_metadata(spectra, mz_irt_df)
+    packed, rows = _packed_rows(index_array, spectra)
+
+    approximate = binned_scores(binned_vectors(packed, bin_width, m, n), rows)
+    keep = approximate >= threshold
+    result = score_spectra_pairs_parallel(index_array[keep], spectra, mz_irt_df, tolerance, ppm, m, n,
+                                          workers=workers, chunk_size=chunk_size, progress=progress, metrics=metrics)
+    result.insert(result.columns.get_loc('iRT 2') + 1, 'binned_score', approximate[keep])
+    return result
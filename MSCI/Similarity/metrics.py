@@ -0,0 +1,167 @@
+import numpy as np
+import pandas as pd
+
+from MSCI.Similarity.spectral_angle_similarity import (
+    _match_chunk, _normalized_dot_products, _packed_rows, _pair_metadata, _pairs_frame, _spectral_angles
+)
+
+# Similarity metrics by name; every metric maps a MatchedPairs to one score per pair
+METRICS = {}
+
+
+def register_metric(name):
+    """
+    Register a similarity metric under name.
+
+    A metric is called as metric(matched, **params) with the MatchedPairs of a chunk
+    of pairs (one matching pass shared by all metrics) and returns an array with one
+    score per pair.
+
+    Usage:
+    @register_metric('shared_intensity')
+    def shared_intensity(matched):
+        ...
+    """
+    def decorator(function):
+        METRICS[name] = function
+        return function
+    return decorator
+
+
+def _matched_intensities(matched):
+    """Pair of every matched peak and the intensities of both of its peaks."""
+    has_match = matched.y_index >= 0
+    return (matched.x_segments[has_match], matched.x_intensities[has_match],
+            matched.y_intensities[matched.y_index[has_match]])
+
+
+def _segmented_pearson(segments, x, y, n_pairs):
+    """Pearson correlation of x and y within every segment; NaN below two points or without variance."""
+    count = np.bincount(segments, minlength=n_pairs)
+    sx = np.bincount(segments, weights=x, minlength=n_pairs)
+    sy = np.bincount(segments, weights=y, minlength=n_pairs)
+    sxx = np.bincount(segments, weights=x * x, minlength=n_pairs)
+    syy = np.bincount(segments, weights=y * y, minlength=n_pairs)
+    sxy = np.bincount(segments, weights=x * y, minlength=n_pairs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (count * sxy - sx * sy) / np.sqrt((count * sxx - sx**2) * (count * syy - sy**2))
+    return np.where(count >= 2, np.clip(r, -1, 1), np.nan)
+
+
+def _entropy_terms(p):
+    """-p ln p, with 0 for p == 0."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(p > 0, -p * np.log(p), 0.0)
+
+
+@register_metric('spectral_angle')
+def spectral_angle(matched, m=0, n=0.5):
+    """Normalized spectral contrast angle (nspectraangle)."""
+    return _spectral_angles(matched, m, n)
+
+
+@register_metric('dot_product')
+def dot_product(matched, m=0, n=0.5):
+    """Normalized dot product of the m/z**m * intensity**n weighted peaks (ndotproduct)."""
+    return _normalized_dot_products(matched, m, n)
+
+
+@register_metric('entropy')
+def entropy_similarity(matched):
+    """
+    Unweighted spectral entropy similarity (Li et al., Nat. Methods 2021).
+
+    1 - (2 S(AB) - S(A) - S(B)) / ln 4 with intensities scaled to sum 1 per spectrum and
+    AB the merged spectrum; 1 for identical spectra, 0 without shared peaks.
+    """
+    n_pairs = matched.n_pairs
+    x_total = np.bincount(matched.x_segments, weights=matched.x_intensities, minlength=n_pairs)
+    y_total = np.bincount(matched.y_segments, weights=matched.y_intensities, minlength=n_pairs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        px = matched.x_intensities / x_total[matched.x_segments]
+        py = matched.y_intensities / y_total[matched.y_segments]
+
+    # Unmatched peaks add p ln 2 each; matched peaks 2 f((a + b) / 2) - f(a) - f(b)
+    has_match = matched.y_index >= 0
+    a, b = px[has_match], py[matched.y_index[has_match]]
+    shared = 2 * _entropy_terms((a + b) / 2) - _entropy_terms(a) - _entropy_terms(b)
+    y_unmatched = np.ones(len(py), dtype=bool)
+    y_unmatched[matched.y_index[has_match]] = False
+    divergence = (np.bincount(matched.x_segments[has_match], weights=shared, minlength=n_pairs)
+                  + np.log(2) * np.bincount(matched.x_segments[~has_match], weights=px[~has_match], minlength=n_pairs)
+                  + np.log(2) * np.bincount(matched.y_segments[y_unmatched], weights=py[y_unmatched], minlength=n_pairs))
+    similarity = 1 - divergence / np.log(4)
+    return np.where((x_total > 0) & (y_total > 0), similarity, np.nan)
+
+
+@register_metric('pearson')
+def pearson(matched):
+    """Pearson correlation of the intensities of the matched peaks."""
+    segments, x, y = _matched_intensities(matched)
+    return _segmented_pearson(segments, x, y, matched.n_pairs)
+
+
+@register_metric('spearman')
+def spearman(matched):
+    """Spearman correlation of the intensities of the matched peaks (average ranks for ties)."""
+    segments, x, y = _matched_intensities(matched)
+    x_rank = pd.Series(x).groupby(segments).rank(method='average').to_numpy()
+    y_rank = pd.Series(y).groupby(segments).rank(method='average').to_numpy()
+    return _segmented_pearson(segments, x_rank, y_rank, matched.n_pairs)
+
+
+@register_metric('matched_peaks')
+def matched_peaks(matched):
+    """Number of matched fragment peaks."""
+    return np.bincount(matched.x_segments[matched.y_index >= 0], minlength=matched.n_pairs)
+
+
+def resolve_metrics(metrics):
+    """
+    {column: (metric, params)} from metric names or a {name: params} dict.
+
+    Usage:
+    resolve_metrics(['spectral_angle', 'entropy'])
+    resolve_metrics({'dot_product': {'m': 1, 'n': 0.5}, 'matched_peaks': {}})
+    """
+    if isinstance(metrics, str):
+        metrics = [metrics]
+    if not isinstance(metrics, dict):
+        metrics = {name: {} for name in metrics}
+    unknown = [name for name in metrics if name not in METRICS]
+    if unknown:
+        raise ValueError(f"Unknown metric(s) {', '.join(unknown)} (choose from {', '.join(METRICS)})")
+    return {name: (METRICS[name], dict(params or {})) for name, params in metrics.items()}
+
+
+def score_metrics_chunk(packed, rows, metrics, tolerance=0, ppm=0):
+    """Every metric of resolve_metrics for the pairs of rows, from one matching pass."""
+    matched = _match_chunk(packed, rows, tolerance, ppm)
+    return {name: metric(matched, **params) for name, (metric, params) in metrics.items()}
+
+
+def score_pairs_metrics(index_array, spectra, mz_irt_df=None, metrics=('spectral_angle',), tolerance=0, ppm=0,
+                        chunk_size=20000, progress=None):
+    """
+    Score candidate pairs with several metrics at once.
+
+    The peaks of every chunk of pairs are matched once and every metric is computed on
+    the same matched arrays. Returns the columns of score_spectra_pairs with one score
+    column per metric instead of similarity_score.
+
+    Usage:
+    result = score_pairs_metrics(index_array, packed, metrics=['spectral_angle', 'entropy', 'matched_peaks'],
+                                 tolerance=0.02)
+    """
+    metrics = resolve_metrics(metrics)
+    index_array = np.asarray(index_array, dtype=np.int64).reshape(-1, 2)
+    mz_irt_df = _pair_metadata(spectra, mz_irt_df)
+    packed, rows = _packed_rows(index_array, spectra)
+
+    parts = []
+    for start in range(0, len(rows), chunk_size):
+        parts.append(score_metrics_chunk(packed, rows[start:start + chunk_size], metrics, tolerance, ppm))
+        if progress is not None:
+            progress(min(start + chunk_size, len(rows)), len(rows))
+    scores = {name: np.concatenate([part[name] for part in parts]) if parts else np.empty(0) for name in metrics}
+    return _pairs_frame(index_array, mz_irt_df, scores)
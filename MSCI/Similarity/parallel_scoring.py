@@ -0,0 +1,126 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from MSCI.Preprocessing.packed_spectra import PackedSpectra
+from MSCI.Similarity.metrics import resolve_metrics, score_metrics_chunk, score_pairs_metrics
+from MSCI.Similarity.spectral_angle_similarity import (
+    _packed_rows, _pair_metadata, _pairs_frame, _spectral_angle_chunk, score_spectra_pairs
+)
+
+# Set in every worker process by _attach_packed_spectra
+_WORKER_PACKED = None
+_WORKER_BLOCKS = []
+
+
+def _share_array(array):
+    """Copy an array into a new shared memory block and return the block and its descriptor."""
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    shared[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _open_shared_block(name):
+    try:
+        # Python >= 3.13: the parent owns the block, do not track it again in the worker
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Older versions register it with the resource tracker shared with the parent,
+        # which is a no-op for a name the parent already registered
+        return shared_memory.SharedMemory(name=name)
+
+
+def _attach_packed_spectra(descriptors):
+    """Worker initializer: map the parent's packed spectra without copying them."""
+    global _WORKER_PACKED
+    arrays = []
+    for name, shape, dtype in descriptors:
+        block = _open_shared_block(name)
+        _WORKER_BLOCKS.append(block)
+        arrays.append(np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf))
+    offsets, mz, intensities = arrays
+    _WORKER_PACKED = PackedSpectra(offsets, mz, intensities)
+
+
+def _score_chunk(task):
+    rows, tolerance, ppm, m, n, metrics = task
+    if metrics is not None:
+        return score_metrics_chunk(_WORKER_PACKED, rows, resolve_metrics(metrics), tolerance, ppm)
+    return _spectral_angle_chunk(_WORKER_PACKED, rows, tolerance, ppm, m, n)
+
+
+def balanced_chunks(rows, counts, n_chunks):
+    """
+    Split pair rows into contiguous chunks carrying roughly the same number of peaks.
+
+    Returns the list of (start, end) row ranges; the cost of a pair is the total
+    number of peaks of its two spectra.
+    """
+    if len(rows) == 0:
+        return []
+    cost = np.cumsum(counts[rows[:, 0]] + counts[rows[:, 1]] + 1)
+    targets = cost[-1] * np.arange(1, n_chunks) / n_chunks
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(cost, targets, side='right'), [len(rows)])))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def score_spectra_pairs_parallel(index_array, spectra, mz_irt_df=None, tolerance=0, ppm=0, m=0, n=0.5,
+                                 workers=None, chunk_size=20000, progress=None, metrics=None):
+    """
+    Score candidate pairs with a pool of worker processes.
+
+    The packed spectra are placed once in multiprocessing shared memory and mapped
+    by every worker, so only the pair indices of each chunk are sent to the workers.
+    Pairs are cut into peak-balanced chunks of about chunk_size pairs (at least a
+    few per worker) and the scores are merged back in the input order. Returns the
+    same DataFrame as score_spectra_pairs; progress is called as progress(done, total)
+    in pairs as chunks complete. With metrics (names or {name: params}, see
+    MSCI.Similarity.metrics) every chunk is scored with all of them in one matching
+    pass and the frame has one column per metric instead of similarity_score.
+
+    Usage:
+    result = score_spectra_pairs_parallel(index_array, spectra, mz_irt_df, ppm=10, workers=32)
+    """
+    index_array = np.asarray(index_array, dtype=np.int64).reshape(-1, 2)
+    workers = workers or os.cpu_count() or 1
+    mz_irt_df = _pair_metadata(spectra, mz_irt_df)
+    if metrics is not None:
+        resolve_metrics(metrics)
+    if workers == 1 or len(index_array) <= chunk_size:
+        if metrics is not None:
+            return score_pairs_metrics(index_array, spectra, mz_irt_df, metrics, tolerance, ppm, chunk_size, progress)
+        return score_spectra_pairs(index_array, spectra, mz_irt_df, tolerance, ppm, m, n, chunk_size, progress)
+
+    packed, rows = _packed_rows(index_array, spectra)
+    n_chunks = max(workers * 4, -(-len(rows) // chunk_size))
+    chunks = balanced_chunks(rows, packed.counts, n_chunks)
+
+    blocks = []
+    try:
+        descriptors = []
+        for array in (packed.offsets, packed.mz, packed.intensities):
+            block, descriptor = _share_array(np.ascontiguousarray(array))
+            blocks.append(block)
+            descriptors.append(descriptor)
+
+        tasks = ((rows[start:end], tolerance, ppm, m, n, metrics) for start, end in chunks)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach_packed_spectra,
+                                 initargs=(descriptors,)) as executor:
+            scores = []
+            for (start, end), chunk_scores in zip(chunks, executor.map(_score_chunk, tasks)):
+                scores.append(chunk_scores)
+                if progress is not None:
+                    progress(end, len(rows))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    if metrics is not None:
+        scores = {name: np.concatenate([part[name] for part in scores]) for name in resolve_metrics(metrics)}
+    else:
+        scores = np.concatenate(scores) if scores else np.empty(0)
+    return _pairs_frame(index_array, mz_irt_df, scores)
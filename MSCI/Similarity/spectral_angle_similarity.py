@@ -1,14 +1,20 @@
 import numpy as np
 import pandas as pd 
 import numpy as np 
+from collections import namedtuple
+
 from matchms.similarity import CosineGreedy
+from MSCI.Preprocessing.packed_spectra import PackedSpectra
 
 def ndotproduct(x, y, m=0, n=0.5, na_rm=True):
-    wx = _weightxy(x.iloc[:,0], x.iloc[:,1], m, n)
-    wy = _weightxy(y.iloc[:,0], y.iloc[:,1], m, n)
+    # Accepts matched peak DataFrames or (n, 2) arrays; missing peaks are skipped like pandas sums
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    wx = _weightxy(x[:, 0], x[:, 1], m, n)
+    wy = _weightxy(y[:, 0], y[:, 1], m, n)
     wx2 = wx**2
     wy2 = wy**2
-    return (np.sum(wx * wy)**2) / (np.sum(wx2, axis=0) * np.sum(wy2, axis=0))
+    return (np.nansum(wx * wy)**2) / (np.nansum(wx2, axis=0) * np.nansum(wy2, axis=0))
 
 
 
@@ -26,107 +32,327 @@ class joinPeaks:
         self.tolerance = tolerance
         self.ppm = ppm
 
+    def match_arrays(self, x_mz, x_intensities, y_mz, y_intensities):
+        """
+        Match the peaks of two spectra given as m/z-sorted arrays.
+
+        Each x peak is paired with the first unused y peak within the absolute
+        tolerance or the ppm tolerance of either peak, and unmatched peaks of both
+        spectra are padded with NaN (x peaks first, then the leftover y peaks).
+        Returns two aligned (n, 2) arrays of [mz, intensity] rows; raises ValueError
+        if either m/z array is not sorted.
+        """
+        x_mz = np.asarray(x_mz, dtype=float)
+        y_mz = np.asarray(y_mz, dtype=float)
+        if np.any(np.diff(x_mz) < 0) or np.any(np.diff(y_mz) < 0):
+            raise ValueError("match_arrays expects peaks sorted by m/z; use match or sort them first")
+        y_index = _match_peak_indices(x_mz, y_mz, self.tolerance, self.ppm)
+
+        unmatched_y = np.ones(len(y_mz), dtype=bool)
+        unmatched_y[y_index[y_index >= 0]] = False
+        unmatched_y = np.flatnonzero(unmatched_y)
+
+        n_rows = len(x_mz) + len(unmatched_y)
+        x_matched = np.full((n_rows, 2), np.nan)
+        y_matched = np.full((n_rows, 2), np.nan)
+
+        x_matched[:len(x_mz), 0] = x_mz
+        x_matched[:len(x_mz), 1] = x_intensities
+        has_match = np.flatnonzero(y_index >= 0)
+        y_matched[has_match, 0] = y_mz[y_index[has_match]]
+        y_matched[has_match, 1] = np.asarray(y_intensities, dtype=float)[y_index[has_match]]
+        y_matched[len(x_mz):, 0] = y_mz[unmatched_y]
+        y_matched[len(x_mz):, 1] = np.asarray(y_intensities, dtype=float)[unmatched_y]
+
+        return x_matched, y_matched
+
     def match(self, x, y):
-        # Initialize the result lists
-        x_matched = []
-        y_matched = []
-
-        # Create a list to keep track of matched y indices
-        matched_y_indices = set()
-
-        # Calculate ppm tolerance for each mz value in x and y
-        ppm_tolerance_x = x['mz'] * self.ppm * 1e-6
-
-        # Perform the matching
-        for i, x_row in x.iterrows():
-            mz_x = x_row['mz']
-            intensity_x = x_row['intensities']
-            match_found = False
-
-            for j, y_row in y.iterrows():
-                if j in matched_y_indices:
-                    continue
-
-                mz_y = y_row['mz']
-                intensity_y = y_row['intensities']
-                ppm_tolerance_y = mz_y * self.ppm * 1e-6
-
-                if abs(mz_y - mz_x) <= self.tolerance or abs(mz_y - mz_x) <= ppm_tolerance_x[i] or abs(mz_y - mz_x) <= ppm_tolerance_y:
-                    x_matched.append([mz_x, intensity_x])
-                    y_matched.append([mz_y, intensity_y])
-                    matched_y_indices.add(j)
-                    match_found = True
-                    break
-
-            if not match_found:
-                x_matched.append([mz_x, intensity_x])
-                y_matched.append([np.nan, np.nan])
-
-        # Add unmatched rows from y
-        for j, y_row in y.iterrows():
-            if j not in matched_y_indices:
-                mz_y = y_row['mz']
-                intensity_y = y_row['intensities']
-                x_matched.append([np.nan, np.nan])
-                y_matched.append([mz_y, intensity_y])
-
-        # Convert to DataFrames
+        """Match two peak DataFrames (mz and intensities columns), sorted by m/z first if needed."""
+        x = x.sort_values('mz', kind='stable')
+        y = y.sort_values('mz', kind='stable')
+        x_matched, y_matched = self.match_arrays(
+            x['mz'].values, x['intensities'].values, y['mz'].values, y['intensities'].values
+        )
+
+        # Convert to DataFrames with the same structure
         x_matched_df = pd.DataFrame(x_matched, columns=['mz', 'intensities'])
         y_matched_df = pd.DataFrame(y_matched, columns=['mz', 'intensities'])
-
-        # Set index to have the same structure
-        x_matched_df['index'] = range(len(x_matched_df))
-        y_matched_df['index'] = range(len(y_matched_df))
-
-        x_matched_df.set_index('index', inplace=True)
-        y_matched_df.set_index('index', inplace=True)
+        x_matched_df.index.name = 'index'
+        y_matched_df.index.name = 'index'
 
         return x_matched_df, y_matched_df
 
 
-def process_spectra_pairs(chunk, spectra, mz_irt_df, tolerance=0, ppm=0, m=0, n=0.5):
-
-    results = []
-
-    for index_pair in chunk:
-        i, j = index_pair
-
-        x = spectra[i]
-        y = spectra[j]
+def _within_tolerance(x_mz, y_mz, tolerance, ppm):
+    # Same test as the original row-by-row matcher: absolute tolerance or ppm of either peak
+    diff = np.abs(y_mz - x_mz)
+    return (diff <= tolerance) | (diff <= x_mz * ppm * 1e-6) | (diff <= y_mz * ppm * 1e-6)
+
+
+def _window_bounds(x_mz, tolerance=0, ppm=0):
+    """Return the lowest and highest y m/z that may match each x peak."""
+    ppm_fraction = ppm * 1e-6
+    lower = x_mz - np.maximum(tolerance, x_mz * ppm_fraction)
+    # Above x the ppm window of the y peak is the wider one: y - x <= y * ppm
+    upper = x_mz + tolerance
+    if ppm_fraction:
+        upper = np.maximum(upper, x_mz / (1 - ppm_fraction)) if ppm_fraction < 1 else np.full_like(x_mz, np.inf)
+    # Widen slightly so rounding never drops a candidate; the exact test is applied afterwards
+    slack = np.abs(x_mz) * 1e-9 + 1e-12
+    return lower - slack, upper + slack
+
+
+def _match_windows(x_mz, y_mz, tolerance=0, ppm=0):
+    """Return the half-open range [lo, hi) of y peaks that may match each x peak."""
+    lower, upper = _window_bounds(x_mz, tolerance, ppm)
+    lo = np.searchsorted(y_mz, lower, side='left')
+    hi = np.searchsorted(y_mz, upper, side='right')
+    return lo, hi
+
+
+def _segmented_searchsorted(values, value_segments, queries, query_segments, side='left'):
+    """
+    searchsorted of every query among the values of its own segment.
+
+    values must be sorted within each segment and segments must be non-decreasing;
+    the returned positions index the full values array.
+    """
+    n_values = len(values)
+    # With side='left' a query sorts before equal values, with side='right' after them
+    query_rank = 0 if side == 'left' else 1
+    kinds = np.concatenate((np.full(n_values, 1 - query_rank), np.full(len(queries), query_rank)))
+    keys = np.concatenate((values, queries))
+    segments = np.concatenate((value_segments, query_segments))
+    order = np.lexsort((kinds, keys, segments))
+
+    is_value = order < n_values
+    values_before = np.cumsum(is_value) - is_value
+    positions = np.empty(len(queries), dtype=np.int64)
+    positions[order[~is_value] - n_values] = values_before[~is_value]
+    return positions
+
+
+def _match_peak_indices(x_mz, y_mz, tolerance=0, ppm=0):
+    """
+    Greedy peak matching on m/z-sorted arrays.
+
+    Returns, for every x peak, the index of the y peak it is matched to or -1.
+    Because both spectra are sorted, the y peak picked for successive x peaks is
+    strictly increasing, so the first free candidate is max(lo, last match + 1).
+    """
+    y_index = np.full(len(x_mz), -1, dtype=np.int64)
+    if len(x_mz) == 0 or len(y_mz) == 0:
+        return y_index
+
+    lo, hi = _match_windows(x_mz, y_mz, tolerance, ppm)
+
+    # Fast path: if no window runs out of free peaks, the recurrence
+    # a_k = max(lo_k, a_(k-1) + 1) is a running maximum of lo_k - k.
+    candidates = np.flatnonzero(lo < hi)
+    rank = np.arange(len(candidates))
+    assigned = np.maximum.accumulate(lo[candidates] - rank) + rank if len(candidates) else rank
+    if np.all(assigned < hi[candidates]):
+        if np.all(_within_tolerance(x_mz[candidates], y_mz[assigned], tolerance, ppm)):
+            y_index[candidates] = assigned
+            return y_index
+
+    # Exact two-pointer merge for crowded windows
+    x_list = x_mz.tolist()
+    y_list = y_mz.tolist()
+    lo_list = lo.tolist()
+    hi_list = hi.tolist()
+    last = -1
+    for k in range(len(x_list)):
+        mz_x = x_list[k]
+        ppm_tolerance_x = mz_x * ppm * 1e-6
+        j = max(lo_list[k], last + 1)
+        while j < hi_list[k]:
+            diff = abs(y_list[j] - mz_x)
+            if diff <= tolerance or diff <= ppm_tolerance_x or diff <= y_list[j] * ppm * 1e-6:
+                y_index[k] = j
+                last = j
+                break
+            j += 1
+
+    return y_index
+
+
+def _match_peak_indices_segmented(x_mz, x_segments, y_mz, y_segments, y_offsets, tolerance=0, ppm=0):
+    """
+    Greedy peak matching for many spectrum pairs at once.
+
+    x and y hold the concatenated, m/z-sorted peaks of every pair, labelled by
+    pair number in x_segments/y_segments. Returns, for every x peak, the index
+    of its matched y peak in the concatenated y arrays or -1.
+    """
+    y_index = np.full(len(x_mz), -1, dtype=np.int64)
+    if len(x_mz) == 0 or len(y_mz) == 0:
+        return y_index
+
+    lower, upper = _window_bounds(x_mz, tolerance, ppm)
+    lo = _segmented_searchsorted(y_mz, y_segments, lower, x_segments, side='left')
+    hi = _segmented_searchsorted(y_mz, y_segments, upper, x_segments, side='right')
+
+    # Running maximum of lo_k - k restarted in every pair (see _match_peak_indices)
+    candidates = np.flatnonzero(lo < hi)
+    candidate_segments = x_segments[candidates]
+    rank = np.arange(len(candidates)) - np.searchsorted(candidate_segments, candidate_segments, side='left')
+    shift = candidate_segments * (len(x_mz) + len(y_mz) + 1)
+    assigned = np.maximum.accumulate(lo[candidates] - rank + shift) - shift + rank
+
+    ok = assigned < hi[candidates]
+    ok[ok] = _within_tolerance(x_mz[candidates[ok]], y_mz[assigned[ok]], tolerance, ppm)
+    crowded = np.unique(candidate_segments[~ok])
+    fast = ~np.isin(candidate_segments, crowded)
+    y_index[candidates[fast]] = assigned[fast]
+
+    # Pairs whose windows compete for the same peaks are resolved one at a time
+    if len(crowded):
+        x_bounds = np.searchsorted(x_segments, np.stack((crowded, crowded + 1)), side='left')
+        for segment, x_start, x_end in zip(crowded.tolist(), x_bounds[0].tolist(), x_bounds[1].tolist()):
+            y_start, y_end = y_offsets[segment], y_offsets[segment + 1]
+            local = _match_peak_indices(x_mz[x_start:x_end], y_mz[y_start:y_end], tolerance, ppm)
+            y_index[x_start:x_end] = np.where(local >= 0, local + y_start, -1)
+
+    return y_index
+
+
+# Peaks of a chunk of spectrum pairs after one matching pass. x/y hold the concatenated peaks
+# of the first/second spectrum of every pair, labelled by pair in x_segments/y_segments;
+# y_index is the matched y peak of every x peak or -1.
+MatchedPairs = namedtuple(
+    'MatchedPairs', ['n_pairs', 'x_mz', 'x_intensities', 'x_segments', 'y_mz', 'y_intensities', 'y_segments', 'y_index']
+)
+
+
+def _match_chunk(packed, rows, tolerance=0, ppm=0):
+    """Match the peaks of every (i, j) row of rows once, for any number of metrics."""
+    n_pairs = len(rows)
+    x_positions, x_offsets = packed.gather(rows[:, 0])
+    y_positions, y_offsets = packed.gather(rows[:, 1])
+    # Peaks of a binary library are float32; match and weight them in double precision
+    x_mz, x_intensities = packed.mz[x_positions].astype(float), packed.intensities[x_positions].astype(float)
+    y_mz, y_intensities = packed.mz[y_positions].astype(float), packed.intensities[y_positions].astype(float)
+    x_segments = np.repeat(np.arange(n_pairs), np.diff(x_offsets))
+    y_segments = np.repeat(np.arange(n_pairs), np.diff(y_offsets))
+
+    y_index = _match_peak_indices_segmented(
+        x_mz, x_segments, y_mz, y_segments, y_offsets, tolerance, ppm
+    )
+    return MatchedPairs(n_pairs, x_mz, x_intensities, x_segments, y_mz, y_intensities, y_segments, y_index)
+
+
+def _normalized_dot_products(matched, m=0, n=0.5):
+    """ndotproduct of every pair of a MatchedPairs."""
+    wx = _weightxy(matched.x_mz, matched.x_intensities, m, n)
+    wy = _weightxy(matched.y_mz, matched.y_intensities, m, n)
+    has_match = matched.y_index >= 0
+    dot = np.bincount(matched.x_segments[has_match], weights=wx[has_match] * wy[matched.y_index[has_match]],
+                      minlength=matched.n_pairs)
+    wx2 = np.bincount(matched.x_segments, weights=wx**2, minlength=matched.n_pairs)
+    wy2 = np.bincount(matched.y_segments, weights=wy**2, minlength=matched.n_pairs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return dot**2 / (wx2 * wy2)
+
+
+def _spectral_angles(matched, m=0, n=0.5):
+    """nspectraangle of every pair of a MatchedPairs."""
+    with np.errstate(invalid='ignore'):
+        return 1 - 2 * np.arccos(_normalized_dot_products(matched, m, n)) / np.pi
+
+
+def _spectral_angle_chunk(packed, rows, tolerance=0, ppm=0, m=0, n=0.5):
+    """nspectraangle for every (i, j) row of rows, computed on packed peak arrays."""
+    return _spectral_angles(_match_chunk(packed, rows, tolerance, ppm), m, n)
+
+
+def _pairs_frame(index_array, mz_irt_df, scores):
+    """
+    Columnar result table shared by the pair scorers.
+
+    scores is one array (the similarity_score column) or a dict of score columns.
+    """
+    index1 = index_array[:, 0]
+    index2 = index_array[:, 1]
+    if not isinstance(scores, dict):
+        scores = {'similarity_score': scores}
+    return pd.DataFrame({
+        'index1': index1,
+        'index2': index2,
+        'peptide 1': mz_irt_df.loc[index1, 'Name'].to_numpy(),
+        'peptide 2': mz_irt_df.loc[index2, 'Name'].to_numpy(),
+        'm/z  1': mz_irt_df.loc[index1, 'MW'].to_numpy(),
+        'm/z 2': mz_irt_df.loc[index2, 'MW'].to_numpy(),
+        'iRT 1': mz_irt_df.loc[index1, 'iRT'].to_numpy(),
+        'iRT 2': mz_irt_df.loc[index2, 'iRT'].to_numpy(),
+        **scores,
+    })
+
+
+def _pair_metadata(spectra, mz_irt_df=None):
+    """Name/MW/iRT table of the pair scorers: mz_irt_df, or the metadata of PackedSpectra."""
+    if mz_irt_df is not None:
+        return mz_irt_df
+    metadata = spectra.metadata if isinstance(spectra, PackedSpectra) else None
+    if metadata is None:
+        raise ValueError("mz_irt_df (Name, MW and iRT per spectrum) is required unless spectra is "
+                         "PackedSpectra with metadata")
+    return metadata
+
+
+def _packed_rows(index_array, spectra):
+    """Pack the spectra referenced by index_array once and map the pairs onto the packed rows."""
+    if isinstance(spectra, PackedSpectra):
+        return spectra, index_array
+    used, inverse = np.unique(index_array, return_inverse=True)
+    packed = PackedSpectra.from_spectra([spectra[i] for i in used.tolist()])
+    return packed, inverse.reshape(index_array.shape)
+
+
+def score_spectra_pairs(index_array, spectra, mz_irt_df=None, tolerance=0, ppm=0, m=0, n=0.5, chunk_size=20000,
+                        progress=None):
+    """
+    Compute nspectraangle for every candidate pair of index_array in vectorized chunks.
+
+    spectra is either a list of matchms Spectrum objects or PackedSpectra; the
+    peaks are packed once and every chunk of pairs is matched and scored with
+    array operations. Returns a DataFrame with the same columns as
+    process_spectra_pairs. mz_irt_df defaults to the PackedSpectra metadata and is
+    required for a list of spectra (ValueError otherwise).
+    progress, if given, is called as progress(done, total) in pairs after every chunk.
+
+    Usage:
+    index_array = Groups_df[['index1', 'index2']].values.astype(int)
+    result = score_spectra_pairs(index_array, spectra, mz_irt_df, tolerance=0, ppm=10)
+    """
+    index_array = np.asarray(index_array, dtype=np.int64).reshape(-1, 2)
+    mz_irt_df = _pair_metadata(spectra, mz_irt_df)
+    packed, rows = _packed_rows(index_array, spectra)
+
+    scores = np.empty(len(rows))
+    for start in range(0, len(rows), chunk_size):
+        scores[start:start + chunk_size] = _spectral_angle_chunk(
+            packed, rows[start:start + chunk_size], tolerance, ppm, m, n
+        )
+        if progress is not None:
+            progress(min(start + chunk_size, len(rows)), len(rows))
+
+    return _pairs_frame(index_array, mz_irt_df, scores)
 
-        x_df = pd.DataFrame({'mz': x.peaks.mz, 'intensities': x.peaks.intensities})
-        y_df = pd.DataFrame({'mz': y.peaks.mz, 'intensities': y.peaks.intensities})
 
-        matcher = joinPeaks(tolerance=tolerance, ppm=ppm)
-        x_matched, y_matched = matcher.match(x_df, y_df)
-
-        angle = nspectraangle(x_matched, y_matched, m=m, n=n)
-        print(angle)
-        
-        # Extract the relevant information for the given index pair
-        results.append({
-            'index1': i,
-            'index2': j,
-            'peptide 1': mz_irt_df.loc[i, 'Name'],
-            'peptide 2': mz_irt_df.loc[j, 'Name'],
-            'm/z  1': mz_irt_df.loc[i, 'MW'],
-            'm/z 2': mz_irt_df.loc[j, 'MW'],
-            'iRT 1': mz_irt_df.loc[i, 'iRT'],
-            'iRT 2': mz_irt_df.loc[j, 'iRT'],
-            'similarity_score': angle,  
-        })
-
-    return pd.DataFrame(results)
+def process_spectra_pairs(chunk, spectra, mz_irt_df, tolerance=0, ppm=0, m=0, n=0.5):
+    return score_spectra_pairs(chunk, spectra, mz_irt_df, tolerance=tolerance, ppm=ppm, m=m, n=n)
 
 def process_spectra_pairs_cosine(chunk, spectra, mz_irt_df, tolerance=0):
 
     results = []
+    # One scorer for all pairs; it holds no per-pair state
+    cosine_greedy = CosineGreedy(tolerance=tolerance)
 
     for index_pair in chunk:
         i, j = index_pair
 
-        cosine_greedy = CosineGreedy(tolerance = tolerance)
-        score = cosine_greedy.pair(spectra[i], spectra[j])    
+        score = cosine_greedy.pair(spectra[i], spectra[j])
         angle = score['score']
         # Extract the relevant information for the given index pair
         results.append({
@@ -1,14 +1,358 @@
 """Console script for msci."""
+import logging
 import sys
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
 import click
 
+from MSCI.Preprocessing.digestion import ENZYMES
+from MSCI.progress import PROGRESS_REPORTERS
+
+FASTA_SUFFIXES = ('.fasta', '.fa', '.faa', '.fasta.gz', '.fa.gz', '.faa.gz')
+
+
+def _write_table(df, output):
+    """Write a table as Parquet (.parquet) or CSV (anything else)."""
+    if str(output).endswith('.parquet'):
+        df.to_parquet(output, index=False)
+    else:
+        df.to_csv(output, index=False)
+
+
+def _read_table(path):
+    import pandas as pd
+    return pd.read_parquet(path) if str(path).endswith('.parquet') else pd.read_csv(path)
+
+
+@contextmanager
+def _input_peptides(input_file, enzyme, missed_cleavages, min_length, max_length):
+    """
+    (peptides, count) of a list (one per line) or of the distinct peptides of a digested FASTA file.
+
+    FASTA input is digested with write_unique_peptides into a temporary file, so memory is
+    bounded by its max_in_memory, and the peptides are streamed from that file.
+    """
+    if not str(input_file).lower().endswith(FASTA_SUFFIXES):
+        import pandas as pd
+        peptides = pd.read_csv(input_file, header=None)[0].tolist()
+        yield peptides, len(peptides)
+        return
+
+    from MSCI.Preprocessing.digestion import iter_proteome_peptides, write_unique_peptides
+    with tempfile.TemporaryDirectory(prefix='msci_peptides_') as work_dir:
+        path = Path(work_dir) / 'peptides.txt'
+        count = write_unique_peptides(
+            iter_proteome_peptides(input_file, enzyme, missed_cleavages, min_length, max_length), path,
+            work_dir=work_dir
+        )
+        with open(path) as file:
+            yield (line.rstrip('\n') for line in file), count
+
+
+def _load_spectra(path):
+    """PackedSpectra of a binary library directory or an MSP/mzML/MGF file."""
+    if Path(path).is_dir():
+        from MSCI.Preprocessing.spectral_library import load_library
+        return load_library(path)
+    from MSCI.Preprocessing.Parsing import read_packed_spectra
+    return read_packed_spectra(path)
+
+
+def _predict(input_file, output, collision_energy, charge, model_intensity, model_irt, server_url,
+             enzyme, missed_cleavages, min_length, max_length, workers, batch_size, cache_path, progress):
+    from MSCI.Preprocessing.Koina import PeptideProcessor
+    from MSCI.Preprocessing.prediction_cache import PredictionCache
+    from MSCI.progress import get_progress
+
+    prediction_cache = PredictionCache(cache_path) if cache_path else None
+    with _input_peptides(input_file, enzyme, missed_cleavages, min_length, max_length) as (peptides, count):
+        processor = PeptideProcessor(None, collision_energy, list(charge), model_intensity, model_irt,
+                                     server_url=server_url, batch_size=batch_size, max_workers=workers,
+                                     cache=prediction_cache, peptides=peptides,
+                                     progress=get_progress(progress, "Predicting"))
+        if str(output).endswith('.msp'):
+            processor.process(output)
+        else:
+            processor.process_to_library(output)
+    if prediction_cache is not None:
+        prediction_cache.close()
+    return count
+
+
+def _group(library, output, mz_tolerance, irt_tolerance, ppm):
+    from MSCI.Grouping_MS1.Grouping_mw_irt import process_peptide_combinations
+
+    spectra = _load_spectra(library)
+    pairs = process_peptide_combinations(spectra.metadata[['Name', 'MW', 'iRT']], mz_tolerance, irt_tolerance,
+                                         use_ppm=ppm)
+    _write_table(pairs, output)
+    return len(pairs)
+
+
+def _score(library, pairs_file, output, tolerance, ppm, workers, batch_size, progress, metrics=(),
+           prefilter=None, bin_width=0.05):
+    from MSCI.Similarity.parallel_scoring import score_spectra_pairs_parallel
+    from MSCI.progress import get_progress
+
+    spectra = _load_spectra(library)
+    pairs = _read_table(pairs_file)
+    options = dict(tolerance=0 if ppm else tolerance, ppm=tolerance if ppm else 0, workers=workers,
+                   chunk_size=batch_size, progress=get_progress(progress, "Scoring"), metrics=list(metrics) or None)
+    index_array = pairs[['index1', 'index2']].to_numpy(dtype=int)
+    if prefilter is None:
+        scores = score_spectra_pairs_parallel(index_array, spectra, spectra.metadata, **options)
+    else:
+        from MSCI.Similarity.binned_similarity import score_spectra_pairs_binned
+        scores = score_spectra_pairs_binned(index_array, spectra, spectra.metadata, threshold=prefilter,
+                                            bin_width=bin_width, **options)
+    _write_table(scores, output)
+    return len(scores)
+
+
+DIGESTION_OPTIONS = [
+    click.option('--enzyme', type=click.Choice(list(ENZYMES)), default='trypsin', show_default=True,
+                 help="Enzyme used to digest a FASTA input."),
+    click.option('--missed-cleavages', type=int, default=0, show_default=True),
+    click.option('--min-length', type=int, default=7, show_default=True),
+    click.option('--max-length', type=int, default=30, show_default=True),
+]
+
+
+def _apply_options(command, options):
+    for option in reversed(options):
+        command = option(command)
+    return command
+
+
+def digestion_options(command):
+    """Options shared by digest, predict and run."""
+    return _apply_options(command, DIGESTION_OPTIONS)
+
+
+def prediction_options(command):
+    """Options shared by predict and run."""
+    options = [
+        click.option('--collision-energy', '-e', type=float, default=30.0, show_default=True),
+        click.option('--charge', '-z', type=int, multiple=True, default=[2], show_default=True,
+                     help="Precursor charge to predict; repeat for several."),
+        click.option('--model-intensity', default="Prosit_2020_intensity_HCD", show_default=True),
+        click.option('--model-irt', default="Prosit_2019_irt", show_default=True),
+        click.option('--server-url', default="https://koina.wilhelmlab.org", show_default=True),
+        *DIGESTION_OPTIONS,
+        click.option('--cache', 'cache_path', type=click.Path(dir_okay=False),
+                     help="PredictionCache database consulted before Koina."),
+    ]
+    return _apply_options(command, options)
+
+
+def grouping_options(command):
+    """Options shared by group and run."""
+    options = [
+        click.option('--mz-tolerance', '-m', type=float, default=10.0, show_default=True),
+        click.option('--irt-tolerance', '-t', type=float, default=5.0, show_default=True),
+        click.option('--ppm/--da', default=True, show_default=True, help="Unit of the m/z tolerance."),
+    ]
+    return _apply_options(command, options)
+
+
+def runtime_options(command):
+    """--workers, --batch-size and --progress."""
+    options = [
+        click.option('--workers', '-j', type=int, default=4, show_default=True,
+                     help="Concurrent Koina batches when predicting, processes when scoring."),
+        click.option('--batch-size', '-b', type=int, default=1000, show_default=True,
+                     help="Peptides per Koina request when predicting, pairs per chunk when scoring."),
+        click.option('--progress', type=click.Choice(PROGRESS_REPORTERS), default='log', show_default=True),
+    ]
+    return _apply_options(command, options)
+
 
-@click.command()
-def main(args=None):
+@click.group()
+@click.option('--log-level', default='INFO', show_default=True,
+              type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR']))
+def main(log_level):
     """Console script for msci."""
-    click.echo("Replace this message by putting your code into "
-               "msci.cli.main")
-    click.echo("See click documentation at https://click.palletsprojects.com/")
+    logging.basicConfig(level=log_level, format="%(asctime)s %(levelname)s %(message)s")
+
+
+@main.command()
+@click.argument('input_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output', type=click.Path())
+@prediction_options
+@runtime_options
+def predict(input_file, output, collision_energy, charge, model_intensity, model_irt, server_url,
+            enzyme, missed_cleavages, min_length, max_length, cache_path, workers, batch_size, progress):
+    """Predict the spectra of INPUT_FILE (peptide list or FASTA) into OUTPUT (.msp or library directory)."""
+    count = _predict(input_file, output, collision_energy, charge, model_intensity, model_irt, server_url,
+                     enzyme, missed_cleavages, min_length, max_length, workers, batch_size, cache_path, progress)
+    click.echo(f"{count} peptides predicted into {output}")
+    return 0
+
+
+@main.command('digest')
+@click.argument('fasta', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output', type=click.Path(dir_okay=False))
+@digestion_options
+@click.option('--min-mass', type=float, help="Minimum neutral peptide mass (Da).")
+@click.option('--max-mass', type=float, help="Maximum neutral peptide mass (Da).")
+@click.option('--max-in-memory', type=int, default=2_000_000, show_default=True,
+              help="Distinct peptides kept in memory before spilling a sorted run to disk.")
+def digest_command(fasta, output, enzyme, missed_cleavages, min_length, max_length, min_mass, max_mass, max_in_memory):
+    """Digest FASTA and write its distinct peptides to OUTPUT, one per line."""
+    from MSCI.Preprocessing.digestion import digest_fasta
+
+    count = digest_fasta(fasta, output, enzyme, missed_cleavages, min_length, max_length, min_mass, max_mass,
+                         max_in_memory)
+    click.echo(f"{count} distinct peptides written to {output}")
+    return 0
+
+
+@main.command()
+@click.argument('library', type=click.Path(exists=True))
+@click.argument('output', type=click.Path(dir_okay=False))
+@grouping_options
+def group(library, output, mz_tolerance, irt_tolerance, ppm):
+    """Write the candidate pairs of LIBRARY (library directory, MSP, mzML or MGF) within the MS1 tolerances."""
+    count = _group(library, output, mz_tolerance, irt_tolerance, ppm)
+    click.echo(f"{count} candidate pairs written to {output}")
+    return 0
+
+
+@main.command()
+@click.argument('library', type=click.Path(exists=True))
+@click.argument('pairs', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--tolerance', type=float, default=0.02, show_default=True, help="Fragment m/z tolerance.")
+@click.option('--ppm', is_flag=True, help="Fragment tolerance in ppm instead of Da.")
+@click.option('--metric', 'metrics', multiple=True,
+              help="Similarity metric column to compute (spectral_angle, dot_product, entropy, pearson, spearman, "
+                   "matched_peaks); repeat for several, all from one peak matching pass. "
+                   "Default: the spectral angle as similarity_score.")
+@click.option('--prefilter', type=float, default=None,
+              help="Only score exactly the pairs whose binned sparse-vector score reaches this value "
+                   "(same scale as the spectral angle); the others are left out of OUTPUT.")
+@click.option('--bin-width', type=float, default=0.05, show_default=True,
+              help="m/z bin width (Da) of the --prefilter vectors; at least twice the fragment tolerance.")
+@runtime_options
+def score(library, pairs, output, tolerance, ppm, metrics, prefilter, bin_width, workers, batch_size, progress):
+    """Score the candidate PAIRS (output of group) on the spectra of LIBRARY and write them to OUTPUT."""
+    if metrics:
+        from MSCI.Similarity.metrics import METRICS
+        unknown = [metric for metric in metrics if metric not in METRICS]
+        if unknown:
+            raise click.BadParameter(f"{', '.join(unknown)}; choose from {', '.join(METRICS)}", param_hint='--metric')
+    count = _score(library, pairs, output, tolerance, ppm, workers, batch_size, progress, metrics,
+                   prefilter, bin_width)
+    click.echo(f"{count} pairs scored into {output}")
+    return 0
+
+
+@main.command()
+@click.argument('input_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@prediction_options
+@grouping_options
+@click.option('--tolerance', type=float, default=0.02, show_default=True, help="Fragment m/z tolerance.")
+@click.option('--fragment-ppm', is_flag=True, help="Fragment tolerance in ppm instead of Da.")
+@runtime_options
+def run(input_file, output_dir, collision_energy, charge, model_intensity, model_irt, server_url,
+        enzyme, missed_cleavages, min_length, max_length, cache_path, mz_tolerance, irt_tolerance, ppm, tolerance,
+        fragment_ppm, workers, batch_size, progress):
+    """Predict, group and score INPUT_FILE; writes library.msl, pairs.parquet and scores.parquet to OUTPUT_DIR."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    library, pairs, scores = output_dir / 'library.msl', output_dir / 'pairs.parquet', output_dir / 'scores.parquet'
+    count = _predict(input_file, library, collision_energy, charge, model_intensity, model_irt, server_url,
+                     enzyme, missed_cleavages, min_length, max_length, workers, batch_size, cache_path, progress)
+    click.echo(f"{count} peptides predicted into {library}")
+    count = _group(library, pairs, mz_tolerance, irt_tolerance, ppm)
+    click.echo(f"{count} candidate pairs written to {pairs}")
+    count = _score(library, pairs, scores, tolerance, fragment_ppm, workers, batch_size, progress)
+    click.echo(f"{count} pairs scored into {scores}")
+    return 0
+
+
+@main.command()
+@click.argument('input_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--universe', '-u', default="Reference Human Canonical proteome", show_default=True,
+              help="Precomputed universe to check against.")
+@click.option('--collision-energy', '-e', type=int, multiple=True,
+              help="Collision energy to check; repeat for several (default: all of the universe).")
+@click.option('--charge', '-z', type=int, default=2, show_default=True,
+              help="Charge of the lines of INPUT_FILE that give none.")
+def check(input_file, output, universe, collision_energy, charge):
+    """Check the peptides of INPUT_FILE (PEPTIDE/charge per line) for twins and write them to OUTPUT."""
+    from MSCI.data.twin_checker import DATASETS, check_peptides, read_peptide_list
+
+    if universe not in DATASETS:
+        raise click.BadParameter(f"choose from {', '.join(DATASETS)}", param_hint='--universe')
+    with open(input_file) as file:
+        targets = read_peptide_list(file, default_charge=charge)
+    twins = check_peptides(targets['peptide'], targets['charge'], universe, collision_energy or None)
+    _write_table(twins, output)
+    click.echo(f"{len(twins)} twins for {twins[['peptide', 'charge']].drop_duplicates().shape[0]} "
+               f"of {len(targets)} peptides written to {output}")
+    return 0
+
+
+@main.group()
+def cache():
+    """Manage the persistent prediction cache."""
+
+
+@cache.command()
+@click.argument('cache_path', type=click.Path(dir_okay=False))
+@click.argument('input_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--collision-energy', '-e', type=float, multiple=True, default=[30.0], show_default=True,
+              help="Collision energy to predict; repeat to sweep several.")
+@click.option('--charge', '-z', type=int, multiple=True, default=[2], show_default=True,
+              help="Precursor charge to predict; repeat for several.")
+@click.option('--model-intensity', default="Prosit_2020_intensity_HCD", show_default=True)
+@click.option('--model-irt', default="Prosit_2019_irt", show_default=True)
+@click.option('--max-entries', type=int, default=None, help="Evict least recently used entries above this size.")
+def warm(cache_path, input_file, collision_energy, charge, model_intensity, model_irt, max_entries):
+    """Predict the peptides of INPUT_FILE into the cache at CACHE_PATH."""
+    import pandas as pd
+    from MSCI.Preprocessing.Koina import PeptideProcessor
+    from MSCI.Preprocessing.prediction_cache import PredictionCache
+
+    prediction_cache = PredictionCache(cache_path, max_entries=max_entries)
+    peptides = pd.read_csv(input_file, header=None)[0].tolist()
+    for energy in collision_energy:
+        processor = PeptideProcessor(input_file, energy, list(charge), model_intensity, model_irt,
+                                     cache=prediction_cache)
+        prediction_cache.warm(processor, peptides)
+        click.echo(f"NCE {energy:g}: {prediction_cache.stats()}")
+    prediction_cache.close()
+    return 0
+
+
+@cache.command()
+@click.argument('cache_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output', type=click.Path(dir_okay=False))
+def export(cache_path, output):
+    """Copy the cache at CACHE_PATH to OUTPUT."""
+    from MSCI.Preprocessing.prediction_cache import PredictionCache
+
+    prediction_cache = PredictionCache(cache_path)
+    prediction_cache.export(output)
+    prediction_cache.close()
+    return 0
+
+
+@cache.command()
+@click.argument('cache_path', type=click.Path(exists=True, dir_okay=False))
+def stats(cache_path):
+    """Show the number of cached predictions."""
+    from MSCI.Preprocessing.prediction_cache import PredictionCache
+
+    prediction_cache = PredictionCache(cache_path)
+    for key, value in prediction_cache.stats().items():
+        click.echo(f"{key}: {value}")
+    prediction_cache.close()
     return 0
 
 
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+
+import requests
+
+# Root of the on-disk caches of MSCI (resources, twin indexes)
+CACHE_DIR = Path(os.environ.get('MSCI_CACHE_DIR', Path.home() / '.cache' / 'msci'))
+RESOURCE_DIR = CACHE_DIR / 'resources'
+# Repository checkout holding the bundled Database/, tutorial/ and docs/ files
+REPO_ROOT = Path(__file__).resolve().parents[2]
+# Cached copies younger than this are used without asking the server
+RESOURCE_TTL = 24 * 3600
+# With MSCI_OFFLINE=1 the network is never used, only cached and bundled copies
+OFFLINE = os.environ.get('MSCI_OFFLINE', '') not in ('', '0')
+
+# Repository file paths in raw.githubusercontent.com and github.com/.../raw/ URLs
+_GITHUB_FILE = re.compile(
+    r'^https?://(?:raw\.githubusercontent\.com/[^/]+/[^/]+/[^/]+|github\.com/[^/]+/[^/]+/raw/[^/]+)/(?P<path>.+)$'
+)
+
+
+def bundled_path(url):
+    """Bundled copy of a repository file URL in this checkout, or None."""
+    match = _GITHUB_FILE.match(url)
+    if match is None:
+        return None
+    path = REPO_ROOT / match.group('path')
+    return path if path.is_file() else None
+
+
+def _cache_paths(url):
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return RESOURCE_DIR / key, RESOURCE_DIR / f"{key}.json"
+
+
+def _read_meta(meta_path):
+    try:
+        with open(meta_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cache(url, data_path, meta_path, content, headers):
+    RESOURCE_DIR.mkdir(parents=True, exist_ok=True)
+    staging = data_path.with_name(f"{data_path.name}.{os.getpid()}.tmp")
+    staging.write_bytes(content)
+    os.replace(staging, data_path)
+    _write_meta(meta_path, {
+        'url': url,
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'fetched_at': time.time(),
+    })
+
+
+def _write_meta(meta_path, meta):
+    staging = meta_path.with_name(f"{meta_path.name}.{os.getpid()}.tmp")
+    with open(staging, 'w') as file:
+        json.dump(meta, file)
+    os.replace(staging, meta_path)
+
+
+def fetch_resource(url, ttl=RESOURCE_TTL, offline=None, session=None, timeout=10):
+    """
+    Local path of a remote resource, downloaded at most once per ttl seconds.
+
+    Cached copies older than ttl are revalidated with the server (ETag/Last-Modified), so
+    unchanged files are not downloaded again. When the server cannot be reached, the
+    cached copy is used even if stale, then the copy bundled with the repository
+    (Database/, tutorial/, docs/, ...). offline (default: the MSCI_OFFLINE environment
+    variable) skips the network entirely. Raises OSError when no copy is available.
+
+    Usage:
+    path = fetch_resource("https://raw.githubusercontent.com/zahrael97/MSCI/master/tutorial/test.txt")
+    """
+    offline = OFFLINE if offline is None else offline
+    data_path, meta_path = _cache_paths(url)
+    meta = _read_meta(meta_path) if data_path.exists() else None
+    if meta is not None and time.time() - meta['fetched_at'] < ttl:
+        return data_path
+
+    if not offline:
+        headers = {}
+        if meta is not None and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta is not None and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            response = (session or requests).get(url, headers=headers, timeout=timeout)
+        except requests.RequestException:
+            response = None
+        if response is not None and response.status_code == 304 and meta is not None:
+            meta['fetched_at'] = time.time()
+            _write_meta(meta_path, meta)
+            return data_path
+        if response is not None and response.status_code == 200:
+            _write_cache(url, data_path, meta_path, response.content, response.headers)
+            return data_path
+
+    # Offline or failed: a stale copy, then the bundled one
+    if meta is not None:
+        return data_path
+    bundled = bundled_path(url)
+    if bundled is not None:
+        return bundled
+    raise OSError(f"Resource unavailable and not cached: {url}")
+
+
+def read_resource(url, **kwargs):
+    """Content of a remote resource as bytes, through fetch_resource."""
+    return fetch_resource(url, **kwargs).read_bytes()
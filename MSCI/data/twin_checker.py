@@ -0,0 +1,96 @@
+"""Lookups of peptide twins in the precomputed twin universes (DATASETS)."""
+from typing import Tuple
+
+import pandas as pd
+
+from MSCI.data.twin_index import load_twin_index
+
+DATASETS = {
+    "Reference Human Canonical proteome": {
+        25: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/NSA_HRHR_NCE25.csv",
+        28: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/NSA_HRHR_NCE28.csv",
+        30: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/NSA_HRHR_NCE30.csv",
+        32: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/NSA_HRHR_NCE32.csv",
+        35: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/NSA_HRHR_NCE35.csv"
+    },
+    "Reference Human Canonical proteome with natural variants": {
+        30: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/mutation_peptides_HRHR_NSA_score.csv",
+    },
+    "Immunopeptidome": {
+        30: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/HLA_peptides_HRHR_NSA_score.csv",
+    },
+    "Human Oral microbiome": {
+        30: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/Oral_microbiom.csv",
+    }
+}
+
+# Universes whose tables carry the spectral angle of each pair
+ANGLE_UNIVERSES = ["Reference Human Canonical proteome with natural variants", "Immunopeptidome"]
+
+# Columns of the batch checker output
+CHECK_COLUMNS = ['peptide', 'charge', 'NCE', 'twin_peptide', 'twin_charge', 'angle']
+
+def extract_peptide_and_charge(peptide_str: str) -> Tuple[str, int]:
+    try:
+        peptide, charge = peptide_str.rsplit('/', 1)
+        return peptide, int(charge)
+    except ValueError:
+        return peptide_str, None
+
+def find_colliding_peptides(df: pd.DataFrame, peptide: str, charge: int, organism: str) -> set:
+    angle_available = organism in ANGLE_UNIVERSES
+
+    matches = df[((df['x_peptide'].apply(lambda x: extract_peptide_and_charge(x) == (peptide, charge))) |
+                  (df['y_peptide'].apply(lambda x: extract_peptide_and_charge(x) == (peptide, charge))))]
+
+    colliding_peptides = {
+        (row['x_peptide'].rsplit('/', 1)[0], int(row['x_peptide'].rsplit('/', 1)[1]), row['angle'] if angle_available else None)
+        for _, row in matches.iterrows() if row['x_peptide'].rsplit('/', 1)[0] != peptide
+    }.union({
+        (row['y_peptide'].rsplit('/', 1)[0], int(row['y_peptide'].rsplit('/', 1)[1]), row['angle'] if angle_available else None)
+        for _, row in matches.iterrows() if row['y_peptide'].rsplit('/', 1)[0] != peptide
+    })
+
+    return colliding_peptides
+
+def read_peptide_list(lines, default_charge: int = 2) -> pd.DataFrame:
+    """
+    Parse a target list with one precursor per line: 'PEPTIDE/2', 'PEPTIDE,2' or 'PEPTIDE'
+    (default_charge). Returns a DataFrame with peptide (upper case) and charge columns.
+    """
+    entries = pd.Series([line.strip() for line in lines if line.strip()], dtype=object)
+    parts = entries.str.replace(',', '/', regex=False).str.rsplit('/', n=1)
+    has_charge = parts.str.len() == 2
+    return pd.DataFrame({
+        'peptide': parts.str[0].str.strip().str.upper(),
+        'charge': parts.str[1].where(has_charge, default_charge).astype(int),
+    })
+
+
+def check_peptides(peptides, charges, organism: str, energies=None, load_index=load_twin_index) -> pd.DataFrame:
+    """
+    Twins of many precursors in one universe, at all (or the given) collision energies.
+
+    Returns a long table with one row per twin: peptide, charge, NCE, twin_peptide,
+    twin_charge and angle (NaN where the universe has no angles). Each energy is
+    answered with one batched lookup in its TwinIndex, loaded with load_index (the GUI
+    passes its process-wide memoized loader).
+
+    Usage:
+    targets = read_peptide_list(open('assay.txt'))
+    twins = check_peptides(targets['peptide'], targets['charge'], "Reference Human Canonical proteome")
+    """
+    energies = list(DATASETS[organism]) if energies is None else list(energies)
+    peptides = [str(peptide).upper() for peptide in peptides]
+    charges = [int(charge) for charge in charges]
+    tables = []
+    for energy in energies:
+        twins = load_index(DATASETS[organism][energy]).lookup_many(peptides, charges)
+        twins.insert(3, 'NCE', energy)
+        tables.append(twins)
+    if not tables:
+        return pd.DataFrame(columns=CHECK_COLUMNS)
+    twins = pd.concat(tables, ignore_index=True)
+    if organism not in ANGLE_UNIVERSES:
+        twins['angle'] = float('nan')
+    return twins.sort_values(['query', 'NCE'], kind='stable')[CHECK_COLUMNS].reset_index(drop=True)
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import shutil
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from MSCI.data.resources import CACHE_DIR, REPO_ROOT, fetch_resource
+
+# Precomputed twin universes shipped with the repository
+DATABASE_DIR = REPO_ROOT / 'Database'
+# Prebuilt indexes are kept here, one directory per source table
+INDEX_DIR = CACHE_DIR / 'twin_index'
+INDEX_VERSION = 1
+
+
+def _split_keys(keys):
+    """Sequence part of 'SEQ/charge' keys."""
+    return pd.Series(keys).str.rsplit('/', n=1).str[0].to_numpy()
+
+
+class TwinIndex:
+    """
+    Sorted-key index from 'SEQ/charge' to the twins of that precursor in a universe table.
+
+    The twins of keys[i] are partners[offsets[i]:offsets[i + 1]], with their spectral angle
+    in angles (NaN where the table has none). Every pair of the table is indexed in both
+    directions and partners with the same sequence as the key are left out, as in
+    twin_checker.find_colliding_peptides. The arrays are .npy files opened with
+    mmap_mode='r', so an index is shared by the page cache and loads instantly.
+
+    Usage:
+    index = load_twin_index('Database/NSA_HRHR_NCE30.csv')
+    twins = index.lookup('SDPYGIIR', 2)
+    """
+
+    def __init__(self, keys, offsets, partners, angles):
+        self.keys = keys
+        self.offsets = offsets
+        self.partners = partners
+        self.angles = angles
+
+    @classmethod
+    def from_table(cls, df):
+        """Build the index from a table with x_peptide, y_peptide and optionally angle columns."""
+        x = df['x_peptide'].astype(str).to_numpy()
+        y = df['y_peptide'].astype(str).to_numpy()
+        angle = df['angle'].to_numpy(dtype=float) if 'angle' in df.columns else np.full(len(df), np.nan)
+
+        edges = pd.DataFrame({
+            'key': np.concatenate((x, y)),
+            'partner': np.concatenate((y, x)),
+            'angle': np.concatenate((angle, angle)),
+        })
+        edges = edges[_split_keys(edges['key']) != _split_keys(edges['partner'])]
+        edges = edges.drop_duplicates().sort_values(['key', 'partner'], kind='stable')
+
+        keys, starts = np.unique(edges['key'].to_numpy(dtype=bytes), return_index=True)
+        offsets = np.append(starts, len(edges)).astype(np.int64)
+        return cls(keys, offsets, edges['partner'].to_numpy(dtype=bytes), edges['angle'].to_numpy())
+
+    def save(self, index_dir):
+        index_dir = Path(index_dir)
+        index_dir.mkdir(parents=True, exist_ok=True)
+        for name in ('keys', 'offsets', 'partners', 'angles'):
+            np.save(index_dir / f"{name}.npy", getattr(self, name))
+
+    @classmethod
+    def load(cls, index_dir):
+        index_dir = Path(index_dir)
+        return cls(*(np.load(index_dir / f"{name}.npy", mmap_mode='r')
+                     for name in ('keys', 'offsets', 'partners', 'angles')))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _positions(self, keys):
+        """Position of every key in the index, or -1 when it has no twins."""
+        keys = np.asarray(keys, dtype=bytes)
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[positions] == keys, positions, -1)
+
+    def lookup(self, peptide, charge):
+        """Twins of one precursor as a set of (peptide, charge, angle or None)."""
+        position = self._positions([f"{peptide}/{charge}".encode()])[0]
+        if position < 0:
+            return set()
+        start, end = self.offsets[position], self.offsets[position + 1]
+        twins = set()
+        for partner, angle in zip(self.partners[start:end].tolist(), self.angles[start:end].tolist()):
+            twin_peptide, twin_charge = partner.decode().rsplit('/', 1)
+            twins.add((twin_peptide, int(twin_charge), None if np.isnan(angle) else angle))
+        return twins
+
+    def lookup_many(self, peptides, charges):
+        """
+        Twins of many precursors at once, as a long table.
+
+        Returns a DataFrame with query (position in the input), peptide, charge,
+        twin_peptide, twin_charge and angle; queries without twins have no row.
+        """
+        queries = pd.Series(peptides, dtype=object).astype(str) + '/' + pd.Series(charges).astype(int).astype(str)
+        positions = self._positions(queries.to_numpy(dtype=bytes))
+        query = np.flatnonzero(positions >= 0)
+        starts = self.offsets[positions[query]]
+        counts = self.offsets[positions[query] + 1] - starts
+        edge = np.repeat(starts - np.concatenate(([0], np.cumsum(counts)[:-1])), counts) + np.arange(counts.sum())
+
+        twins = pd.Series(np.asarray(self.partners[edge]).astype(str), dtype=object).str.rsplit('/', n=1)
+        query = np.repeat(query, counts)
+        return pd.DataFrame({
+            'query': query,
+            'peptide': np.asarray(peptides, dtype=object)[query],
+            'charge': np.asarray(charges, dtype=int)[query],
+            'twin_peptide': twins.str[0].to_numpy(dtype=object),
+            'twin_charge': twins.str[1].astype(int).to_numpy(),
+            'angle': np.asarray(self.angles[edge]),
+        })
+
+
+def _local_source(source):
+    """Local path of a universe table: as given, in the Database directory, or through the resource cache."""
+    if str(source).startswith(('http://', 'https://')):
+        return fetch_resource(str(source))
+    source = Path(source)
+    return source if source.exists() else DATABASE_DIR / source.name
+
+
+def _index_dir(source):
+    """Index directory of a source table, keyed on its path, size and modification time."""
+    stat = os.stat(source)
+    stamp = f"{Path(source).resolve()}:{stat.st_size}:{stat.st_mtime_ns}:{INDEX_VERSION}"
+    return INDEX_DIR / f"{Path(source).stem}-{hashlib.sha1(stamp.encode()).hexdigest()[:12]}"
+
+
+def build_twin_index(source, index_dir=None):
+    """Build (or rebuild) the index of a universe CSV file and return its directory."""
+    index_dir = Path(index_dir) if index_dir is not None else _index_dir(source)
+    # Build next to the target and move it in place, so readers never see a partial index
+    staging = index_dir.with_name(f"{index_dir.name}.{os.getpid()}.tmp")
+    TwinIndex.from_table(pd.read_csv(source)).save(staging)
+    with open(staging / 'index.json', 'w') as file:
+        json.dump({'source': str(source), 'version': INDEX_VERSION}, file)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    try:
+        os.replace(staging, index_dir)
+    except OSError:
+        # Another process has just built the same index
+        shutil.rmtree(staging, ignore_errors=True)
+    return index_dir
+
+
+@lru_cache(maxsize=None)
+def load_twin_index(source):
+    """
+    TwinIndex of a universe CSV file, built on first use and loaded once per process.
+
+    source is a path, the file name of a table in the Database directory or a URL
+    (fetched through MSCI.data.resources, with the bundled Database/ copy as fallback).
+    """
+    source = _local_source(source)
+    index_dir = _index_dir(source)
+    if not (index_dir / 'index.json').exists():
+        build_twin_index(source, index_dir)
+    return TwinIndex.load(index_dir)
@@ -1,24 +1,9 @@
 # peptide_analysis.py
 import streamlit as st
 import tempfile
-import pandas as pd
-from MSCI.Preprocessing.Koina import PeptideProcessor
-from .utils import load_image
-from MSCI.Similarity.spectral_angle_similarity import process_spectra_pairs
-from MSCI.Preprocessing.read_msp_file import read_msp_file
-from matchms.importing import load_from_msp
-from matchms.exporting import save_as_msp
-from matchms.filtering import reduce_to_number_of_peaks, select_by_relative_intensity
-import os
 import matplotlib.pyplot as plt
-import sys
-import time
-# Append custom library paths
-from matchms import Spectrum
-from MSCI.Preprocessing.Koina import PeptideProcessor
-from MSCI.Grouping_MS1.Grouping_mw_irt import process_peptide_combinations
-from MSCI.Preprocessing.read_msp_file import read_msp_file
-from MSCI.Similarity.spectral_angle_similarity import process_spectra_pairs
+from .utils import load_resource
+from MSCI.pipeline import filter_stage, grouping_stage, predict_stage, scoring_stage
 # Constants
 INTENSITY_MODELS = [
     "Prosit_2020_intensity_HCD", "ms2pip_HCD2021", "ms2pip_timsTOF2023", "ms2pip_iTRAQphospho",
@@ -30,110 +15,46 @@ INTENSITY_MODELS = [
 IRT_MODELS = ["Prosit_2019_irt", "Deeplc_hela_hf", "AlphaPeptDeep_rt_generic", "Prosit_2020_irt_TMT"]
 
 
-import os
-def keep_top_n_peaks(spectrum: Spectrum, n: int) -> Spectrum:
-    """Keep only the top n most intense peaks in the spectrum."""
-    return reduce_to_number_of_peaks(spectrum, n_required=n, n_max=n)
-
-
-def keep_above_intensity(spectrum: Spectrum, threshold: float) -> Spectrum:
-    """Keep only peaks above a certain relative intensity threshold."""
-    spectrum = select_by_relative_intensity(spectrum, intensity_from=threshold, intensity_to=1.0)
-    return spectrum
-
-def filter_spectra_by_intensity(input_file_path: str, output_file_path: str, intensity_threshold: float):
-    """Filter the spectra by keeping only peaks above a certain intensity threshold."""
-    try:
-        # Load spectra from the MSP file
-        spectra = list(load_from_msp(input_file_path))
-
-        # Loop through all spectra and apply keep_above_intensity function
-        processed_spectra = []
-        for spectrum in spectra:
-            processed_spectrum = keep_above_intensity(spectrum, intensity_threshold)
-            processed_spectra.append(processed_spectrum)
-
-        # Ensure the output file is either non-existent or empty before saving
-        if os.path.exists(output_file_path):
-            os.remove(output_file_path)
-
-        # Save the processed spectra as an MSP file
-        save_as_msp(processed_spectra, output_file_path)
-
-    except Exception as e:
-        st.error(f"An error occurred while filtering spectra: {e}")
-        return None
-
-def filter_spectra_by_top_peaks(input_file_path: str, output_file_path: str, n_peaks: int):
-    """Filter the spectra by keeping only the top n peaks and format them correctly."""
-    try:
-        # Load spectra from the MSP file
-        spectra = list(load_from_msp(input_file_path))
-
-        # Loop through all spectra and apply keep_top_n_peaks function
-        processed_spectra = []
-        for spectrum in spectra:
-            processed_spectrum = keep_top_n_peaks(spectrum, n_peaks)
-            processed_spectra.append(processed_spectrum)
-
-        # Ensure the output file is either non-existent or empty before saving
-        if os.path.exists(output_file_path):
-            os.remove(output_file_path)
-
-        # Save the processed spectra as an MSP file
-        save_as_msp(processed_spectra, output_file_path)
-
-    except Exception as e:
-        st.error(f"An error occurred while filtering spectra: {e}")
-        return None
-
-def perform_analysis(mz_tolerance: float, irt_tolerance: float, use_ppm: bool):
-    if not st.session_state.spectra_cache or st.session_state.mz_irt_df_cache.empty:
+def perform_analysis(mz_tolerance: float, irt_tolerance: float, use_ppm: bool, similarity_method: str = "Spectral Angle"):
+    if st.session_state.spectra_cache is None or st.session_state.mz_irt_df_cache.empty:
         st.error("Spectra data is missing or invalid. Please ensure the MSP file is correctly loaded.")
         return
 
+    memo = st.session_state.pipeline_memo
     with st.spinner("Processing peptide combinations..."):
         try:
-            Groups_df = process_peptide_combinations(
-                st.session_state.mz_irt_df_cache, mz_tolerance, irt_tolerance, use_ppm=use_ppm
+            _, Groups_df = grouping_stage(
+                memo, st.session_state.prediction_key, st.session_state.mz_irt_df_cache,
+                mz_tolerance, irt_tolerance, use_ppm
             )
             
             st.write(f"Grouped data shape: {Groups_df.shape}")
             
-            if not {'index1', 'index2'}.issubset(Groups_df.columns):
+            if Groups_df.empty:
                 st.error("No indistinguishable pairs")
                 return
 
             index_array = Groups_df[['index1', 'index2']].values.astype(int)
-            similarity_progress = st.progress(0)
-            total_combinations = len(index_array)
-            results = []
 
             with st.spinner("Calculating spectra similarities..."):
-                for i, (idx1, idx2) in enumerate(index_array):
-                    result = process_spectra_pairs(
-                        [(idx1, idx2)], st.session_state.spectra_cache, st.session_state.mz_irt_df_cache, tolerance=mz_tolerance, ppm=use_ppm
-                    )
-                    results.append(result)
-                    similarity_progress.progress((i + 1) / total_combinations)
-
-                st.session_state.analysis_results = pd.concat(results, ignore_index=True)
+                similarity_progress = st.progress(0)
+                st.session_state.analysis_results = scoring_stage(
+                    memo, st.session_state.filter_key, st.session_state.spectra_cache, index_array,
+                    similarity_method, mz_tolerance, use_ppm,
+                    progress=lambda done, total: similarity_progress.progress(done / total)
+                )
+                similarity_progress.progress(1.0)
                 st.success("Spectra similarity analysis completed!")
 
         except Exception as e:
             st.error(f"An error occurred during analysis: {str(e)}")
 
-import tempfile
-
-import requests
-
-import requests
-
 def peptide_twins_analysis():
     """Render the Peptide Twins Analysis page."""
     st.session_state.setdefault('spectra_cache', None)
     st.session_state.setdefault('mz_irt_df_cache', None)
     st.session_state.setdefault('temp_file_path', None)
+    st.session_state.setdefault('pipeline_memo', {})
 
     st.header("Peptide Twins Analysis")
     # Input Description    
@@ -150,11 +71,9 @@ def peptide_twins_analysis():
     # **Download Example Dataset**
     example_url = "https://raw.githubusercontent.com/proteomicsunitcrg/MSCI/main/tutorial/test.txt"
 
-    # Fetch the example file
-    response = requests.get(example_url)
-    if response.status_code == 200:
-        example_data = response.text
-        
+    # Fetch the example file (cached on disk and across reruns)
+    try:
+        example_data = load_resource(example_url).decode("utf-8")
 
         # Add download button
         st.download_button(
@@ -163,7 +82,7 @@ def peptide_twins_analysis():
             file_name="example_peptides.txt",
             mime="text/plain"
         )
-    else:
+    except OSError:
         st.error("Failed to load the example dataset. Please try again.")
 
 
@@ -174,13 +93,16 @@ def peptide_twins_analysis():
     # Load example dataset if checkbox is checked
     if use_example and not uploaded_file:
         example_url = "https://raw.githubusercontent.com/zahrael97/MSCI/master/random_tryptic_peptides.txt"
-        response = requests.get(example_url)
-        if response.status_code == 200:
+        try:
+            example_text = load_resource(example_url).decode("utf-8")
+        except OSError:
+            example_text = None
+        if example_text is not None:
             st.success("Loaded example dataset successfully!")
-            st.session_state.peptide_data = response.text
+            st.session_state.peptide_data = example_text
             
             # Show the first 3 lines of the dataset
-            example_lines = response.text.splitlines()[:3]
+            example_lines = example_text.splitlines()[:3]
             st.write("### First 3 lines of the Example Dataset:")
             st.text("\n".join(example_lines))  # Display the first 3 lines
 
@@ -211,19 +133,14 @@ def peptide_twins_analysis():
     intensity_threshold = st.number_input("Intensity Threshold", min_value=0.0, max_value=1.0, step=0.01, value=0.1, key="intensity_threshold")
 
     if st.session_state.temp_file_path:
-        processor = PeptideProcessor(
-            input_file=st.session_state.temp_file_path,
-            collision_energy=collision_energy,
-            charge=charge,
-            model_intensity=model_intensity,
-            model_irt=model_irt
-        )
-
+        memo = st.session_state.pipeline_memo
         try:
+            # Each stage is memoized on its own inputs, so changing a downstream setting
+            # (tolerances, similarity method) reuses the predictions and earlier stages
             with st.spinner("Running prediction..."):
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".msp") as temp_output:
-                    output_msp_path = temp_output.name
-                    processor.process(output_msp_path)
+                prediction_key, predicted = predict_stage(
+                    memo, st.session_state.peptide_data, model_intensity, model_irt, collision_energy, charge
+                )
                 st.success("Prediction Completed Successfully")
 
             st.subheader("Spectra Analysis")
@@ -242,45 +159,22 @@ def peptide_twins_analysis():
             if st.button("Start Analysis"):
                 st.session_state.similarity_method = similarity_method
 
-                spectra_file = output_msp_path
-                
-                if filter_option == "Top N Peaks":
-                    try:
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=".msp") as temp_filtered:
-                            filtered_file = temp_filtered.name
-                            filter_spectra_by_top_peaks(
-                                spectra_file,
-                                filtered_file,
-                                st.session_state.n_peaks
-                            )
-                            spectra_file = filtered_file
-                    except Exception as e:
-                        st.error(f"An error occurred while filtering spectra: {e}")
-                        return
-
-                elif filter_option == "Intensity Threshold":
-                    try:
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=".msp") as temp_filtered:
-                            filtered_file = temp_filtered.name
-                            filter_spectra_by_intensity(
-                                spectra_file,
-                                filtered_file,
-                                st.session_state.intensity_threshold
-                            )
-                            spectra_file = filtered_file
-                    except Exception as e:
-                        st.error(f"An error occurred while filtering spectra: {e}")
-                        return
-
                 try:
-                    st.session_state.spectra_cache = list(load_from_msp(spectra_file))
-                    st.session_state.mz_irt_df_cache = read_msp_file(spectra_file)
-                    st.write(f"Loaded {len(st.session_state.spectra_cache)} spectra from the MSP file.")
+                    # Filtering works on the packed peaks in memory, without rewriting the library
+                    filter_key, packed = filter_stage(
+                        memo, prediction_key, predicted, filter_option,
+                        st.session_state.n_peaks, st.session_state.intensity_threshold
+                    )
+                    st.session_state.prediction_key = prediction_key
+                    st.session_state.filter_key = filter_key
+                    st.session_state.spectra_cache = packed
+                    st.session_state.mz_irt_df_cache = packed.metadata[['Name', 'MW', 'iRT']]
+                    st.write(f"Loaded {len(st.session_state.spectra_cache)} predicted spectra.")
                 except Exception as e:
                     st.error(f"An error occurred while loading spectra: {e}")
                     return
 
-                perform_analysis(mz_tolerance, irt_tolerance, use_ppm)
+                perform_analysis(mz_tolerance, irt_tolerance, use_ppm, similarity_method)
 
         except Exception as e:
             st.error(f"An error occurred during prediction: {e}")
@@ -331,7 +225,8 @@ def plot_spectra():
     if st.button("Plot Spectra"):
         if len(st.session_state.spectra_cache) > index1 and len(st.session_state.spectra_cache) > index2:
             plt.figure(figsize=(10, 6))
-            st.session_state.spectra_cache[index1].plot_against(st.session_state.spectra_cache[index2])
+            spectrum1 = st.session_state.spectra_cache.to_spectrum(index1)
+            spectrum1.plot_against(st.session_state.spectra_cache.to_spectrum(index2))
             st.pyplot(plt.gcf())
             plt.clf()  # Clear the plot for the next use
         else:
@@ -1,49 +1,9 @@
 import streamlit as st
 import pandas as pd
-from typing import Dict, List, Tuple
 import requests
 
-DATASETS = {
-    "Reference Human Canonical proteome": {
-        25: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/NSA_HRHR_NCE25.csv",
-        28: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/NSA_HRHR_NCE28.csv",
-        30: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/NSA_HRHR_NCE30.csv",
-        32: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/NSA_HRHR_NCE32.csv",
-        35: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/NSA_HRHR_NCE35.csv"
-    },
-    "Reference Human Canonical proteome with natural variants": {
-        30: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/mutation_peptides_HRHR_NSA_score.csv",
-    },
-    "Immunopeptidome": {
-        30: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/HLA_peptides_HRHR_NSA_score.csv",
-    },
-    "Human Oral microbiome": {
-        30: "https://raw.githubusercontent.com/zahrael97/MSCI/master/Database/Oral_microbiom.csv",
-    }
-}
-
-def extract_peptide_and_charge(peptide_str: str) -> Tuple[str, int]:
-    try:
-        peptide, charge = peptide_str.rsplit('/', 1)
-        return peptide, int(charge)
-    except ValueError:
-        return peptide_str, None
-
-def find_colliding_peptides(df: pd.DataFrame, peptide: str, charge: int, organism: str) -> set:
-    angle_available = organism in ["Reference Human Canonical proteome with natural variants", "Immunopeptidome"]
-
-    matches = df[((df['x_peptide'].apply(lambda x: extract_peptide_and_charge(x) == (peptide, charge))) |
-                  (df['y_peptide'].apply(lambda x: extract_peptide_and_charge(x) == (peptide, charge))))]
-
-    colliding_peptides = {
-        (row['x_peptide'].rsplit('/', 1)[0], int(row['x_peptide'].rsplit('/', 1)[1]), row['angle'] if angle_available else None)
-        for _, row in matches.iterrows() if row['x_peptide'].rsplit('/', 1)[0] != peptide
-    }.union({
-        (row['y_peptide'].rsplit('/', 1)[0], int(row['y_peptide'].rsplit('/', 1)[1]), row['angle'] if angle_available else None)
-        for _, row in matches.iterrows() if row['y_peptide'].rsplit('/', 1)[0] != peptide
-    })
-
-    return colliding_peptides
+from MSCI.data.twin_checker import ANGLE_UNIVERSES, DATASETS, check_peptides, read_peptide_list
+from MSCI.gui.utils import get_twin_index
 
 def peptide_twins_checker():
     st.header("Peptide Twins Checker")
@@ -68,22 +28,23 @@ def peptide_twins_checker():
             colliding_info = {}
 
             for energy in energies:
-                df_path = DATASETS[organism][energy]
+                # The universe table is indexed once per process and looked up in place
                 with st.spinner(f"Loading data for NCE {energy}..."):
                     try:
-                        df = pd.read_csv(df_path, delimiter=',')
+                        index = get_twin_index(DATASETS[organism][energy])
                     except Exception as e:
                         st.error(f"An error occurred while loading the CSV file: {e}")
                         continue
 
-                if df.empty:
+                if len(index) == 0:
                     st.warning(f"No data found in the file for NCE {energy}. Skipping.")
                     continue
 
-                with st.spinner(f"Checking for twins in NCE {energy}..."):
-                    colliding_peptides = find_colliding_peptides(df, peptide, charge, organism)
-                    if colliding_peptides:
-                        colliding_info[energy] = colliding_peptides
+                colliding_peptides = index.lookup(peptide, charge)
+                if organism not in ANGLE_UNIVERSES:
+                    colliding_peptides = {(twin, twin_charge, None) for twin, twin_charge, _ in colliding_peptides}
+                if colliding_peptides:
+                    colliding_info[energy] = colliding_peptides
 
             if colliding_info:
                 st.info(f"Peptides that are similar to {peptide} in charge {charge}:")
@@ -97,5 +58,17 @@ def peptide_twins_checker():
         else:
             st.warning("Please enter a peptide and charge to check.")
 
+    st.subheader("Check a list of peptides")
+    target_file = st.file_uploader("Upload a target list (one PEPTIDE/charge per line)", type=["txt", "csv"],
+                                   key='target_list')
+    if target_file is not None and st.button("Check list"):
+        targets = read_peptide_list(target_file.read().decode("utf-8").splitlines(), default_charge=charge)
+        twins = check_peptides(targets['peptide'], targets['charge'], organism, energies or None,
+                               load_index=get_twin_index)
+        st.write(f"{twins[['peptide', 'charge']].drop_duplicates().shape[0]} of {len(targets)} peptides have twins.")
+        st.dataframe(twins)
+        st.download_button(label="Download twins as CSV", data=twins.to_csv(index=False).encode('utf-8'),
+                           file_name='peptide_twins.csv', mime='text/csv')
+
 if __name__ == "__main__":
     peptide_twins_checker()
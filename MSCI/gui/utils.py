@@ -1,10 +1,14 @@
 # utils.py
 
 import base64
+import functools
 import streamlit as st
 from pathlib import Path
 import requests
 
+from MSCI.data.resources import RESOURCE_TTL, read_resource
+from MSCI.data.twin_index import load_twin_index
+
 def load_image(image_path: str) -> str:
     """Load and encode an image file to base64."""
     try:
@@ -14,11 +18,41 @@ def load_image(image_path: str) -> str:
         st.error(f"Image not found: {image_path}")
         return ""
     
+def _cached(kind, **options):
+    """
+    Streamlit cache decorator (st.cache_data or st.cache_resource) applied on first call.
+
+    Decorating lazily keeps this module importable without a Streamlit runtime.
+    """
+    def decorator(function):
+        cached = None
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            nonlocal cached
+            if cached is None:
+                cached = getattr(st, kind)(**options)(function)
+            return cached(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@_cached('cache_data', ttl=RESOURCE_TTL, show_spinner=False)
+def load_resource(url: str) -> bytes:
+    """Content of a remote file, from the on-disk resource cache and memoized across reruns."""
+    return read_resource(url)
+
+
+@_cached('cache_resource', show_spinner=False)
+def get_twin_index(source: str):
+    """TwinIndex of a universe table, shared by all sessions."""
+    return load_twin_index(source)
+
+
 def load_image_from_url(url):
-    response = requests.get(url)
-    if response.status_code == 200:
-        return base64.b64encode(response.content).decode('utf-8')
-    else:
+    try:
+        return base64.b64encode(load_resource(url)).decode('utf-8')
+    except OSError:
         return None
     
 
@@ -26,12 +60,11 @@ def load_image(image_path: str) -> str:
     """Load and encode an image file to base64."""
     try:
         if image_path.startswith("http://") or image_path.startswith("https://"):
-            response = requests.get(image_path)
-            if response.status_code == 200:
-                return base64.b64encode(response.content).decode('utf-8')
-            else:
+            image = load_image_from_url(image_path)
+            if image is None:
                 st.error(f"Unable to load image from URL: {image_path}")
                 return ""
+            return image
         else:
             with open(image_path, "rb") as img_file:
                 return base64.b64encode(img_file.read()).decode('utf-8')
@@ -0,0 +1,227 @@
+import itertools
+import re
+
+import numpy as np
+import pandas as pd
+
+from MSCI.Preprocessing.digestion import digest_spans, read_fasta
+
+# One single-residue UniProt feature of the 'Natural variant' column
+VARIANT_PATTERN = r'VARIANT (?P<position>\d+); /note="(?P<note>[^"]+)"'
+# Substitution notes, e.g. 'A -> T (in dbSNP:rs1234)'
+SUBSTITUTION_PATTERN = r'^(?P<original>[A-Z]) -> (?P<variant>[A-Z])\b'
+VARIANT_COLUMNS = ['Entry', 'position', 'original', 'variant', 'note']
+# Columns map_variants_to_peptides adds to the peptide spans
+MAPPED_COLUMNS = ['position', 'offset', 'original', 'variant', 'note']
+
+
+def read_proteome(fasta, accession_pattern=r'^(?:sp|tr)\|([A-Z0-9]+)\|'):
+    """Dict of UniProt accession to sequence of a FASTA file."""
+    accession = re.compile(accession_pattern)
+    proteome = {}
+    for header, sequence in read_fasta(fasta):
+        match = accession.search(header)
+        if match:
+            proteome[match.group(1)] = sequence
+    return proteome
+
+
+def read_variant_table(path):
+    """Entry and 'Natural variant' columns of a UniProt TSV export."""
+    return pd.read_csv(path, sep='\t', usecols=['Entry', 'Natural variant'])
+
+
+def parse_natural_variants(table):
+    """
+    Single-residue substitutions of a UniProt table, in one pass over all entries.
+
+    table has Entry and 'Natural variant' columns (a UniProt TSV export, see
+    read_variant_table). Returns a DataFrame with Entry, position (0-based in the
+    protein), original and variant residue and the full note. Features that are not a
+    single-residue substitution ('Missing', ranges, ...) are left out.
+    """
+    notes = table.set_index('Entry')['Natural variant'].dropna()
+    features = notes.str.extractall(VARIANT_PATTERN).reset_index(level='match', drop=True).reset_index()
+    substitutions = features['note'].str.extract(SUBSTITUTION_PATTERN)
+    variants = pd.DataFrame({
+        'Entry': features['Entry'].astype(str),
+        'position': features['position'].astype(np.int64) - 1,
+        'original': substitutions['original'],
+        'variant': substitutions['variant'],
+        'note': features['note'],
+    })
+    variants = variants[variants['variant'].notna() & (variants['position'] >= 0)]
+    return variants.drop_duplicates(['Entry', 'position', 'variant']).reset_index(drop=True)[VARIANT_COLUMNS]
+
+
+def peptide_spans(proteome, enzyme='trypsin', missed_cleavages=0, min_length=7, max_length=30):
+    """
+    Peptides of every protein with their offsets, as a DataFrame.
+
+    Columns: Entry, start, end (sequence[start:end] is the peptide) and peptide, sorted
+    by Entry then start.
+    """
+    entries, starts, ends, peptides = [], [], [], []
+    for entry, sequence in proteome.items():
+        for start, end in digest_spans(sequence, enzyme, missed_cleavages, min_length, max_length):
+            entries.append(entry)
+            starts.append(start)
+            ends.append(end)
+            peptides.append(sequence[start:end])
+    spans = pd.DataFrame({
+        'Entry': pd.Series(entries, dtype=object),
+        'start': np.asarray(starts, dtype=np.int64),
+        'end': np.asarray(ends, dtype=np.int64),
+        'peptide': pd.Series(peptides, dtype=object),
+    })
+    return spans.sort_values(['Entry', 'start', 'end'], kind='stable').reset_index(drop=True)
+
+
+def map_variants_to_peptides(spans, variants):
+    """
+    Every (peptide, variant) pair where the variant position lies inside the peptide.
+
+    Spans and variants are placed on one sorted axis (entry rank, position); the
+    peptides that can hold a variant start within max peptide length before it, so
+    they are found with two searchsorted calls per variant instead of scanning the
+    peptides of the protein. Variants whose original residue does not match the
+    sequence (other isoform numbering) are dropped.
+
+    Returns the span columns plus position, offset (of the variant in the peptide),
+    original, variant and note.
+    """
+    spans = spans.sort_values(['Entry', 'start', 'end'], kind='stable').reset_index(drop=True)
+    entry_codes = {entry: code for code, entry in enumerate(pd.unique(spans['Entry']))}
+    variants = variants[variants['Entry'].isin(entry_codes)].reset_index(drop=True)
+    if len(spans) == 0 or len(variants) == 0:
+        return pd.DataFrame(columns=list(spans.columns) + MAPPED_COLUMNS)
+
+    # Positions of all proteins on one axis, each protein on its own stretch
+    stride = int(max(spans['end'].max(), variants['position'].max() + 1)) + 1
+    span_base = spans['Entry'].map(entry_codes).to_numpy(dtype=np.int64) * stride
+    span_keys = span_base + spans['start'].to_numpy()
+    variant_keys = variants['Entry'].map(entry_codes).to_numpy(dtype=np.int64) * stride + variants['position'].to_numpy()
+    longest = int((spans['end'] - spans['start']).max())
+
+    hi = np.searchsorted(span_keys, variant_keys, side='right')
+    lo = np.searchsorted(span_keys, variant_keys - longest + 1, side='left')
+    counts = hi - lo
+    variant_rows = np.repeat(np.arange(len(variants)), counts)
+    span_rows = np.repeat(lo - np.concatenate(([0], np.cumsum(counts)[:-1])), counts) + np.arange(counts.sum())
+
+    mapped = spans.iloc[span_rows].reset_index(drop=True)
+    found = variants.iloc[variant_rows].reset_index(drop=True)
+    mapped['position'] = found['position'].to_numpy()
+    mapped['offset'] = mapped['position'] - mapped['start']
+    for column in MAPPED_COLUMNS[2:]:
+        mapped[column] = found[column].to_numpy()
+
+    # Keys of other proteins end before the stretch of the variant's protein
+    inside = variant_keys[variant_rows] < span_base[span_rows] + mapped['end'].to_numpy()
+    mapped = mapped[inside].reset_index(drop=True)
+    reference = np.array([peptide[offset] for peptide, offset in zip(mapped['peptide'], mapped['offset'].tolist())],
+                         dtype=object)
+    return mapped[reference == mapped['original'].to_numpy(dtype=object)].reset_index(drop=True)
+
+
+def _variant_combinations(variants, max_variants, reach):
+    """
+    Lazily yield tuples of (position, original, variant) sorted by position, with 1 to
+    max_variants variants at distinct positions spanning at most reach residues.
+    """
+    for anchor, first in enumerate(variants):
+        partners = [v for v in variants[anchor + 1:] if first[0] < v[0] <= first[0] + reach]
+        yield (first,)
+        for size in range(1, max_variants):
+            for others in itertools.combinations(partners, size):
+                positions = [v[0] for v in others]
+                if len(set(positions)) == size:
+                    yield (first,) + others
+
+
+def iter_variant_peptides(sequence, variants, enzyme='trypsin', missed_cleavages=0, min_length=7, max_length=30,
+                          max_variants=2):
+    """
+    Lazily yield (peptide, start, description) for the peptides of a protein carrying variants.
+
+    variants is an iterable of (position, original, variant) single-residue substitutions
+    (0-based positions); original may be None, otherwise variants that do not match the
+    sequence are skipped. Every combination of up to max_variants variants at distinct
+    positions close enough to share a peptide is applied, and the region around them
+    is digested again, so substitutions that create or remove a cleavage site give the
+    peptides of the variant protein. A peptide is yielded when it differs from the
+    reference peptides at the same place and holds, or borders, every variant of the
+    combination. Peptides are yielded once per protein; description lists the variants
+    as e.g. 'P4L;R11Q' (1-based positions).
+
+    Usage:
+    for peptide, start, description in iter_variant_peptides(sequence, [(3, 'P', 'L')]):
+        ...
+    """
+    variants = sorted({
+        (int(position), sequence[position], variant) for position, original, variant in variants
+        if 0 <= position < len(sequence) and original in (None, sequence[position]) and variant != sequence[position]
+    })
+    seen = set()
+    # Cleavage rules look at one residue on each side of a site
+    for combination in _variant_combinations(variants, max_variants, max_length + 1):
+        first, last = combination[0][0], combination[-1][0]
+        lo = max(0, last - max_length - 1)
+        hi = min(len(sequence), first + max_length + 2)
+        reference = sequence[lo:hi]
+        window = list(reference)
+        for position, _, variant in combination:
+            window[position - lo] = variant
+        window = ''.join(window)
+
+        reference_spans = set(digest_spans(reference, enzyme, missed_cleavages, min_length, max_length))
+        for start, end in digest_spans(window, enzyme, missed_cleavages, min_length, max_length):
+            if not (start - 1 <= first - lo and last - lo <= end):
+                continue
+            peptide = window[start:end]
+            if (start, end) in reference_spans and peptide == reference[start:end]:
+                continue
+            if enzyme == 'nonspecific' and not (start <= first - lo and last - lo < end):
+                continue
+            if peptide not in seen:
+                seen.add(peptide)
+                description = ';'.join(f"{original}{position + 1}{variant}" for position, original, variant in combination)
+                yield peptide, start + lo, description
+
+
+def project_variants(proteome, variants, enzyme='trypsin'):
+    """
+    Variants of parse_natural_variants placed on the cleavage fragments of their protein.
+
+    The proteins carrying variants are cut at every cleavage site (single residues for
+    'nonspecific'), so the fragments tile each sequence, and the variants are projected
+    onto them with map_variants_to_peptides: every variant whose original residue
+    matches the sequence comes back once, with its fragment (Entry, start, end, peptide)
+    and offset in it, sorted by Entry and position.
+    """
+    proteome = {entry: sequence for entry, sequence in proteome.items() if entry in set(variants['Entry'])}
+    if enzyme == 'nonspecific':
+        spans = peptide_spans(proteome, enzyme, 0, 1, 1)
+    else:
+        longest = max((len(sequence) for sequence in proteome.values()), default=1)
+        spans = peptide_spans(proteome, enzyme, 0, 1, longest)
+    mapped = map_variants_to_peptides(spans, variants)
+    return mapped.sort_values(['Entry', 'position'], kind='stable').reset_index(drop=True)
+
+
+def iter_proteome_variant_peptides(proteome, variants, enzyme='trypsin', missed_cleavages=0, min_length=7,
+                                   max_length=30, max_variants=2):
+    """
+    Lazily yield (Entry, peptide, start, description) for every protein of proteome with variants.
+
+    variants is a DataFrame from parse_natural_variants; they are located and checked
+    against the sequences through project_variants, then combined and redigested per
+    protein by iter_variant_peptides.
+    """
+    projected = project_variants(proteome, variants, enzyme)
+    for entry, protein_variants in projected.groupby('Entry', sort=False):
+        protein_variants = zip(protein_variants['position'].tolist(), protein_variants['original'].tolist(),
+                               protein_variants['variant'].tolist())
+        for peptide, start, description in iter_variant_peptides(
+                proteome[entry], protein_variants, enzyme, missed_cleavages, min_length, max_length, max_variants):
+            yield entry, peptide, start, description
@@ -0,0 +1,105 @@
+"""
+Memoized stages of the peptide twins analysis (prediction, filtering, grouping, scoring).
+
+The GUI keeps one memo per session; the stages hold no Streamlit state, so they can be
+used and tested without a Streamlit runtime.
+"""
+import hashlib
+import io
+
+import numpy as np
+import pandas as pd
+
+from MSCI.Grouping_MS1.Grouping_mw_irt import process_peptide_combinations
+from MSCI.Preprocessing.filter_spectra import filter_peaks
+from MSCI.Similarity.spectral_angle_similarity import process_spectra_pairs_cosine, score_spectra_pairs
+
+# Pairs scored per step of the scoring stage (and per progress update)
+SCORING_BATCH_SIZE = 5000
+
+
+def run_stage(memo, stage, key, compute):
+    """
+    Result of one pipeline stage, recomputed only when its key changed.
+
+    memo maps a stage name to its last (key, result); keys of downstream stages include the
+    keys of the stages they read from, so a change invalidates exactly the stages after it.
+    """
+    cached = memo.get(stage)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    result = compute()
+    memo[stage] = (key, result)
+    return result
+
+
+def predict_stage(memo, peptide_data, model_intensity, model_irt, collision_energy, charge, progress=None):
+    """Predicted spectra of the peptide list; only reruns when the list or the prediction settings change."""
+    from MSCI.Preprocessing.Koina import PeptideProcessor
+
+    key = (hashlib.sha1(peptide_data.encode()).hexdigest(), model_intensity, model_irt, collision_energy, charge)
+
+    def compute():
+        # Same parsing as PeptideProcessor.read_peptides on the uploaded file
+        peptides = pd.read_csv(io.StringIO(peptide_data), header=None)[0].tolist()
+        processor = PeptideProcessor(None, collision_energy, charge, model_intensity, model_irt,
+                                     peptides=peptides, progress=progress)
+        return processor.process_to_packed()
+
+    return key, run_stage(memo, 'prediction', key, compute)
+
+
+def filter_stage(memo, prediction_key, packed, filter_option, n_peaks, intensity_threshold):
+    """Peak-filtered spectra, keyed on the predictions and the active filter setting only."""
+    if filter_option == "Top N Peaks":
+        key = (prediction_key, filter_option, n_peaks)
+        return key, run_stage(memo, 'filtering', key, lambda: filter_peaks(packed, top_n=n_peaks))
+    if filter_option == "Intensity Threshold":
+        key = (prediction_key, filter_option, intensity_threshold)
+        return key, run_stage(memo, 'filtering', key, lambda: filter_peaks(packed, intensity_from=intensity_threshold))
+    return (prediction_key, filter_option), packed
+
+
+def grouping_stage(memo, prediction_key, mz_irt_df, mz_tolerance, irt_tolerance, use_ppm):
+    """Candidate pairs from MS1 grouping; peak filtering does not change them."""
+    key = (prediction_key, mz_tolerance, irt_tolerance, use_ppm)
+    return key, run_stage(memo, 'grouping', key, lambda: process_peptide_combinations(
+        mz_irt_df, mz_tolerance, irt_tolerance, use_ppm=use_ppm
+    ))
+
+
+def scoring_stage(memo, filter_key, packed, index_array, similarity_method, mz_tolerance, use_ppm, progress=None):
+    """
+    Similarity of every candidate pair in index_array.
+
+    Scores are kept per pair for the current spectra and scoring settings, so a new set of
+    candidate pairs (e.g. after widening the iRT tolerance) only scores the pairs not seen yet.
+    progress, if given, is called as progress(done, total) in newly scored pairs.
+    """
+    key = (filter_key, similarity_method, mz_tolerance, use_ppm)
+    cached = memo.get('scoring')
+    scored = cached[1] if cached is not None and cached[0] == key else None
+
+    pairs = pd.MultiIndex.from_arrays([index_array[:, 0], index_array[:, 1]])
+    if scored is not None:
+        missing = index_array[~pairs.isin(pd.MultiIndex.from_frame(scored[['index1', 'index2']]))]
+    else:
+        missing = index_array
+
+    results = [] if scored is None else [scored]
+    for start in range(0, len(missing), SCORING_BATCH_SIZE):
+        chunk = missing[start:start + SCORING_BATCH_SIZE]
+        if similarity_method == "Greedy Cosine Similarity":
+            spectra = {i: packed.to_spectrum(i) for i in np.unique(chunk).tolist()}
+            result = process_spectra_pairs_cosine(chunk.tolist(), spectra, packed.metadata, tolerance=mz_tolerance)
+        else:
+            # Score the pairs in batches on the packed spectra
+            result = score_spectra_pairs(chunk, packed, packed.metadata, tolerance=mz_tolerance, ppm=use_ppm)
+        results.append(result)
+        if progress is not None:
+            progress(min(start + SCORING_BATCH_SIZE, len(missing)), len(missing))
+
+    scored = pd.concat(results, ignore_index=True)
+    memo['scoring'] = (key, scored)
+    positions = pd.MultiIndex.from_frame(scored[['index1', 'index2']]).get_indexer(pairs)
+    return scored.iloc[positions].reset_index(drop=True)
@@ -0,0 +1,101 @@
+"""
+Progress reporters for the long-running stages (prediction, grouping, scoring).
+
+A reporter is called as progress(done, total); total is None when the length of a
+streamed input is not known in advance.
+"""
+import logging
+import sys
+
+logger = logging.getLogger('MSCI')
+
+PROGRESS_REPORTERS = ('tqdm', 'log', 'streamlit', 'none')
+
+
+def null_progress(done, total):
+    """Reporter that ignores progress."""
+
+
+class LogProgress:
+    """Log '<description>: done/total' through the MSCI logger, about every tenth of the run."""
+
+    def __init__(self, description="Processing", steps=10):
+        self.description = description
+        self.steps = steps
+        self._last = -1
+
+    def __call__(self, done, total):
+        if total is None:
+            # Unknown length (streamed input): log every `steps` calls
+            if done % self.steps == 0:
+                logger.info("%s: %d", self.description, done)
+            return
+        step = self.steps if total == 0 else done * self.steps // total
+        if done == 0 or step > self._last:
+            self._last = step
+            logger.info("%s: %d/%d", self.description, done, total)
+
+
+class TqdmProgress:
+    """tqdm progress bar on stderr; a call with done == 0 starts a new bar."""
+
+    def __init__(self, description="Processing"):
+        self.description = description
+        self._bar = None
+
+    def __call__(self, done, total):
+        if self._bar is None or done == 0:
+            from tqdm import tqdm
+            if self._bar is not None:
+                self._bar.close()
+            self._bar = tqdm(total=total, desc=self.description)
+        self._bar.update(done - self._bar.n)
+        if total is not None and done >= total:
+            self._bar.close()
+
+
+class StreamlitProgress:
+    """st.progress bar, with a success message once the run is complete."""
+
+    def __init__(self, message="Processing complete!"):
+        self.message = message
+        self._bar = None
+
+    def __call__(self, done, total):
+        import streamlit as st
+        if total is None:
+            return
+        if self._bar is None or done == 0:
+            self._bar = st.progress(0)
+        self._bar.progress(done / total if total else 1.0)
+        if done >= total:
+            st.success(self.message)
+
+
+def _in_streamlit():
+    """Whether the code runs inside a Streamlit app (without importing streamlit otherwise)."""
+    if 'streamlit' not in sys.modules:
+        return False
+    try:
+        from streamlit.runtime import exists
+    except ImportError:
+        return False
+    return exists()
+
+
+def default_progress(description="Processing"):
+    """Streamlit bar inside the GUI, log lines everywhere else."""
+    return StreamlitProgress() if _in_streamlit() else LogProgress(description)
+
+
+def get_progress(name, description="Processing"):
+    """Reporter by name: 'tqdm', 'log', 'streamlit' or 'none'."""
+    if name == 'tqdm':
+        return TqdmProgress(description)
+    if name == 'log':
+        return LogProgress(description)
+    if name == 'streamlit':
+        return StreamlitProgress()
+    if name == 'none':
+        return null_progress
+    raise ValueError(f"Unknown progress reporter: {name} (choose from {', '.join(PROGRESS_REPORTERS)})")
@@ -6,7 +6,8 @@ requirements = [
     'Click>=7.0',
     'streamlit',
     'matchms',
-    'scipy'
+    'scipy',
+    'pyarrow'
 ]
 
 setup(
@@ -21,6 +22,11 @@ setup(
         'Programming Language :: Python :: 3.8',
     ],
     description="MSCI assesses peptide fragmentation spectra information content.",
+    entry_points={
+        'console_scripts': [
+            'msci=MSCI.cli:main',
+        ],
+    },
     install_requires=requirements,
     license="MIT license",
     include_package_data=True,
@@ -1,13 +1,28 @@
 import pytest
 import sys
 import os
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 sys.path.append('/home/zahra/Downloads/MSCI')
 from MSCI.Preprocessing.Koina import PeptideProcessor
-from MSCI.Preprocessing.read_msp_file import read_msp_file
-from MSCI.Grouping_MS1.Grouping_mw_irt import process_peptide_combinations
-from MSCI.Similarity.spectral_angle_similarity import process_spectra_pairs
+from MSCI.Preprocessing.prediction_cache import PredictionCache
+from MSCI.Preprocessing.filter_spectra import filter_peaks, top_n_peaks, select_by_relative_intensity
+from MSCI.Preprocessing.fragments import fragment_ladders, fragment_labels, annotate_peaks
+from MSCI.Preprocessing.peptide_mass import AA_MASSES, MOD_MASSES, MASSES, peptide_masses, precursor_mzs
+from MSCI.Preprocessing.read_msp_file import read_msp_file, read_msp, msp_byte_ranges
+from MSCI.Preprocessing.spectral_library import load_library
+from MSCI.Grouping_MS1.Grouping_mw_irt import (
+    process_peptide_combinations, find_candidate_pairs, find_combinations_kdtree, make_data_compatible
+)
+from MSCI.Grouping_MS1.chunked_grouping import stream_peptide_combinations
+from MSCI.Grouping_MS1.charge_states import NeutralMassIndex, process_multicharge_combinations, PROTON_MASS
+from MSCI.Similarity.spectral_angle_similarity import process_spectra_pairs, joinPeaks, nspectraangle, score_spectra_pairs
+from MSCI.Similarity.parallel_scoring import score_spectra_pairs_parallel
 from matchms.importing import load_from_msp
 import pandas as pd
+import numpy as np
 # Ensure pandas has the version attribute
 if not hasattr(pd, 'version'):
     class Version:
@@ -49,6 +64,23 @@ def test_read_msp_file():
     assert 'MW' in mz_irt_df.columns, "The 'MW' column should be present in the DataFrame"
     assert 'iRT' in mz_irt_df.columns, "The 'iRT' column should be present in the DataFrame"
 
+@pytest.mark.parametrize("filename", ['output.msp', 'filtered_output.msp'])
+def test_read_msp_single_pass(filename):
+    """Peaks and metadata of both MSP dialects match matchms, also when parsed in byte ranges."""
+    packed = read_msp(filename)
+    spectra = list(load_from_msp(filename))
+    assert len(packed) == len(spectra)
+    for i, spectrum in enumerate(spectra):
+        mz, intensities = packed.peaks(i)
+        np.testing.assert_array_equal(mz, spectrum.peaks.mz)
+        np.testing.assert_array_equal(intensities, spectrum.peaks.intensities)
+    assert list(packed.metadata['Name']) == [spectrum.get('compound_name') for spectrum in spectra]
+    assert packed.metadata[['MW', 'iRT']].notna().all().all()
+
+    parts = [read_msp(filename, byte_range, block_size=4096) for byte_range in msp_byte_ranges(filename, 7)]
+    pd.testing.assert_frame_equal(pd.concat([part.metadata for part in parts], ignore_index=True), packed.metadata)
+    np.testing.assert_array_equal(np.concatenate([part.mz for part in parts]), packed.mz)
+
 @pytest.mark.parametrize("mz_tolerance, irt_tolerance", [(1, 10), (0.5, 5), (2, 20)])
 def test_process_peptide_combinations_param(mz_tolerance, irt_tolerance):
     mz_irt_df = read_msp_file('output.msp')
@@ -67,4 +99,829 @@ def test_process_spectra_pairs():
     index_array = Groups_df[['index1','index2']].values.astype(int)
     result = process_spectra_pairs(index_array, spectra, mz_irt_df, tolerance=0, ppm=10)
     assert result is not None, "The function should return a result"
-    assert 'similarity_score' in result.columns, "The result should contain 'similarity_score' column"
\ No newline at end of file
+    assert 'similarity_score' in result.columns, "The result should contain 'similarity_score' column"
+
+def _reference_join_peaks(x, y, tolerance, ppm):
+    """Row-by-row matcher that joinPeaks.match used before the array rewrite."""
+    x_matched, y_matched, matched_y_indices = [], [], set()
+    ppm_tolerance_x = x['mz'] * ppm * 1e-6
+    for i, x_row in x.iterrows():
+        match_found = False
+        for j, y_row in y.iterrows():
+            if j in matched_y_indices:
+                continue
+            diff = abs(y_row['mz'] - x_row['mz'])
+            if diff <= tolerance or diff <= ppm_tolerance_x[i] or diff <= y_row['mz'] * ppm * 1e-6:
+                x_matched.append([x_row['mz'], x_row['intensities']])
+                y_matched.append([y_row['mz'], y_row['intensities']])
+                matched_y_indices.add(j)
+                match_found = True
+                break
+        if not match_found:
+            x_matched.append([x_row['mz'], x_row['intensities']])
+            y_matched.append([np.nan, np.nan])
+    for j, y_row in y.iterrows():
+        if j not in matched_y_indices:
+            x_matched.append([np.nan, np.nan])
+            y_matched.append([y_row['mz'], y_row['intensities']])
+    return np.array(x_matched).reshape(-1, 2), np.array(y_matched).reshape(-1, 2)
+
+
+@pytest.mark.parametrize("tolerance, ppm", [(0, 0), (0, 10), (0.02, 0), (0.5, 20), (5, 0)])
+def test_join_peaks_matches_reference(tolerance, ppm):
+    """The array matcher must reproduce the original row-by-row matching."""
+    rng = np.random.default_rng(7)
+    spectra = list(load_from_msp('output.msp'))[:10]
+    pairs = [(spectra[i].peaks.mz, spectra[i].peaks.intensities, spectra[i + 1].peaks.mz, spectra[i + 1].peaks.intensities)
+             for i in range(len(spectra) - 1)]
+    for _ in range(20):
+        x_mz = np.sort(np.round(rng.uniform(100, 200, rng.integers(0, 30)), 2))
+        y_mz = np.sort(np.round(rng.uniform(100, 200, rng.integers(0, 30)), 2))
+        pairs.append((x_mz, rng.random(len(x_mz)), y_mz, rng.random(len(y_mz))))
+
+    matcher = joinPeaks(tolerance=tolerance, ppm=ppm)
+    for x_mz, x_int, y_mz, y_int in pairs:
+        x = pd.DataFrame({'mz': x_mz, 'intensities': x_int})
+        y = pd.DataFrame({'mz': y_mz, 'intensities': y_int})
+        expected_x, expected_y = _reference_join_peaks(x, y, tolerance, ppm)
+        x_matched, y_matched = matcher.match_arrays(x_mz, x_int, y_mz, y_int)
+        np.testing.assert_array_equal(x_matched, expected_x)
+        np.testing.assert_array_equal(y_matched, expected_y)
+
+    # Unsorted peak tables are sorted by match and refused by match_arrays
+    x = pd.DataFrame({'mz': [300.0, 100.0, 200.0], 'intensities': [3.0, 1.0, 2.0]})
+    y = pd.DataFrame({'mz': [200.0, 300.0], 'intensities': [5.0, 6.0]})
+    x_matched, y_matched = matcher.match(x, y)
+    expected_x, expected_y = _reference_join_peaks(x.sort_values('mz').reset_index(drop=True), y, tolerance, ppm)
+    np.testing.assert_array_equal(x_matched.to_numpy(), expected_x)
+    np.testing.assert_array_equal(y_matched.to_numpy(), expected_y)
+    with pytest.raises(ValueError, match='sorted'):
+        matcher.match_arrays(x['mz'], x['intensities'], y['mz'], y['intensities'])
+
+
+@pytest.mark.parametrize("tolerance, ppm", [(0, 10), (0.05, 0), (2, 0)])
+def test_score_spectra_pairs_matches_pairwise(tolerance, ppm):
+    """The batched engine must give the same angles as scoring pair by pair."""
+    spectra = list(load_from_msp('output.msp'))
+    mz_irt_df = read_msp_file('output.msp')
+    index_array = np.array([(i, j) for i in range(len(spectra)) for j in range(i + 1, len(spectra), 7)])
+
+    result = score_spectra_pairs(index_array, spectra, mz_irt_df, tolerance=tolerance, ppm=ppm, chunk_size=97)
+
+    matcher = joinPeaks(tolerance=tolerance, ppm=ppm)
+    expected = []
+    for i, j in index_array:
+        x_matched, y_matched = matcher.match_arrays(spectra[i].peaks.mz, spectra[i].peaks.intensities,
+                                                    spectra[j].peaks.mz, spectra[j].peaks.intensities)
+        expected.append(nspectraangle(x_matched, y_matched))
+    np.testing.assert_allclose(result['similarity_score'], expected, rtol=1e-9, atol=1e-12)
+    assert list(result['peptide 1']) == list(mz_irt_df.loc[index_array[:, 0], 'Name'])
+    with pytest.raises(ValueError, match='mz_irt_df'):
+        score_spectra_pairs(index_array, spectra, tolerance=tolerance, ppm=ppm)
+
+
+def test_score_spectra_pairs_parallel_matches_serial():
+    """Shared-memory workers must return the serial scores in the input order."""
+    spectra = list(load_from_msp('output.msp'))
+    mz_irt_df = read_msp_file('output.msp')
+    index_array = np.array([(i, j) for i in range(len(spectra)) for j in range(i + 1, len(spectra), 3)])
+
+    serial = score_spectra_pairs(index_array, spectra, mz_irt_df, tolerance=0, ppm=10)
+    parallel = score_spectra_pairs_parallel(index_array, spectra, mz_irt_df, tolerance=0, ppm=10,
+                                            workers=2, chunk_size=100)
+    pd.testing.assert_frame_equal(parallel, serial)
+
+
+def _reference_entropy(x_matched, y_matched):
+    """Unweighted entropy similarity of joinPeaks output, from the merged spectrum."""
+    def entropy(p):
+        p = p[p > 0]
+        return -np.sum(p * np.log(p))
+    a = np.nan_to_num(x_matched[:, 1]) / np.nansum(x_matched[:, 1])
+    b = np.nan_to_num(y_matched[:, 1]) / np.nansum(y_matched[:, 1])
+    return 1 - (2 * entropy((a + b) / 2) - entropy(a) - entropy(b)) / np.log(4)
+
+
+def test_metric_registry_matches_pairwise():
+    """All metrics from one matching pass must match pair-by-pair references."""
+    from scipy.stats import pearsonr, spearmanr
+    from MSCI.Similarity.metrics import score_pairs_metrics
+    from MSCI.Similarity.spectral_angle_similarity import ndotproduct
+
+    spectra = list(load_from_msp('output.msp'))
+    mz_irt_df = read_msp_file('output.msp')
+    index_array = np.array([(i, j) for i in range(len(spectra)) for j in range(i, len(spectra), 9)])
+    metrics = {'spectral_angle': {}, 'dot_product': {'m': 1, 'n': 0.5}, 'entropy': {}, 'pearson': {},
+               'spearman': {}, 'matched_peaks': {}}
+    result = score_pairs_metrics(index_array, spectra, mz_irt_df, metrics, tolerance=0.5, chunk_size=61)
+
+    matcher = joinPeaks(tolerance=0.5)
+    expected = {name: [] for name in metrics}
+    for i, j in index_array:
+        x_matched, y_matched = matcher.match_arrays(spectra[i].peaks.mz, spectra[i].peaks.intensities,
+                                                    spectra[j].peaks.mz, spectra[j].peaks.intensities)
+        shared = ~np.isnan(x_matched[:, 1]) & ~np.isnan(y_matched[:, 1])
+        x_shared, y_shared = x_matched[shared, 1], y_matched[shared, 1]
+        correlated = shared.sum() >= 2 and np.ptp(x_shared) > 0 and np.ptp(y_shared) > 0
+        expected['spectral_angle'].append(nspectraangle(x_matched, y_matched))
+        expected['dot_product'].append(ndotproduct(x_matched, y_matched, m=1))
+        expected['entropy'].append(_reference_entropy(x_matched, y_matched))
+        expected['pearson'].append(pearsonr(x_shared, y_shared)[0] if correlated else np.nan)
+        expected['spearman'].append(spearmanr(x_shared, y_shared)[0] if correlated else np.nan)
+        expected['matched_peaks'].append(shared.sum())
+
+    for name in metrics:
+        np.testing.assert_allclose(result[name], expected[name], rtol=1e-9, atol=1e-9, err_msg=name)
+    assert 'similarity_score' not in result.columns
+    np.testing.assert_allclose(result.loc[index_array[:, 0] == index_array[:, 1], 'entropy'], 1)
+
+    parallel = score_spectra_pairs_parallel(index_array, spectra, mz_irt_df, tolerance=0.5, workers=2,
+                                            chunk_size=50, metrics=metrics)
+    pd.testing.assert_frame_equal(parallel, result)
+    with pytest.raises(ValueError, match='Unknown metric'):
+        score_pairs_metrics(index_array, spectra, mz_irt_df, ['cosine'])
+
+
+def test_binned_prefilter_keeps_similar_pairs():
+    """The sparse binned screen must track the exact angle and only pass its survivors to exact scoring."""
+    from MSCI.Preprocessing.packed_spectra import PackedSpectra
+    from MSCI.Similarity.binned_similarity import binned_scores, binned_vectors, score_spectra_pairs_binned
+
+    spectra = list(load_from_msp('output.msp'))
+    mz_irt_df = read_msp_file('output.msp')
+    index_array = np.array([(i, j) for i in range(len(spectra)) for j in range(i, len(spectra), 2)])
+    exact = score_spectra_pairs(index_array, spectra, mz_irt_df, tolerance=0.02)['similarity_score'].to_numpy()
+
+    approximate = binned_scores(binned_vectors(PackedSpectra.from_spectra(spectra), bin_width=0.05), index_array)
+    np.testing.assert_allclose(approximate, exact, atol=0.1)
+    np.testing.assert_allclose(approximate[index_array[:, 0] == index_array[:, 1]], 1)
+
+    result = score_spectra_pairs_binned(index_array, spectra, mz_irt_df, threshold=0.4, bin_width=0.05,
+                                        tolerance=0.02, workers=1)
+    keep = approximate >= 0.4
+    assert keep.sum() < len(index_array) and (exact >= 0.5).sum() <= keep.sum()
+    assert not ((exact >= 0.5) & ~keep).any()
+    np.testing.assert_array_equal(result[['index1', 'index2']].to_numpy(), index_array[keep])
+    np.testing.assert_allclose(result['similarity_score'], exact[keep], rtol=1e-9)
+    np.testing.assert_allclose(result['binned_score'], approximate[keep])
+
+
+@pytest.mark.parametrize("use_ppm, mz_tolerance, irt_tolerance", [(False, 1, 10), (False, 0.05, 2), (True, 10, 5), (True, 500, 20)])
+def test_find_candidate_pairs_matches_kdtree(use_ppm, mz_tolerance, irt_tolerance):
+    """The sorted sweep must return exactly the pair set of the k-d tree search."""
+    rng = np.random.default_rng(3)
+    msp_df = read_msp_file('output.msp')
+    random_df = pd.DataFrame({'Name': 'x', 'MW': np.round(rng.uniform(400, 420, 3000), 3),
+                              'iRT': np.round(rng.uniform(0, 100, 3000), 1)})
+    for mz_irt_df in (msp_df, random_df):
+        expected = {(i[0], j[0]) for i, j in find_combinations_kdtree(
+            make_data_compatible(mz_irt_df), mz_tolerance, irt_tolerance, use_ppm)}
+        pos1, pos2 = find_candidate_pairs(mz_irt_df['MW'], mz_irt_df['iRT'], mz_tolerance, irt_tolerance, use_ppm,
+                                          chunk_size=1000)
+        assert pos1.dtype.kind == 'i' and pos2.dtype.kind == 'i'
+        assert set(zip(pos1.tolist(), pos2.tolist())) == expected
+        assert len(pos1) == len(expected)
+
+
+@pytest.mark.parametrize("use_ppm, mz_tolerance", [(False, 0.3), (True, 800)])
+def test_stream_peptide_combinations_matches_in_memory(tmp_path, use_ppm, mz_tolerance):
+    """Binned out-of-core grouping must write the in-memory pair set exactly once."""
+    import pyarrow.parquet as pq
+    rng = np.random.default_rng(5)
+    mz_irt_df = pd.DataFrame({'Name': [f"P{i}/2" for i in range(4000)],
+                              'MW': rng.uniform(400, 410, 4000), 'iRT': rng.uniform(0, 100, 4000)})
+    expected = process_peptide_combinations(mz_irt_df, mz_tolerance, 1, use_ppm=use_ppm)
+
+    files = stream_peptide_combinations(mz_irt_df, tmp_path / 'pairs', mz_tolerance, 1, use_ppm=use_ppm,
+                                        bin_width=0.25, chunksize=700, work_dir=tmp_path / 'bins')
+    streamed = pd.concat([pd.read_parquet(f) for f in files]).sort_values(['index1', 'index2'])
+    pd.testing.assert_frame_equal(streamed.reset_index(drop=True), expected.reset_index(drop=True))
+    # One file per mass bin, one row group per input chunk that reached it
+    bin_files = sorted((tmp_path / 'bins').iterdir())
+    assert len(bin_files) == 40 and all(f.suffix == '.parquet' for f in bin_files)
+    assert pq.ParquetFile(bin_files[0]).num_row_groups == 6
+
+
+def test_multicharge_grouping_matches_flat_grouping():
+    """One sweep over a neutral-mass index finds the same pairs as grouping every charge state row."""
+    mz_irt_df = read_msp_file('output.msp')
+    sequences = mz_irt_df['Name'].str.rsplit('/', n=1).str[0]
+    neutral = mz_irt_df['MW'] * 2 - 2 * PROTON_MASS
+    states = pd.concat([
+        pd.DataFrame({'Name': sequences + f"/{z}", 'MW': (neutral + z * PROTON_MASS) / z, 'iRT': mz_irt_df['iRT']})
+        for z in (1, 2, 3, 4)
+    ], ignore_index=True)
+
+    expected = process_peptide_combinations(states, 0.5, 10, use_ppm=False)
+    same_peptide = (expected['peptide 1'].str.rsplit('/', n=1).str[0]
+                    == expected['peptide 2'].str.rsplit('/', n=1).str[0])
+    expected = {frozenset(pair) for pair in expected.loc[~same_peptide, ['index1', 'index2']].itertuples(index=False)}
+
+    index = NeutralMassIndex.from_msp_frame(mz_irt_df)
+    assert len(index.candidate_pairs((1, 2, 3, 4), 0.5, 10, use_ppm=False)) == len(expected)
+    result = process_multicharge_combinations(states, 0.5, 10, use_ppm=False)
+    assert {frozenset(pair) for pair in result[['index1', 'index2']].itertuples(index=False)} == expected
+
+
+class _StandInKoina(BaseHTTPRequestHandler):
+    """Minimal KServe v2 stand-in: deterministic fake predictions, a 429 on the first intensity call."""
+    calls = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        peptides = body['inputs'][0]['data']
+        _StandInKoina.calls.append(self.path)
+        if self.path.endswith('intensity/infer') and self.path not in _StandInKoina.calls[:-1]:
+            self.send_response(429)
+            self.end_headers()
+            return
+        if self.path.endswith('irt/infer'):
+            outputs = [{'name': 'irt', 'data': [float(len(p)) for p in peptides]}]
+        else:
+            charges = [row for row in body['inputs'][2]['data']]
+            mz = [100.0 * (k + 1) + len(p) + z for p, z in zip(peptides, charges) for k in range(3)]
+            outputs = [{'name': 'annotation', 'data': []}, {'name': 'mz', 'data': mz},
+                       {'name': 'intensities', 'data': [0.5, 1.0, -1.0] * len(peptides)}]
+        payload = json.dumps({'outputs': outputs}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def koina_url():
+    """Base URL of a _StandInKoina server running for the duration of the test."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StandInKoina)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _reference_peptide_mass(sequence):
+    """Residue-by-residue mass, as PeptideProcessor.calculate_peptide_mass used to compute it."""
+    total = MASSES["N_TERMINUS"] + MASSES["C_TERMINUS"]
+    for residue, modification in re.findall(r'([A-Z])(\[UNIMOD:\d+\])?', sequence):
+        total += AA_MASSES[residue] + MOD_MASSES.get(modification, 0.0)
+    return total
+
+
+def test_peptide_masses_match_reference():
+    """Batch masses match the residue-by-residue sum; unknown residues and modifications are masked."""
+    rng = np.random.default_rng(3)
+    residues = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+    sequences = [''.join(rng.choice(residues, size=rng.integers(7, 30))) for _ in range(300)]
+    sequences = [sequence.replace('M', 'M[UNIMOD:35]').replace('C', 'C[UNIMOD:4]') for sequence in sequences]
+    masses, valid = peptide_masses(sequences)
+    assert valid.all()
+    np.testing.assert_allclose(masses, [_reference_peptide_mass(sequence) for sequence in sequences], rtol=0, atol=1e-9)
+
+    mz, valid = precursor_mzs(['[UNIMOD:1]-PEPTIDE', 'PEPTIDEX', 'PEPK[UNIMOD:999]', 'PEP[]', 'M[UNIMOD:35]'], charges=(1, 2))
+    assert valid.tolist() == [True, False, False, True, True]
+    np.testing.assert_allclose(mz[0], (_reference_peptide_mass('PEPTIDE') + 42.010565 + np.array([1, 2]) * PROTON_MASS) / [1, 2])
+    assert np.isnan(mz[1:3]).all()
+
+    # SILAC, phospho and water loss add their modification mass to the residue
+    labelled = ['PEPTIDEK[UNIMOD:259]', 'PEPTIDER[UNIMOD:267]', 'K[UNIMOD:259]R[UNIMOD:267]',
+                'PEPS[UNIMOD:21]T[UNIMOD:21]Y[UNIMOD:21]K', 'PEPS[UNIMOD:23]T[UNIMOD:23]Y[UNIMOD:23]K']
+    masses, valid = peptide_masses(labelled)
+    assert valid.all()
+    np.testing.assert_allclose(masses, [_reference_peptide_mass(sequence) for sequence in labelled], rtol=0, atol=1e-9)
+    np.testing.assert_allclose(masses[2] - _reference_peptide_mass('KR'), 8.014199 + 10.008269, atol=1e-9)
+
+
+def test_fragment_ladders_match_pyteomics():
+    """b/y/a ladders at several charges match pyteomics, and predicted peaks are annotated."""
+    mass = pytest.importorskip('pyteomics.mass')
+    sequences = ['PEPTIDE', 'SAMPLER', 'XX', 'GGK']
+    ladders, annotations = fragment_ladders(sequences, ion_types=('a', 'b', 'y'), fragment_charges=(1, 2),
+                                            with_annotations=True)
+    labels = fragment_labels(annotations).to_numpy()
+    assert ladders.counts.tolist() == [36, 36, 0, 12]
+    for i, sequence in enumerate(sequences):
+        mz, _ = ladders.peaks(i)
+        assert np.all(np.diff(mz) >= 0)
+        for peak_mz, label in zip(mz, labels[ladders.offsets[i]:ladders.offsets[i + 1]]):
+            ion_type, number, charge = label[0], int(label[1:].split('^')[0]), int(label.split('^')[1]) if '^' in label else 1
+            fragment = sequence[:number] if ion_type in 'ab' else sequence[-number:]
+            assert peak_mz == pytest.approx(mass.fast_mass(fragment, ion_type=ion_type, charge=charge), abs=1e-5)
+
+    library = read_msp('output.msp')
+    sequences = library.metadata['Name'].str.rsplit('/', n=1).str[0]
+    annotated = annotate_peaks(library, sequences, tolerance=0.02, fragment_charges=(1, 2, 3))
+    assert len(annotated) == len(library.mz)
+    assert annotated['matched'].all()
+
+
+def _write_mzml(path, n_spectra, indexed=True):
+    """Small run alternating MS1 and MS2 spectra with unsorted peaks."""
+    pyopenms = pytest.importorskip('pyopenms')
+    experiment = pyopenms.MSExperiment()
+    for scan in range(n_spectra):
+        spectrum = pyopenms.MSSpectrum()
+        spectrum.setMSLevel(1 if scan % 3 == 0 else 2)
+        spectrum.setRT(10.0 * scan)
+        spectrum.setNativeID(f"scan={scan + 1}")
+        spectrum.set_peaks((np.array([300.0 + scan, 100.0 + scan, 500.5]), np.array([1.0, 2.0, 3.0], dtype=np.float32)))
+        if spectrum.getMSLevel() == 2:
+            precursor = pyopenms.Precursor()
+            precursor.setMZ(400.0 + scan)
+            precursor.setCharge(2)
+            spectrum.setPrecursors([precursor])
+        experiment.addSpectrum(spectrum)
+    mzml_file = pyopenms.MzMLFile()
+    options = mzml_file.getOptions()
+    options.setWriteIndex(indexed)
+    mzml_file.setOptions(options)
+    mzml_file.store(str(path), experiment)
+
+
+@pytest.mark.parametrize("indexed", [True, False])
+def test_iter_mzml_streams_ms2_packed(tmp_path, indexed):
+    """MS2 spectra come out packed and m/z-sorted, with precursors, in batches or in parallel ranges."""
+    path = tmp_path / 'run.mzML'
+    _write_mzml(path, 30, indexed)
+    from MSCI.Preprocessing.read_mzml import iter_mzml, read_mzml, read_mzml_parallel
+
+    batches = list(iter_mzml(path, batch_size=7))
+    assert [len(batch) for batch in batches] == [7, 7, 6]
+    packed = read_mzml(path)
+    assert packed.metadata['scan'].tolist() == [scan for scan in range(30) if scan % 3]
+    np.testing.assert_allclose(packed.metadata['MW'], 400.0 + packed.metadata['scan'])
+    assert (packed.metadata['charge'] == 2).all()
+    mz, intensities = packed.peaks(0)
+    np.testing.assert_allclose(mz, [101.0, 301.0, 500.5])
+    np.testing.assert_allclose(intensities, [2.0, 1.0, 3.0])
+
+    parallel = read_mzml_parallel(path, workers=3)
+    pd.testing.assert_frame_equal(parallel.metadata, packed.metadata)
+    np.testing.assert_array_equal(parallel.mz, packed.mz)
+
+
+def test_iter_mgf_counts_missing_fields(tmp_path):
+    """MGF spectra stream in packed batches; missing RTINSECONDS/PEPMASS are counted, not printed."""
+    from collections import Counter
+    from MSCI.Preprocessing.read_mgf import iter_mgf
+    path = tmp_path / 'run.mgf'
+    blocks = []
+    for i in range(5):
+        header = [f"TITLE=spectrum {i}", "CHARGE=2+"]
+        if i != 1:
+            header.append(f"PEPMASS={500 + i}")
+        if i != 3:
+            header.append(f"RTINSECONDS={60 * i}")
+        peaks = [f"{300 + i} 10", f"{200 + i} 20"]
+        blocks.append("\n".join(["BEGIN IONS"] + header + peaks + ["END IONS"]))
+    path.write_text("\n\n".join(blocks) + "\n")
+
+    summary = Counter()
+    batches = list(iter_mgf(str(path), batch_size=2, summary=summary))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert summary == Counter(spectra=5, missing_pepmass=1, missing_rtinseconds=1)
+    metadata = pd.concat([batch.metadata for batch in batches], ignore_index=True)
+    assert metadata['Name'].tolist() == [f"spectrum {i}" for i in range(5)]
+    assert metadata['MW'].isna().tolist() == [False, True, False, False, False]
+    assert metadata['RT'].isna().tolist() == [False, False, False, True, False]
+    mz, intensities = batches[0].peaks(1)
+    np.testing.assert_array_equal(mz, [201, 301])
+    np.testing.assert_array_equal(intensities, [20, 10])
+
+
+@pytest.mark.parametrize("n_peaks, intensity_from", [(6, 0.1), (1, 0.5), (100, 0.0)])
+def test_packed_peak_filters_match_matchms(n_peaks, intensity_from):
+    """Whole-library filters keep the same peaks as the per-spectrum matchms filters."""
+    from matchms.filtering import reduce_to_number_of_peaks, select_by_relative_intensity as matchms_relative
+    from MSCI.Preprocessing.packed_spectra import PackedSpectra
+    packed = read_msp('output.msp')
+    spectra = list(load_from_msp('output.msp'))
+    top = top_n_peaks(packed, n_peaks)
+    top_all = top_n_peaks(packed, n_peaks, n_required=0)
+    relative = select_by_relative_intensity(packed, intensity_from)
+    assert len(top) == len(top_all) == len(relative) == len(spectra)
+    for i, spectrum in enumerate(spectra):
+        # Spectra the matchms filter drops (fewer than n_required peaks) are emptied in place
+        expected = reduce_to_number_of_peaks(spectrum, n_required=n_peaks, n_max=n_peaks)
+        expected = np.empty(0) if expected is None else expected.peaks.intensities
+        # Ties at the cut-off may be broken differently, compare the kept intensities
+        np.testing.assert_array_equal(np.sort(top.peaks(i)[1]), np.sort(expected))
+        expected = reduce_to_number_of_peaks(spectrum, n_max=n_peaks)
+        np.testing.assert_array_equal(np.sort(top_all.peaks(i)[1]), np.sort(expected.peaks.intensities))
+        expected = matchms_relative(spectrum, intensity_from=intensity_from)
+        np.testing.assert_array_equal(relative.peaks(i)[0], expected.peaks.mz)
+
+    # Ties at the cut-off keep the peaks of higher m/z
+    ties = PackedSpectra.from_peak_lists([[100.0, 200.0, 300.0, 400.0], [150.0]], [[5.0, 1.0, 5.0, 5.0], [2.0]])
+    np.testing.assert_array_equal(top_n_peaks(ties, 2, n_required=0).mz, [300.0, 400.0, 150.0])
+    assert top_n_peaks(ties, 2).counts.tolist() == [2, 0]
+
+    filtered = filter_peaks(packed, top_n=n_peaks, mz_range=(200, 800), remove_zeros=True)
+    assert (filtered.counts <= n_peaks).all()
+    assert ((filtered.mz >= 200) & (filtered.mz <= 800) & (filtered.intensities > 0)).all()
+    pd.testing.assert_frame_equal(filtered.metadata, packed.metadata)
+
+
+@pytest.mark.parametrize("table, organism", [
+    ('NSA_HRHR_NCE30.csv', "Reference Human Canonical proteome"),
+    ('HLA_peptides_HRHR_NSA_score.csv', "Immunopeptidome"),
+])
+def test_twin_index_matches_find_colliding_peptides(tmp_path, monkeypatch, table, organism):
+    """Index lookups return the same twins as scanning the table, single and batched."""
+    from MSCI.data import twin_index
+    from MSCI.data.twin_checker import find_colliding_peptides
+    monkeypatch.setattr(twin_index, 'INDEX_DIR', tmp_path)
+    twin_index.load_twin_index.cache_clear()
+    index = twin_index.load_twin_index(table)
+    assert isinstance(index.keys, np.memmap)
+
+    df = pd.read_csv(f'Database/{table}')
+    queries = [name.rsplit('/', 1) for name in pd.concat([df['x_peptide'], df['y_peptide']]).sample(40, random_state=1)]
+    queries = [(peptide, int(charge)) for peptide, charge in queries] + [('NOTINTHETABLE', 2)]
+    for peptide, charge in queries:
+        assert index.lookup(peptide, charge) == find_colliding_peptides(df, peptide, charge, organism)
+
+    batch = index.lookup_many([peptide for peptide, _ in queries], [charge for _, charge in queries])
+    for position, (peptide, charge) in enumerate(queries):
+        rows = batch[batch['query'] == position]
+        assert (rows['peptide'] == peptide).all() and (rows['charge'] == charge).all()
+        assert len(rows) == len(index.lookup(peptide, charge))
+    assert twin_index.load_twin_index(table) is index
+
+
+def test_batch_checker_and_cli(tmp_path, monkeypatch):
+    """A target list is checked at every energy in one call, from the API and the check command."""
+    from click.testing import CliRunner
+    from MSCI import cli
+    from MSCI.data import resources, twin_index
+    from MSCI.data.twin_checker import check_peptides, read_peptide_list, DATASETS
+    monkeypatch.setattr(resources, 'OFFLINE', True)
+    monkeypatch.setattr(resources, 'RESOURCE_DIR', tmp_path / 'resources')
+    monkeypatch.setattr(twin_index, 'INDEX_DIR', tmp_path / 'index')
+    twin_index.load_twin_index.cache_clear()
+    organism = "Reference Human Canonical proteome"
+
+    targets = read_peptide_list(['ELEELSER/2', 'sslaevqseier,2', 'NOTINTHETABLE', ''], default_charge=3)
+    assert targets.values.tolist() == [['ELEELSER', 2], ['SSLAEVQSEIER', 2], ['NOTINTHETABLE', 3]]
+    twins = check_peptides(targets['peptide'], targets['charge'], organism)
+    assert list(twins.columns) == ['peptide', 'charge', 'NCE', 'twin_peptide', 'twin_charge', 'angle']
+    assert set(twins['NCE']) <= set(DATASETS[organism]) and twins['angle'].isna().all()
+    for energy in DATASETS[organism]:
+        index = twin_index.load_twin_index(DATASETS[organism][energy])
+        expected = {(twin, twin_charge) for twin, twin_charge, _ in index.lookup('ELEELSER', 2)}
+        rows = twins[(twins['peptide'] == 'ELEELSER') & (twins['NCE'] == energy)]
+        assert set(zip(rows['twin_peptide'], rows['twin_charge'])) == expected
+    assert 'NOTINTHETABLE' not in set(twins['peptide'])
+    loaded = []
+    check_peptides(['ELEELSER'], [2], organism, [30, 28],
+                   load_index=lambda source: loaded.append(source) or twin_index.load_twin_index(source))
+    assert loaded == [DATASETS[organism][30], DATASETS[organism][28]]
+
+    input_file = tmp_path / 'targets.txt'
+    input_file.write_text('ELEELSER/2\nSSLAEVQSEIER/2\n')
+    result = CliRunner().invoke(cli.main, ['check', str(input_file), str(tmp_path / 'twins.csv'), '-e', '30'])
+    assert result.exit_code == 0, result.output
+    written = pd.read_csv(tmp_path / 'twins.csv')
+    assert (written['NCE'] == 30).all()
+    assert len(written) == len(twins[twins['NCE'] == 30])
+
+
+def test_concurrent_koina_batches(tmp_path, koina_url):
+    """Batches run concurrently against a local v2 server, with retries, and are written in input order."""
+    peptides = ['PEPTIDE', 'SAMPLER', 'AAAAK', 'LLLLLLR', 'GGGK', 'MMMMR', 'WWK']
+    input_file = tmp_path / 'peptides.txt'
+    input_file.write_text('\n'.join(peptides) + '\n')
+    processor = PeptideProcessor(input_file=str(input_file), collision_energy=30, charge=[2, 3],
+                                 model_intensity="Prosit_2020_intensity_HCD", model_irt="Prosit_2019_irt",
+                                 server_url=koina_url,
+                                 batch_size=2, max_workers=3, backoff_factor=0.01)
+    processor.process(str(tmp_path / 'out.msp'))
+
+    library = read_msp_file(str(tmp_path / 'out.msp'))
+    assert list(library['Name']) == [f"{p}/{z}" for p in peptides for z in (2, 3)]
+    assert list(library['iRT']) == [float(len(p)) for p in peptides for z in (2, 3)]
+
+
+def test_binary_library_matches_msp(tmp_path, koina_url):
+    """A library written straight from the predictions holds the same spectra as the MSP output."""
+    input_file = tmp_path / 'peptides.txt'
+    input_file.write_text('PEPTIDE\nSAMPLER\nAAAAK\nGGGK\n')
+    processor = PeptideProcessor(input_file=str(input_file), collision_energy=30, charge=[2, 3],
+                                 model_intensity="Prosit_2020_intensity_HCD", model_irt="Prosit_2019_irt",
+                                 server_url=koina_url,
+                                 batch_size=3, backoff_factor=0.01)
+    processor.process(str(tmp_path / 'out.msp'))
+    processor.process_to_library(tmp_path / 'out.msl')
+    in_memory = processor.process_to_packed()
+
+    expected = read_msp_file(str(tmp_path / 'out.msp'))
+    spectra = list(load_from_msp(str(tmp_path / 'out.msp')))
+    packed = load_library(tmp_path / 'out.msl')
+
+    assert isinstance(packed.mz, np.memmap)
+    assert list(in_memory.metadata['Name']) == list(expected['Name'])
+    np.testing.assert_allclose(in_memory.mz, packed.mz, atol=1e-4)
+    assert list(packed.metadata['Name']) == list(expected['Name'])
+    np.testing.assert_allclose(packed.metadata['MW'], expected['MW'], atol=1e-6)
+    np.testing.assert_allclose(packed.metadata['iRT'], expected['iRT'])
+    for i, spectrum in enumerate(spectra):
+        mz, intensities = packed.peaks(i)
+        np.testing.assert_allclose(mz, spectrum.peaks.mz, atol=0.005)
+        np.testing.assert_allclose(intensities, spectrum.peaks.intensities, atol=1e-6)
+
+
+def test_prediction_cache_serves_repeated_runs(tmp_path, koina_url):
+    """A second run with the same settings is answered from the cache without any request."""
+    input_file = tmp_path / 'peptides.txt'
+    input_file.write_text('PEPTIDE\nSAMPLER\nAAAAK\n')
+    cache = PredictionCache(tmp_path / 'cache.sqlite')
+    outputs = []
+    for run in range(2):
+        processor = PeptideProcessor(input_file=str(input_file), collision_energy=30, charge=2,
+                                     model_intensity="Prosit_2020_intensity_HCD", model_irt="Prosit_2019_irt",
+                                     server_url=koina_url,
+                                     backoff_factor=0.01, cache=cache)
+        calls_before = len(_StandInKoina.calls)
+        processor.process(str(tmp_path / f'run{run}.msp'))
+        outputs.append((tmp_path / f'run{run}.msp').read_text())
+    assert len(_StandInKoina.calls) == calls_before
+    processor.max_workers = 1
+    processor.batch_size = 1
+    cache.warm(processor, iter(['WARMEDK', 'PEPTIDE']))
+
+    assert outputs[0] == outputs[1]
+    assert cache.stats() == {'intensity_entries': 4, 'irt_entries': 4, 'hits': 8, 'misses': 8}
+
+    # Least recently used entries go first once the cache is over its size
+    cache.get_irt(['SAMPLER'], "Prosit_2019_irt")
+    cache.max_entries = 2
+    cache.put_irt(['NEWPEPTIDE'], "Prosit_2019_irt", [1.0])
+    assert cache.get_irt(['NEWPEPTIDE', 'SAMPLER', 'PEPTIDE'], "Prosit_2019_irt") == [1.0, 7.0, None]
+
+
+def test_prediction_cache_warms_through_any_processor(tmp_path, koina_url):
+    """warm fills the cache it is called on, even for a processor built without it."""
+    cache = PredictionCache(tmp_path / 'cache.sqlite')
+    other = PredictionCache(tmp_path / 'other.sqlite')
+    for processor_cache in (None, other):
+        processor = PeptideProcessor(None, collision_energy=30, charge=2,
+                                     model_intensity="Prosit_2020_intensity_HCD", model_irt="Prosit_2019_irt",
+                                     server_url=koina_url,
+                                     backoff_factor=0.01, cache=processor_cache)
+        cache.warm(processor, ['PEPTIDE', 'SAMPLER'])
+        assert processor.cache is processor_cache
+
+    assert cache.get_irt(['PEPTIDE', 'SAMPLER'], "Prosit_2019_irt") == [7.0, 7.0]
+    assert other.stats()['irt_entries'] == 0
+
+
+def test_resource_cache_revalidates_and_falls_back(tmp_path, monkeypatch):
+    """Remote files are served from disk within the TTL, revalidated by ETag, and bundled offline."""
+    from MSCI.data import resources
+    monkeypatch.setattr(resources, 'RESOURCE_DIR', tmp_path / 'resources')
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.headers.get('If-None-Match'))
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', '7')
+            self.end_headers()
+            self.wfile.write(b'PEPTIDE')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/tutorial/test.txt"
+    try:
+        assert resources.read_resource(url, offline=False) == b'PEPTIDE'
+        assert resources.read_resource(url, offline=False) == b'PEPTIDE'
+        assert requests_seen == [None]
+        assert resources.read_resource(url, ttl=0, offline=False) == b'PEPTIDE'
+        assert requests_seen == [None, '"v1"']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Stale copies are used when the server is gone
+    assert resources.read_resource(url, ttl=0, offline=False) == b'PEPTIDE'
+    bundled = "https://raw.githubusercontent.com/zahrael97/MSCI/master/tutorial/test.txt"
+    assert resources.fetch_resource(bundled, offline=True) == resources.REPO_ROOT / 'tutorial' / 'test.txt'
+    with pytest.raises(OSError):
+        resources.fetch_resource("https://example.invalid/missing.txt", offline=True)
+
+
+def test_gui_stages_reuse_upstream_results(monkeypatch):
+    """Changing a downstream setting reruns only that stage, and scoring only new candidate pairs."""
+    from MSCI import pipeline
+    from MSCI.pipeline import run_stage
+    memo, calls = {}, []
+    assert run_stage(memo, 'prediction', ('a', 30), lambda: calls.append(1) or 'spectra') == 'spectra'
+    assert run_stage(memo, 'prediction', ('a', 30), lambda: calls.append(1) or 'other') == 'spectra'
+    assert run_stage(memo, 'prediction', ('a', 28), lambda: calls.append(1) or 'other') == 'other'
+    assert len(calls) == 2
+
+    packed = read_msp('output.msp')
+    scored_rows = []
+    score = pipeline.score_spectra_pairs
+    monkeypatch.setattr(pipeline, 'score_spectra_pairs',
+                        lambda chunk, *args, **kwargs: scored_rows.append(len(chunk)) or score(chunk, *args, **kwargs))
+
+    narrow = np.array([[0, 1], [2, 3]])
+    wide = np.array([[4, 5], [0, 1], [2, 3], [6, 7]])
+    first = pipeline.scoring_stage(memo, 'f', packed, narrow, "Spectral Angle", 0.02, False)
+    second = pipeline.scoring_stage(memo, 'f', packed, wide, "Spectral Angle", 0.02, False)
+    assert scored_rows == [2, 2]
+    assert second[['index1', 'index2']].values.tolist() == wide.tolist()
+    np.testing.assert_allclose(second['similarity_score'].iloc[1:3], first['similarity_score'])
+    np.testing.assert_allclose(second['similarity_score'], score(wide, packed, packed.metadata, tolerance=0.02)['similarity_score'])
+    pipeline.scoring_stage(memo, 'g', packed, narrow, "Spectral Angle", 0.02, False)
+    assert scored_rows == [2, 2, 2]
+
+
+def test_cli_runs_pipeline_from_fasta(tmp_path, koina_url):
+    """msci run digests a FASTA file, predicts, groups and scores without the GUI."""
+    from click.testing import CliRunner
+    from MSCI import cli
+    from MSCI.Preprocessing.digestion import read_fasta, tryptic_digest
+    fasta = tmp_path / 'proteins.fasta'
+    fasta.write_text('>sp|P1|ONE\nMAKPEPTIDERSAMP\nLERKAAAAAAAK\n>sp|P2|TWO\nPEPTIDERGGGGGGGK\n')
+    assert [header for header, _ in read_fasta(fasta)] == ['sp|P1|ONE', 'sp|P2|TWO']
+    assert tryptic_digest('MAKPEPTIDERSAMPLERKAAAAAAAK', missed_cleavages=1) == [
+        'MAKPEPTIDER', 'MAKPEPTIDERSAMPLER', 'SAMPLER', 'SAMPLERK', 'KAAAAAAAK', 'AAAAAAAK'
+    ]
+
+    result = CliRunner().invoke(cli.main, [
+        'run', str(fasta), str(tmp_path / 'out'), '--server-url', koina_url,
+        '-z', '2', '-z', '3', '--da', '-m', '5', '-t', '100', '--tolerance', '20', '--fragment-ppm',
+        '--workers', '1', '--batch-size', '2', '--progress', 'none',
+    ])
+    assert result.exit_code == 0, result.output
+
+    library = load_library(tmp_path / 'out' / 'library.msl')
+    # FASTA input is deduplicated on disk like msci digest, so the peptides come sorted
+    peptides = ['AAAAAAAK', 'GGGGGGGK', 'MAKPEPTIDER', 'PEPTIDER', 'SAMPLER']
+    assert list(library.metadata['Name']) == [f"{p}/{z}" for p in peptides for z in (2, 3)]
+    pairs = pd.read_parquet(tmp_path / 'out' / 'pairs.parquet')
+    expected_pairs = process_peptide_combinations(library.metadata, 5, 100, use_ppm=False)
+    assert pairs[['index1', 'index2']].values.tolist() == expected_pairs[['index1', 'index2']].values.tolist()
+    scores = pd.read_parquet(tmp_path / 'out' / 'scores.parquet')
+    expected = score_spectra_pairs(pairs[['index1', 'index2']].to_numpy(), library, ppm=20)
+    np.testing.assert_allclose(scores['similarity_score'], expected['similarity_score'])
+
+
+def test_digest_fasta_deduplicates_on_disk(tmp_path):
+    """Spilled sorted runs merge into the same distinct peptide set as an in-memory digestion."""
+    from click.testing import CliRunner
+    from MSCI import cli
+    from MSCI.Preprocessing.digestion import digest, digest_fasta, read_fasta
+    from MSCI.Preprocessing.create_hla import generate_variable_length_peptides
+    rng = np.random.default_rng(3)
+    residues = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+    proteins = [''.join(rng.choice(residues, rng.integers(30, 120))) for _ in range(40)]
+    proteins += proteins[:10] + ['PEPTIDEXKSAMPLERK']
+    fasta = tmp_path / 'proteins.fasta'
+    fasta.write_text(''.join(f">sp|P{i}|PROT{i}\n{p[:50]}\n{p[50:]}\n" for i, p in enumerate(proteins)))
+
+    assert list(digest('MKPARPDKAAD', 'trypsin/p', 0, 1, 10)) == ['MK', 'PAR', 'PDK', 'AAD']
+    assert list(digest('AAKDAAD', 'asp-n', 0, 1, 10)) == ['AAK', 'DAA', 'D']
+    assert sorted(generate_variable_length_peptides('ACDEFGHIKL', 8, 9)) == sorted(
+        ['ACDEFGHI', 'CDEFGHIK', 'DEFGHIKL', 'ACDEFGHIK', 'CDEFGHIKL'])
+
+    for enzyme, missed, low, high in (('trypsin', 2, 7, 30), ('nonspecific', 0, 8, 11)):
+        expected = sorted({peptide for _, sequence in read_fasta(fasta)
+                           for peptide in digest(sequence, enzyme, missed, low, high) if 'X' not in peptide})
+        for max_in_memory in (10, 10_000_000):
+            output = tmp_path / f"{enzyme}-{max_in_memory}.txt"
+            assert digest_fasta(fasta, output, enzyme, missed, low, high, max_in_memory=max_in_memory) == len(expected)
+            assert output.read_text().split() == expected
+
+    masses, _ = peptide_masses(expected)
+    result = CliRunner().invoke(cli.main, ['digest', str(fasta), str(tmp_path / 'cli.txt'), '--enzyme', 'nonspecific',
+                                           '--min-length', '8', '--max-length', '11', '--max-mass', '1000'])
+    assert result.exit_code == 0, result.output
+    assert (tmp_path / 'cli.txt').read_text().split() == [p for p, m in zip(expected, masses) if m <= 1000]
+
+
+def test_write_unique_peptides_cleans_up_on_failure(tmp_path, monkeypatch):
+    """A failed digestion or merge leaves neither run files nor a staging file behind."""
+    from MSCI.Preprocessing import digestion
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    output = tmp_path / 'out' / 'peptides.txt'
+    output.parent.mkdir()
+
+    def failing_batches():
+        yield ['PEPTIDEK', 'SAMPLERK']
+        yield ['AAAAK', 'CCCCK']
+        raise RuntimeError("digestion failed")
+
+    with pytest.raises(RuntimeError, match='digestion failed'):
+        digestion.write_unique_peptides(failing_batches(), output, max_in_memory=2, work_dir=work_dir)
+    assert list(work_dir.iterdir()) == [] and list(output.parent.iterdir()) == []
+
+    def failing_merge(runs, file):
+        file.write("PARTIAL\n")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(digestion, '_merge_runs', failing_merge)
+    with pytest.raises(OSError, match='disk full'):
+        digestion.write_unique_peptides([['PEPTIDEK', 'SAMPLERK'], ['AAAAK']], output, max_in_memory=2,
+                                        work_dir=work_dir)
+    assert list(work_dir.iterdir()) == [] and list(output.parent.iterdir()) == []
+
+
+def test_variant_projection_matches_scan():
+    """Variants parsed in one pass map to the same peptides as scanning every peptide of the protein."""
+    from MSCI.mutation.variants import map_variants_to_peptides, parse_natural_variants, peptide_spans
+    rng = np.random.default_rng(5)
+    residues = np.array(list('ACDEFGHIKLMNPQRSTVWY'))
+    proteome = {f"P{i:05d}": ''.join(rng.choice(residues, rng.integers(20, 200))) for i in range(30)}
+    notes = []
+    for entry, sequence in proteome.items():
+        positions = rng.choice(len(sequence), min(len(sequence), 8), replace=False)
+        features = [f'VARIANT {p + 1}; /note="{sequence[p]} -> {rng.choice(residues)} (in dbSNP:rs{p})"; '
+                    f'/evidence="ECO:0000269"' for p in positions]
+        features.append('VARIANT 2; /note="Missing"')
+        features.append(f'VARIANT 1; /note="{"W" if sequence[0] != "W" else "C"} -> A"')
+        notes.append('; '.join(features))
+    table = pd.DataFrame({'Entry': list(proteome) + ['Q99999'], 'Natural variant': notes + [np.nan]})
+
+    variants = parse_natural_variants(table)
+    assert len(variants) == 30 * 9 and not variants['note'].str.startswith('Missing').any()
+    spans = peptide_spans(proteome, 'trypsin', 2, 4, 40)
+    mapped = map_variants_to_peptides(spans, variants)
+
+    expected = set()
+    for variant in variants.itertuples():
+        sequence = proteome[variant.Entry]
+        if sequence[variant.position] != variant.original:
+            continue
+        for span in spans[spans['Entry'] == variant.Entry].itertuples():
+            if span.start <= variant.position < span.end:
+                expected.add((variant.Entry, span.start, span.end, variant.position - span.start, variant.variant))
+    assert set(zip(mapped['Entry'], mapped['start'], mapped['end'], mapped['offset'], mapped['variant'])) == expected
+    assert len(mapped) == len(expected)
+
+
+def test_variant_peptides_redigest_cleavage_sites(tmp_path, koina_url):
+    """Lazy variant peptides equal a full redigestion of every variant protein, streamed into prediction."""
+    import itertools
+    from MSCI.Preprocessing.digestion import digest_spans
+    from MSCI.mutation.variants import iter_variant_peptides, iter_proteome_variant_peptides, project_variants
+    rng = np.random.default_rng(11)
+    residues = np.array(list('AKRPGLSE'))
+    for enzyme, missed, low, high in (('trypsin', 1, 3, 12), ('lys-c', 0, 2, 10), ('nonspecific', 0, 4, 6)):
+        for _ in range(5):
+            sequence = ''.join(rng.choice(residues, 40))
+            positions = rng.choice(40, 7, replace=False).tolist() + [int(rng.integers(40))]
+            variants = [(p, None, str(rng.choice([r for r in 'KRPL' if r != sequence[p]]))) for p in positions]
+            reference = {(s, e, sequence[s:e]) for s, e in digest_spans(sequence, enzyme, missed, low, high)}
+            expected = set()
+            for size in (1, 2):
+                for combo in itertools.combinations(variants, size):
+                    if len({p for p, _, _ in combo}) < size:
+                        continue
+                    mutated = list(sequence)
+                    for p, _, v in combo:
+                        mutated[p] = v
+                    mutated = ''.join(mutated)
+                    expected |= {mutated[s:e] for s, e in digest_spans(mutated, enzyme, missed, low, high)
+                                 if (s, e, mutated[s:e]) not in reference}
+            found = list(iter_variant_peptides(sequence, variants, enzyme, missed, low, high, max_variants=2))
+            assert len(found) == len({peptide for peptide, _, _ in found})
+            assert {peptide for peptide, _, _ in found} == expected
+            table = pd.DataFrame({'Entry': 'P0', 'position': [p for p, _, _ in variants],
+                                  'original': [sequence[p] for p, _, _ in variants],
+                                  'variant': [v for _, _, v in variants], 'note': ''})
+            projected = iter_proteome_variant_peptides({'P0': sequence}, table, enzyme, missed, low, high)
+            assert {peptide for _, peptide, _, _ in projected} == expected
+
+    proteome = {'P1': 'MAKPEPTIDERSAMPLER', 'P2': 'GGGGKLLLLR'}
+    variants = pd.DataFrame({'Entry': ['P1', 'P2', 'P2', 'P3'], 'position': [3, 4, 6, 0],
+                             'original': ['P', 'K', 'W', 'M'], 'variant': ['L', 'E', 'A', 'V'],
+                             'note': ['P -> L', 'K -> E', 'W -> A', 'M -> V']})
+    rows = list(iter_proteome_variant_peptides(proteome, variants, min_length=1))
+    assert rows == [('P1', 'MAK', 0, 'P4L'), ('P1', 'LEPTIDER', 3, 'P4L'), ('P2', 'GGGGELLLLR', 0, 'K5E')]
+    for enzyme in ('trypsin', 'nonspecific'):
+        projected = project_variants(proteome, variants, enzyme)
+        assert list(zip(projected['Entry'], projected['position'])) == [('P1', 3), ('P2', 4)]
+
+    processor = PeptideProcessor(None, 30, 2, "Prosit_2020_intensity_HCD", "Prosit_2019_irt",
+                                 server_url=koina_url,
+                                 batch_size=2, backoff_factor=0.01, progress=lambda done, total: None,
+                                 peptides=(row[1] for row in iter_proteome_variant_peptides(proteome, variants, min_length=1)))
+    packed = processor.process_to_packed()
+    assert list(packed.metadata['Name']) == ['MAK/2', 'LEPTIDER/2', 'GGGGELLLLR/2']